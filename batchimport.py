@@ -0,0 +1,195 @@
+"""Parse many CSV files at once on a pool of processes, for `DBManager.import_csv_files`.
+
+Each file is read, normalized and validated in a worker process, which only imports
+pandas and NumPy. Rather than pickling the parsed DataFrame back to the parent, the
+worker copies its columns into one `multiprocessing.shared_memory` block as flat NumPy
+buffers (float64 for numbers, fixed width unicode for text, a mask of the nulls of
+each) and returns a small description of the block. The parent copies the columns out
+and unlinks the block, so a file's rows cross the process boundary as one memcpy.
+
+The pool is started with the `spawn` method, so workers don't inherit the threads,
+database connections or GUI of the parent."""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Buffers in a block start on multiples of this many bytes.
+_align = 8
+
+
+def file_spec(table_cols, foreign=None, label_column="category"):
+    """Describe the columns a file is parsed into, from the `DBColumn`s of the table as a
+    dict of name -> column. The description only holds plain values, so it can be sent
+    to the workers."""
+    return {
+        "columns": {name: {"numeric": col.is_numeric(), "required": not col.can_self_generate()}
+                    for name, col in table_cols.items()},
+        "foreign": foreign[0] if foreign else None,
+        "label_column": label_column
+    }
+
+
+def parse_file(path, spec):
+    """Read the CSV file at path and validate its rows against spec (see `file_spec()`).
+
+    Text is stripped and runs of whitespace collapsed, so the same product written
+    slightly differently by two suppliers is still seen as a duplicate, and empty text is
+    null. Rows missing a required value, or with a value that isn't a number in a numeric
+    column, are rejected. Columns the table doesn't know are ignored. Returns the rows
+    packed into shared memory, see `pack()`. Raises ValueError if a required column is missing."""
+    columns, label_column = spec["columns"], spec["label_column"]
+    header = pd.read_csv(path, nrows=0).columns.tolist()
+
+    required = []
+    for name, col in columns.items():
+        if not col["required"]:
+            continue
+        if name in header:
+            required.append(name)
+        elif name == spec["foreign"] and label_column in header:
+            required.append(label_column)
+        else:
+            raise ValueError(f"`{path}` is missing the required column `{name}`.")
+
+    known = [name for name in header if name in columns or name == label_column]
+    df = pd.read_csv(path, dtype=object, usecols=known, keep_default_na=False, na_values=[""])
+
+    valid = df[required].notna().all(axis=1)
+    for name in known:
+        if name in columns and columns[name]["numeric"]:
+            values = pd.to_numeric(df[name], errors="coerce")
+            valid &= values.notna() | df[name].isna()
+            df[name] = values.astype(np.float64)
+        else:
+            text = df[name].str.strip().str.replace(r"\s+", " ", regex=True)
+            df[name] = text.where(text != "")
+    # Stripping can empty a required text value.
+    valid &= df[required].notna().all(axis=1)
+
+    rejected = int((~valid).sum())
+    return pack(path, df[valid].reset_index(drop=True), rejected)
+
+
+def pack(path, df, rejected=0):
+    """Copy the columns of df into a new shared memory block. Returns a dict describing
+    the block, which `unpack()` turns back into the DataFrame."""
+    arrays = []
+    for name in df.columns:
+        series = df[name]
+        mask = series.isna().to_numpy()
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            values = series.fillna("").to_numpy(dtype=str)
+        arrays.append((name, values, mask))
+
+    meta = {"path": path, "rows": len(df), "rejected": rejected, "shm": None, "columns": []}
+    size = 0
+    for name, values, mask in arrays:
+        buffers = []
+        for array in (values, mask):
+            buffers.append((size, array.dtype.str))
+            size += -(-array.nbytes // _align) * _align
+        meta["columns"].append((name, buffers))
+    if size == 0:
+        # Nothing to share, eg every row was rejected.
+        meta["columns"] = [(name, None) for name, _, _ in arrays]
+        return meta
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        for (name, values, mask), (_, buffers) in zip(arrays, meta["columns"]):
+            for array, (offset, dtype) in zip((values, mask), buffers):
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=offset)[:] = array
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+    meta["shm"] = shm.name
+    shm.close()
+    if multiprocessing.parent_process() is not None:
+        # The parent unlinks the block once it has read it, the worker mustn't remove it when it exits.
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return meta
+
+
+def unpack(meta):
+    """Copy the rows of a block described by meta (see `pack()`) into a DataFrame, and unlink the block."""
+    if meta["shm"] is None:
+        return pd.DataFrame({name: pd.Series(dtype=object) for name, _ in meta["columns"]})
+
+    rows = meta["rows"]
+    shm = shared_memory.SharedMemory(name=meta["shm"])
+    values = mask = None
+    try:
+        data = {}
+        for name, ((values_offset, values_dtype), (mask_offset, mask_dtype)) in meta["columns"]:
+            values = np.ndarray(rows, dtype=values_dtype, buffer=shm.buf, offset=values_offset)
+            mask = np.ndarray(rows, dtype=mask_dtype, buffer=shm.buf, offset=mask_offset)
+            if values.dtype.kind == "U":
+                series = pd.Series(values.astype(object))
+                series[mask] = None
+            else:
+                series = pd.Series(values.copy())
+            data[name] = series
+        return pd.DataFrame(data)
+    finally:
+        # The arrays viewing the block have to be gone before it can be closed.
+        values = mask = None
+        shm.close()
+        shm.unlink()
+
+
+def discard(meta):
+    """Unlink the block of meta without reading it."""
+    if meta["shm"] is None:
+        return
+    shm = shared_memory.SharedMemory(name=meta["shm"])
+    shm.close()
+    shm.unlink()
+
+
+def parse_files(paths, spec, workers=None, progress=None):
+    """Parse the files at paths on a pool of at most workers processes (the number of CPUs
+    by default), see `parse_file()`. With one worker or one file the files are parsed in
+    this process. Yields (path, DataFrame, rows rejected, None) for each parsed file and
+    (path, None, 0, error) for each file that failed, in the order they finish. progress
+    is called with (files done, files) after each file."""
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+
+    if workers <= 1:
+        for done, path in enumerate(paths, 1):
+            try:
+                meta = parse_file(path, spec)
+            except (OSError, ValueError, pd.errors.ParserError) as err:
+                yield path, None, 0, err
+            else:
+                yield path, unpack(meta), meta["rejected"], None
+            if progress is not None:
+                progress(done, len(paths))
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    futures = {pool.submit(parse_file, path, spec): path for path in paths}
+    try:
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures.pop(future)
+            try:
+                meta = future.result()
+            except (OSError, ValueError, pd.errors.ParserError) as err:
+                yield path, None, 0, err
+            else:
+                yield path, unpack(meta), meta["rejected"], None
+            if progress is not None:
+                progress(done, len(paths))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        # Files parsed but never read, eg after a cancellation, still hold a block each.
+        for future in futures:
+            if not future.cancelled() and future.exception() is None:
+                discard(future.result())
@@ -0,0 +1,217 @@
+"""Run the same conformance checks and timings against every database backend, see `dbbackends`.
+
+Each backend gets fresh `products` and `categories` tables, the checks make sure rows,
+ids, updates, deletes and upserts come back the same on every backend and the timings
+cover bulk inserts, reads and saving a mix of changes.
+
+SQLite runs in a temporary file. MySQL is only run when asked for, against the server in
+the DBManager config and a scratch database (`datavault_bench` unless given), which is emptied.
+
+Run from the repository root: python -m benchmarks.bench_backends [rows] [backend[:db] ...]"""
+import numpy as np
+import os
+import pandas as pd
+import sys
+import tempfile
+import time
+
+from dbmanager import ChangeSet, ConflictError, DBManager
+
+
+def make_products(n, categories, seed=0):
+    """Make n products spread over the category ids 1 to categories."""
+    rng = np.random.default_rng(seed)
+    brands = np.array([None] + [f"Brand {i}" for i in range(200)], dtype=object)
+    return pd.DataFrame({
+        "id_category": rng.integers(1, categories + 1, n),
+        "name": [f"Product {i}" for i in range(n)],
+        "brand": brands[rng.integers(0, len(brands), n)],
+        "stock_available": rng.integers(0, 500, n),
+        "selling_price": rng.integers(100, 100000, n) / 100
+    })
+
+
+def use_backend(name, db):
+    """Point DBManager at a fresh, empty database on the backend called name."""
+    DBManager.updateconfig("backend", name)
+    DBManager.updateconfig("db", db)
+    DBManager.updateconfig("table", "products")
+
+    if name == "mysql":
+        with DBManager.open_connection(ignore_db=True) as con:
+            con.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{db}`")
+    with DBManager.open_connection() as con:
+        cursor = DBManager.get_backend().cursor(con)
+        # The version table goes too, or the schema would be taken as already migrated.
+        tables = [table["table"] for table in DBManager._feed_tables] + [DBManager._version_table["table"]]
+        for table in ["products", "categories"] + tables:
+            cursor.execute(f"DROP TABLE IF EXISTS `{table}`")
+        con.commit()
+
+    DBManager.setup_db()
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(f"{DBManager.getconfig('backend')}: {message}")
+
+
+def run_checks():
+    """Check that the backend behaves the way DBManager expects, on a handful of rows."""
+    # 0 turns a setting off rather than falling back to the default, only None does that.
+    for key, message in (("feed_poll_ms", "stop polling for changes"), ("page_prefetch", "stop reading pages ahead")):
+        DBManager.updateconfig(key, 0)
+        check(DBManager.getconfig(key) == 0, f"{key}=0 doesn't {message}")
+        DBManager.updateconfig(key, None)
+    check(DBManager.getconfig("feed_poll_ms") == DBManager._config_defaults["feed_poll_ms"],
+          "an unset feed_poll_ms doesn't fall back to the default")
+    for slow_ms, logged in ((1e-6, True), (0, False)):
+        DBManager.updateconfig("slow_query_ms", slow_ms)
+        DBManager.query_stats.reset()
+        DBManager.get_dbdata("products", cached=False)
+        check(bool(DBManager.query_report()["slow"]) == logged,
+              f"slow_query_ms={slow_ms} {'didn' if logged else 'did'}'t log the read as slow")
+    DBManager.updateconfig("slow_query_ms", None)
+
+    ids = DBManager.insert_returning_ids(
+        "categories", pd.DataFrame({"title": ["Food", "Drink"]}))
+    check(ids == [1, 2], f"category ids {ids} aren't [1, 2]")
+
+    products = make_products(10, categories=2)
+    products.loc[3, "brand"] = None
+    report = DBManager.save_changes(ChangeSet(insert=products))
+    check(report["rows"] == 10, "not every product was inserted")
+
+    df = DBManager.get_dbdata("products")
+    check(sorted(df["id_product"]) == sorted(report["ids"].astype(int)),
+          "the ids reported by bulk_insert don't match the ids in the table")
+    check(df["brand"].isna().sum() == products["brand"].isna().sum(),
+          "missing brands didn't come back as missing")
+    check(np.allclose(sorted(df["selling_price"]), sorted(products["selling_price"])),
+          "prices didn't come back the same")
+
+    version = DBManager.table_version("products")
+    edited = df.copy()
+    edited.loc[0, "stock_available"] = 12345
+    edited = edited.drop(index=[1])
+    report = DBManager.add_df_to_db(edited, "products", read_version=version)
+    check((report["updated"], report["deleted"]) == (1, 1),
+          f"expected 1 update and 1 delete, got {report['updated']} and {report['deleted']}")
+
+    upsert = edited.iloc[[0]].copy()
+    upsert["name"] = "Renamed"
+    new_row = upsert.copy()
+    new_row["id_product"] = 1000
+    DBManager.upsert("products", pd.concat([upsert, new_row]))
+
+    df = DBManager.get_dbdata("products").set_index("id_product")
+    check(len(df) == 10, f"expected 10 products after the upsert, got {len(df)}")
+    check(df.loc[int(upsert["id_product"].iloc[0]), "name"] == "Renamed",
+          "the upsert didn't update the existing row")
+    check(df.loc[int(upsert["id_product"].iloc[0]), "stock_available"] == 12345,
+          "the update of the edited row was lost")
+
+    # Every write shows up in the change feed, and a save of rows read before it is refused.
+    since = DBManager.table_version("products")
+    key = int(upsert["id_product"].iloc[0])
+    with DBManager.open_connection() as con:
+        DBManager.add_stock(DBManager.cursor(con), "products", {key: 1})
+        con.commit()
+    DBManager.save_changes(ChangeSet(delete=[1000]))
+    changed, deleted, _ = DBManager.changes_since("products", since)
+    check(changed["id_product"].tolist() == [key] and deleted == [1000],
+          "the change feed doesn't have the stock change and the delete")
+    try:
+        DBManager.save_changes(ChangeSet(update=pd.DataFrame({"id_product": [key], "name": ["Stale"]}),
+                                         changed=pd.DataFrame({"name": [True]}),
+                                         versions={key: int(df.loc[key, "row_version"])}))
+    except ConflictError as err:
+        check(err.keys == [key], f"the conflict was reported for {err.keys}")
+    else:
+        check(False, "a save of a row changed since it was read went through")
+    DBManager.save_changes(ChangeSet(insert=new_row))
+
+    chunks = list(DBManager.get_dbdata("products", chunksize=3))
+    check([len(chunk) for chunk in chunks] == [3, 3, 3, 1],
+          "the table wasn't streamed in chunks of 3 rows")
+
+    # Searches match by prefix whatever the case, as MySQL's default collation does.
+    for search in ("renamed", "RENAM", "Renamed"):
+        check(DBManager.count_rows("products", search=search) == 2,
+              f"searching for {search!r} didn't count the renamed products")
+        page = DBManager.get_page("products", search=search)
+        check(page["id_product"].tolist() == [key, 1000], f"searching for {search!r} didn't find the renamed products")
+    check(DBManager.count_rows("products", search="renamedx") == 0, "a longer prefix still matched")
+
+    # Rows are deleted by leaving them out, whatever version they were last written at.
+    version = DBManager.table_version("products")
+    df = DBManager.get_dbdata("products", cached=False)
+    last = int(df.loc[df["row_version"].idxmax(), "id_product"])
+    DBManager.add_df_to_db(df[df["id_product"] != last], "products", read_version=version)
+    check(last not in DBManager.get_dbdata("products", cached=False)["id_product"].tolist(),
+          "leaving out the row written last didn't delete it")
+
+    version = DBManager.table_version("products")
+    df = DBManager.get_dbdata("products", cached=False)
+    DBManager.add_df_to_db(df.iloc[0:0], "products", read_version=version)
+    check(DBManager.count_rows("products") == 0, "saving an empty frame didn't delete every row")
+
+
+def run_timings(n):
+    """Time bulk inserts, a full read and saving a mix of changes on n products."""
+    DBManager.insert_returning_ids(
+        "categories", pd.DataFrame({"title": [f"Category {i}" for i in range(300)]}))
+    products = make_products(n, categories=300)
+    results = {}
+
+    start = time.perf_counter()
+    DBManager.save_changes(ChangeSet(insert=products))
+    results["insert_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    version = DBManager.table_version("products")
+    df = DBManager.get_dbdata("products")
+    results["read_s"] = time.perf_counter() - start
+
+    # Edit 1% of the rows, delete 1% and add 1%.
+    edited = df.copy()
+    step = 100
+    edited.loc[::step, "stock_available"] += 1
+    edited = edited.drop(index=edited.index[1::step])
+    edited = pd.concat([edited, make_products(n // step, categories=300, seed=1)],
+                       ignore_index=True)
+
+    start = time.perf_counter()
+    DBManager.add_df_to_db(edited, "products", read_version=version)
+    results["save_mix_s"] = time.perf_counter() - start
+
+    results["rows"] = n
+    return results
+
+
+def main(n=100000, *backends):
+    backends = backends or ("sqlite",)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in backends:
+            name, _, db = spec.partition(":")
+            if name == "sqlite":
+                db = db or os.path.join(tmp, "bench.db")
+            db = db or "datavault_bench"
+
+            use_backend(name, db)
+            run_checks()
+            use_backend(name, db)
+            results[name] = run_timings(n)
+            DBManager.close_pools()
+
+    print(f"{n} rows")
+    for name, result in results.items():
+        print(f"{name:>7}: insert {result['insert_s']:7.3f} s, read {result['read_s']:7.3f} s, "
+              f"save mix {result['save_mix_s']:7.3f} s")
+    return results
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]), *sys.argv[2:])
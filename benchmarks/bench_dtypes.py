@@ -0,0 +1,74 @@
+"""Compare the memory use and groupby/merge time of a products DataFrame built the way
+pandas infers it from the driver's tuples against one built with the compact dtypes
+of `DBManager.apply_dtypes`.
+
+Run from the repository root: python -m benchmarks.bench_dtypes [rows]"""
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import sys
+import time
+
+from dbmanager import DBManager
+
+
+def make_rows(n, seed=0):
+    """Make n rows of products as the MySQL driver returns them, ie with Decimal prices,
+    in the order of the columns of the table. Columns not generated here are NULL."""
+    rng = np.random.default_rng(seed)
+    brands = [None] + [f"Brand {i}" for i in range(200)]
+    categories = rng.integers(1, 300, n)
+    brand_idx = rng.integers(0, len(brands), n)
+    stock = rng.integers(0, 500, n)
+    cents = rng.integers(100, 100000, n)
+    versions = rng.integers(1, n + 1, n)
+
+    values = {
+        "id_product": range(1, n + 1),
+        "id_category": (int(category) for category in categories),
+        "name": (f"Product {i}" for i in range(n)),
+        "barcode": (f"{5000000000000 + i}" if i % 4 else None for i in range(n)),
+        "brand": (brands[i] for i in brand_idx),
+        "stock_available": (int(count) for count in stock),
+        "selling_price": (Decimal(int(cent)).scaleb(-2) for cent in cents),
+        "row_version": (int(version) for version in versions)
+    }
+    return list(zip(*(values.get(col, [None] * n) for col in DBManager.get_table_cols("products"))))
+
+
+def measure(df):
+    start = time.perf_counter()
+    df.groupby("id_category").agg(count=("id_product", "size"),
+                                  stock=("stock_available", "sum"),
+                                  price=("selling_price", "mean"))
+    groupby_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df.merge(df[["id_product", "brand"]], on="id_product")
+    merge_time = time.perf_counter() - start
+
+    return {
+        "memory_mb": df.memory_usage(deep=True).sum() / 2 ** 20,
+        "groupby_s": groupby_time,
+        "merge_s": merge_time
+    }
+
+
+def main(n=200000):
+    rows = make_rows(n)
+    cols = DBManager.get_table_cols("products")
+
+    before = pd.DataFrame(rows, columns=cols)
+    after = DBManager.apply_dtypes(pd.DataFrame(rows, columns=cols), "products")
+
+    results = {"inferred": measure(before), "compact": measure(after)}
+    print(f"{n} rows")
+    for name, result in results.items():
+        print(f"{name:>9}: {result['memory_mb']:8.2f} MB, groupby {result['groupby_s'] * 1000:8.2f} ms, "
+              f"merge {result['merge_s'] * 1000:8.2f} ms")
+    return results
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
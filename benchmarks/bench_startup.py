@@ -0,0 +1,100 @@
+"""Check that the command line entry point starts fast and without any GUI library.
+
+Each command is run `repeat` times in a fresh interpreter, the median wall time is compared
+against its budget and the modules it imported are checked for tkinter, matplotlib and
+pandastable. `--help` must not even import pandas. The commands that touch the database
+run against a small SQLite database in a temporary folder.
+
+Run from the repository root: python -m benchmarks.bench_startup [repeat]
+Exits with 1 if a command is over its budget or imported a GUI library."""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Median wall time each command may take from interpreter start to exit, in seconds.
+BUDGETS_S = {
+    "help": 0.3,
+    "stats": 2.0,
+    "export": 2.0
+}
+
+GUI_MODULES = ("tkinter", "matplotlib", "pandastable")
+
+# Runs datavault.main in a fresh interpreter and reports the modules it imported.
+_probe = """
+import json, sys
+sys.argv = ["datavault"] + json.loads(sys.argv[1])
+import datavault
+try:
+    code = datavault.main(sys.argv[1:])
+finally:
+    sys.stdout.flush()
+    sys.stderr.write("\\nMODULES " + json.dumps(sorted({name.split(".")[0] for name in sys.modules})) + "\\n")
+sys.exit(code or 0)
+"""
+
+
+def run_command(args):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", _probe, json.dumps(args)], cwd=ROOT,
+                          capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+
+    modules = []
+    for line in proc.stderr.splitlines():
+        if line.startswith("MODULES "):
+            modules = json.loads(line[len("MODULES "):])
+    return seconds, proc.returncode, modules, proc.stderr
+
+
+def main(repeat=5):
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ["--backend", "sqlite", "--db", os.path.join(tmp, "startup.db")]
+        csv_path = os.path.join(ROOT, "import-products.csv")
+        code = run_command(db + ["import", csv_path])[1]
+        if code != 0:
+            raise RuntimeError(f"Setting up the benchmark database failed with exit code {code}.")
+
+        commands = {
+            "help": ["--help"],
+            "stats": db + ["stats"],
+            "export": db + ["export", os.path.join(tmp, "export.csv")]
+        }
+        for name, args in commands.items():
+            times, modules = [], []
+            for _ in range(repeat):
+                seconds, code, modules, stderr = run_command(args)
+                if code != 0:
+                    failures.append(f"{name} exited with {code}: {stderr.strip()}")
+                    break
+                times.append(seconds)
+            if not times:
+                continue
+
+            median = statistics.median(times)
+            gui = [module for module in GUI_MODULES if module in modules]
+            if name == "help" and "pandas" in modules:
+                gui.append("pandas")
+            over = median > BUDGETS_S[name]
+
+            print(f"{name:>8}: {median * 1000:8.1f} ms (budget {BUDGETS_S[name] * 1000:.0f} ms)"
+                  f"{'  OVER BUDGET' if over else ''}{'  imported ' + ', '.join(gui) if gui else ''}")
+            if over:
+                failures.append(f"{name} took {median:.3f}s, over its budget of {BUDGETS_S[name]}s")
+            if gui:
+                failures.append(f"{name} imported {', '.join(gui)}")
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:2])))
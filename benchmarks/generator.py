@@ -0,0 +1,114 @@
+"""Generate synthetic product catalogues, from a few thousand rows to tens of millions.
+
+The catalogues look like a real shop's: the number of categories and brands grows
+with the catalogue, a few brands and categories hold most of the products, some
+products have no brand, stock is mostly low with some items sold out, and prices
+follow a log-normal spread around a typical price for each category. Everything is
+drawn from a seeded generator, so the same arguments always give the same catalogue.
+
+Run from the repository root to write a CSV in the format of `import-products.csv`:
+python -m benchmarks.generator rows path [seed]"""
+import numpy as np
+import pandas as pd
+import sys
+
+_adjectives = ("Fresh", "Frozen", "Organic", "Baby", "Pet", "Garden", "Kitchen", "Office", "Outdoor",
+               "Bath", "Party", "Travel", "Sports", "Home", "Craft", "Health", "Snack", "Winter")
+_nouns = ("Drinks", "Chips", "Sweets", "Bread", "Dairy", "Meat", "Fruit", "Vegetables", "Cleaning",
+          "Toys", "Tools", "Lighting", "Paper", "Storage", "Care", "Supplies", "Accessories", "Goods")
+_syllables = ("ka", "lo", "mi", "ra", "to", "ve", "su", "no", "pa", "zi", "be", "do", "fu", "ga")
+_products = ("Classic", "Original", "Light", "Extra", "Mini", "Family Pack", "Value", "Premium",
+             "Lite", "Max", "Plus", "Select")
+
+# Share of the products without a brand.
+NO_BRAND = 0.15
+
+
+def category_count(rows):
+    """The number of categories in a catalogue of rows products, about 40 at 1k and 5k at 10M."""
+    return int(np.clip(round(0.6 * rows ** 0.6), 10, 5000))
+
+
+def brand_count(rows):
+    """The number of brands in a catalogue of rows products, about 150 at 1k and 30k at 10M."""
+    return int(np.clip(round(3 * rows ** 0.57), 20, 100000))
+
+
+def make_categories(n, seed=0):
+    """Make n unique category titles."""
+    titles = [f"{adjective} {noun}" for noun in _nouns for adjective in _adjectives]
+    np.random.default_rng(seed).shuffle(titles)
+    return [titles[idx % len(titles)] + ("" if idx < len(titles) else f" {idx // len(titles) + 1}")
+            for idx in range(n)]
+
+
+def make_brands(n, seed=0):
+    """Make n unique brand names."""
+    # Every three syllable name once, in a random order, then again with a number.
+    size = len(_syllables)
+    order = np.random.default_rng(seed + 1).permutation(size ** 3)
+    names = []
+    for idx in range(n):
+        code = int(order[idx % len(order)])
+        name = (_syllables[code // size ** 2] + _syllables[code // size % size] +
+                _syllables[code % size]).capitalize()
+        names.append(name if idx < len(order) else f"{name} {idx // len(order) + 1}")
+    return names
+
+
+def zipf_weights(n, exponent=1.1):
+    """Popularity of n items where a few are very popular, normalised to sum to 1."""
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def iter_catalogue(rows, chunksize=1000000, seed=0):
+    """Yield the products of a catalogue of rows products as DataFrames of at most chunksize
+    rows, with the category title in a `category` column rather than `id_category`.
+    Only one chunk is held in memory at a time, so this scales to any number of rows."""
+    rng = np.random.default_rng(seed)
+    categories = np.array(make_categories(category_count(rows), seed), dtype=object)
+    brands = np.array(make_brands(brand_count(rows), seed), dtype=object)
+    category_weights = zipf_weights(len(categories), 0.8)
+    brand_weights = zipf_weights(len(brands))
+    # The typical price of each category, in currency units.
+    category_prices = rng.lognormal(mean=3.5, sigma=1.0, size=len(categories))
+    products = np.array(_products, dtype=object)
+
+    for start in range(0, rows, chunksize):
+        n = min(chunksize, rows - start)
+        category_idx = rng.choice(len(categories), size=n, p=category_weights)
+        brand = brands[rng.choice(len(brands), size=n, p=brand_weights)]
+        brand[rng.random(n) < NO_BRAND] = None
+        variant = products[rng.integers(0, len(products), n)]
+
+        # Mostly low stock with a long tail, and some sold out items.
+        stock = rng.geometric(0.03, n) - 1
+        stock[rng.random(n) < 0.05] = 0
+        price = np.round(category_prices[category_idx] *
+                         rng.lognormal(0, 0.4, n), 2).clip(0.5, 99999)
+
+        yield pd.DataFrame({
+            "category": categories[category_idx],
+            "name": [f"{v} {i}" for i, v in zip(range(start, start + n), variant)],
+            "brand": brand,
+            "stock_available": stock,
+            "selling_price": price
+        })
+
+
+def make_catalogue(rows, seed=0):
+    """Make a whole catalogue of rows products as one DataFrame, see `iter_catalogue()`."""
+    return pd.concat(iter_catalogue(rows, seed=seed), ignore_index=True)
+
+
+def write_csv(path, rows, seed=0, chunksize=1000000):
+    """Write a catalogue of rows products to path as CSV, in the format of `import-products.csv`."""
+    for idx, chunk in enumerate(iter_catalogue(rows, chunksize=chunksize, seed=seed)):
+        chunk.to_csv(path, mode="w" if idx == 0 else "a",
+                     header=idx == 0, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    write_csv(sys.argv[2], int(sys.argv[1]), *(int(arg) for arg in sys.argv[3:]))
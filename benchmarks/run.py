@@ -0,0 +1,299 @@
+"""Benchmark the DBManager and GUI data paths on synthetic catalogues and store the results as JSON.
+
+Every benchmark runs against a local SQLite database (see `dbbackends`) filled from
+`benchmarks.generator`, so no database server is needed and the same arguments always
+give the same data. Each benchmark is timed `repeat` times, with the database put back
+in its starting state before every run, and then run once more under `tracemalloc` for
+its peak memory. Results are written to `benchmarks/results/`, two result files can be
+compared to spot regressions between versions.
+
+Run from the repository root:
+python -m benchmarks.run [--rows 1000 100000 ...] [--repeat 5] [--only name ...] [--out path]
+python -m benchmarks.run --compare old.json new.json [--threshold 1.1]"""
+import argparse
+import datetime
+import json
+import numpy as np
+import os
+import pandas as pd
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import generator
+from dbmanager import DBManager
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# Share of the rows edited, deleted or added by the `add_df_to_db` benchmarks.
+CHANGE_SHARE = 0.01
+
+
+class Bench(object):
+    """The state shared by the benchmarks of one catalogue size: a database file holding
+    the catalogue, the catalogue as DataFrames and a CSV file of it."""
+
+    def __init__(self, rows, folder, seed=0):
+        self.rows = rows
+        self.folder = folder
+        self.seed = seed
+        self.base_db = os.path.join(folder, f"base_{rows}.db")
+        self.db = os.path.join(folder, f"work_{rows}.db")
+        self.csv = os.path.join(folder, f"catalogue_{rows}.csv")
+
+        generator.write_csv(self.csv, rows, seed=seed)
+        self.catalogue = generator.make_catalogue(rows, seed=seed)
+
+        # Fill the base database once, every benchmark starts from a copy of it.
+        self.use_db(self.base_db)
+        DBManager.setup_db()
+        DBManager.import_csv(self.csv, "products")
+        DBManager.close_pools()
+
+        self.reset()
+        self.products = DBManager.get_dbdata("products")
+        self.categories = DBManager.get_dbdata("categories")
+
+    @staticmethod
+    def use_db(path):
+        DBManager.updateconfig("backend", "sqlite")
+        DBManager.updateconfig("db", path)
+        DBManager.updateconfig("table", "products")
+
+    def reset(self):
+        """Put the working database back to the generated catalogue."""
+        DBManager.close_pools()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
+        shutil.copy(self.base_db, self.db)
+        self.use_db(self.db)
+
+    def changed_products(self, edit=0.0, delete=0.0, insert=0.0):
+        """Get the products with a share of the rows edited, deleted and added."""
+        rng = np.random.default_rng(self.seed)
+        df = self.products.copy()
+        n = len(df)
+
+        if edit:
+            rows = rng.choice(n, int(n * edit), replace=False)
+            df.loc[rows, "stock_available"] += 1
+        if delete:
+            df = df.drop(index=rng.choice(n, int(n * delete), replace=False))
+        if insert:
+            new = self.catalogue.sample(int(n * insert), random_state=self.seed)
+            new = new.assign(id_category=new["category"].map(
+                dict(zip(self.categories["title"], self.categories["id_category"]))))
+            df = pd.concat([df, new.drop(columns=["category"])], ignore_index=True)
+        return df
+
+
+def bench_get_dbdata(bench):
+    return None, lambda: DBManager.get_dbdata("products", cached=False)
+
+
+def bench_get_dbdata_cached(bench):
+    # The first call fills the cache, the timed calls are hits.
+    DBManager.get_dbdata("products")
+    return None, lambda: DBManager.get_dbdata("products")
+
+
+def bench_add_df_to_db(edit=0.0, delete=0.0, insert=0.0):
+    def setup(bench):
+        df = bench.changed_products(edit=edit, delete=delete, insert=insert)
+        version = DBManager.table_version("products")
+        return None, lambda: DBManager.add_df_to_db(df, "products", read_version=version)
+    return setup
+
+
+def bench_import_csv(bench):
+    # Import into an empty products table, the categories are already known.
+    with DBManager.open_connection() as con:
+        DBManager.get_backend().cursor(con).execute("DELETE FROM `products`")
+        con.commit()
+    return None, lambda: DBManager.import_csv(bench.csv, "products")
+
+
+def bench_resolve_labels(bench):
+    df = bench.catalogue.copy()
+    return None, lambda: DBManager.resolve_labels(df.copy(), "products")
+
+
+def bench_category_stats_sql(bench):
+    return None, lambda: DBManager.query_category_stats(cached=False)
+
+
+def bench_category_stats_cached(bench):
+    # The first call fills the cache, the timed calls are hits, ie switching to the stats tab.
+    DBManager.query_category_stats()
+    return None, DBManager.query_category_stats
+
+
+def bench_rebuild_aggregates(bench):
+    return None, DBManager.rebuild_aggregates
+
+
+def bench_sync_aggregates(bench):
+    # A stock change to a share of the rows, and the sync that picks it up through the change feed.
+    DBManager.rebuild_aggregates()
+    keys = bench.products["id_product"].iloc[::round(1 / CHANGE_SHARE)].tolist()
+
+    def run():
+        with DBManager.open_connection() as con:
+            DBManager.add_stock(DBManager.cursor(con), "products", dict.fromkeys(keys, 1))
+            con.commit()
+        DBManager.sync_aggregates()
+    return None, run
+
+
+# Name -> setup(bench), which returns (reason the benchmark was skipped, callable to time).
+BENCHMARKS = {
+    "get_dbdata": bench_get_dbdata,
+    "get_dbdata_cached": bench_get_dbdata_cached,
+    "add_df_to_db_insert": bench_add_df_to_db(insert=CHANGE_SHARE),
+    "add_df_to_db_edit": bench_add_df_to_db(edit=CHANGE_SHARE),
+    "add_df_to_db_delete": bench_add_df_to_db(delete=CHANGE_SHARE),
+    "add_df_to_db_mix": bench_add_df_to_db(edit=CHANGE_SHARE, delete=CHANGE_SHARE, insert=CHANGE_SHARE),
+    "import_csv": bench_import_csv,
+    "resolve_labels": bench_resolve_labels,
+    "category_stats_sql": bench_category_stats_sql,
+    "category_stats_cached": bench_category_stats_cached,
+    "rebuild_aggregates": bench_rebuild_aggregates,
+    "sync_aggregates": bench_sync_aggregates
+}
+
+
+def measure(bench, setup, repeat):
+    """Time setup's callable repeat times, then get its peak memory in one more run."""
+    times = []
+    for _ in range(repeat):
+        bench.reset()
+        skipped, fn = setup(bench)
+        if skipped:
+            return {"skipped": skipped}
+
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    bench.reset()
+    _, fn = setup(bench)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "max_s": max(times),
+        "times_s": times,
+        "peak_mb": peak / 2 ** 20
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return {
+        "commit": commit,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "backend": "sqlite"
+    }
+
+
+def run(rows=(1000, 100000), repeat=5, only=None, seed=0):
+    names = only or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {', '.join(unknown)}.")
+
+    out = {"environment": environment(), "repeat": repeat, "seed": seed, "results": {}}
+    with tempfile.TemporaryDirectory() as folder:
+        for n in rows:
+            bench = Bench(n, folder, seed=seed)
+            results = out["results"][str(n)] = {}
+            for name in names:
+                results[name] = measure(bench, BENCHMARKS[name], repeat)
+                print_result(n, name, results[name])
+            DBManager.close_pools()
+
+    return out
+
+
+def print_result(rows, name, result):
+    if "skipped" in result:
+        print(f"{rows:>10} {name:<22} skipped, {result['skipped']}")
+    else:
+        print(f"{rows:>10} {name:<22} {result['median_s'] * 1000:10.2f} ms "
+              f"(min {result['min_s'] * 1000:.2f}) {result['peak_mb']:9.2f} MB peak")
+
+
+def compare(old_path, new_path, threshold=1.1):
+    """Print the change in median time and peak memory of every benchmark in two result files.
+    Returns the (rows, name) of the benchmarks that got slower by more than threshold times."""
+    with open(old_path, encoding="utf-8") as old_file, open(new_path, encoding="utf-8") as new_file:
+        old, new = json.load(old_file)["results"], json.load(new_file)["results"]
+
+    regressions = []
+    for rows, results in new.items():
+        for name, result in results.items():
+            before = old.get(rows, {}).get(name)
+            if before is None or "skipped" in before or "skipped" in result:
+                continue
+
+            ratio = result["median_s"] / before["median_s"]
+            flag = "  SLOWER" if ratio > threshold else ""
+            print(f"{rows:>10} {name:<22} {before['median_s'] * 1000:10.2f} -> {result['median_s'] * 1000:10.2f} ms "
+                  f"({ratio:5.2f}x), {before['peak_mb']:8.2f} -> {result['peak_mb']:8.2f} MB{flag}")
+            if ratio > threshold:
+                regressions.append((rows, name))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000],
+                        help="catalogue sizes to run the benchmarks on")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS),
+                        help="only run these benchmarks")
+    parser.add_argument("--out", help="result file, by default a new file in benchmarks/results/")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running the benchmarks")
+    parser.add_argument("--threshold", type=float, default=1.1,
+                        help="slowdown ratio reported as a regression by --compare")
+    args = parser.parse_args(args)
+
+    if args.compare:
+        return compare(*args.compare, threshold=args.threshold)
+
+    out = run(args.rows, repeat=args.repeat, only=args.only, seed=args.seed)
+    path = args.out
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{stamp}-{out['environment']['commit'] or 'local'}.json")
+    with open(path, "w", encoding="utf-8") as out_file:
+        json.dump(out, out_file, indent=2)
+    print(f"Results written to {path}")
+    return out
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Command line entry point for running DataVault jobs without a display, eg nightly supplier imports.
+
+python datavault.py [connection options] import FILE [FILE ...]
+python datavault.py [connection options] export PATH [--columns A,B] [--filter "COLUMN OP [VALUE]"] [--search TEXT]
+python datavault.py [connection options] sync
+python datavault.py [connection options] stats [--search TEXT] [--format json|csv]
+
+Nothing here imports tkinter, matplotlib or pandastable, and `dbmanager` (with pandas) is
+only imported once a command runs, so `--help` and argument errors return straight away.
+The result of a command is printed to stdout as JSON, messages are logged to stderr, as
+JSON lines with `--log-format json`, and failures are reported through the exit code:
+
+0 success, 1 the job failed, 2 bad arguments, 3 the database couldn't be reached,
+4 an input file couldn't be read or was invalid."""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CONNECTION = 3
+EXIT_INPUT = 4
+
+log = logging.getLogger("datavault")
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as one JSON object per line, for log collectors."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)),
+            "level": record.levelname.lower(),
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["error"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(log_format="text", verbose=False):
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log.handlers[:] = [handler]
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    log.propagate = False
+
+
+def configure_db(args):
+    """Point DBManager at the database given on the command line, or in the `DATAVAULT_*`
+    environment variables, and bring its schema up to date."""
+    from dbmanager import DBManager
+
+    settings = {
+        "backend": args.backend or os.environ.get("DATAVAULT_BACKEND"),
+        "host": args.host or os.environ.get("DATAVAULT_HOST"),
+        "user": args.user or os.environ.get("DATAVAULT_USER"),
+        # Passwords are only taken from the environment, so they don't show up in process lists.
+        "passwd": os.environ.get("DATAVAULT_PASSWORD"),
+        "db": args.db or os.environ.get("DATAVAULT_DB"),
+        "table": args.table
+    }
+    for key, value in settings.items():
+        if value is not None:
+            DBManager.updateconfig(key, value)
+
+    DBManager.set_notifier(None)
+    for sql in DBManager.setup_db():
+        log.info("Migrated the schema: %s", " ".join(sql.split()))
+    return DBManager
+
+
+def result(data):
+    print(json.dumps(data, default=str))
+
+
+def cmd_import(args):
+    DBManager = configure_db(args)
+    if not args.load_data:
+        # The files are parsed in parallel, deduplicated and written together.
+        report = DBManager.import_csv_files(args.files, args.table, workers=args.workers,
+                                            dedup=not args.keep_duplicates)
+        for failed in report["failed"]:
+            log.error("Import of %s failed: %s", failed["file"], failed["error"], extra={"fields": failed})
+        log.info("Imported %s rows from %s files (%s rejected, %s duplicates, %.0f rows/s)", report["rows"],
+                 len(report["files"]), report["rejected"], report["duplicates"], report["rows_per_sec"],
+                 extra={"fields": {key: value for key, value in report.items() if key not in ("files", "failed")}})
+        result(report)
+        return EXIT_INPUT if report["failed"] else EXIT_OK
+
+    totals = {"files": 0, "rows": 0, "rejected": 0, "failed": []}
+    for path in args.files:
+        try:
+            report = DBManager.import_csv(path, args.table, chunksize=args.chunk_size, load_data=True)
+        except ConnectionError:
+            raise
+        except (OSError, ValueError) as err:
+            # One bad file doesn't stop the others.
+            log.error("Import of %s failed: %s", path, err, extra={"fields": {"file": path}})
+            totals["failed"].append({"file": path, "error": str(err)})
+            continue
+
+        log.info("Imported %s rows from %s (%s rejected, %.0f rows/s)", report["rows"], path,
+                 report["rejected"], report["rows_per_sec"], extra={"fields": {"file": path, **report}})
+        totals["files"] += 1
+        totals["rows"] += report["rows"]
+        totals["rejected"] += report["rejected"]
+
+    result(totals)
+    return EXIT_INPUT if totals["failed"] else EXIT_OK
+
+
+def cmd_export(args):
+    DBManager = configure_db(args)
+    report = DBManager.export_table(args.path, args.table, columns=args.columns, filters=args.filter,
+                                    search=args.search, format=args.format, compression=args.compression)
+    log.info("Exported %s rows of %s to %s (%.0f rows/s)", report["rows"], args.table, args.path,
+             report["rows_per_sec"], extra={"fields": report})
+    result(report)
+    return EXIT_OK
+
+
+def cmd_sync(args):
+    """Bring the local snapshot of the table up to date, reading only the rows changed since it was taken."""
+    DBManager = configure_db(args)
+    table = DBManager.get_crud_table(args.table)
+
+    start = time.perf_counter()
+    snapshot = DBManager.load_snapshot(table)
+    if snapshot is None or args.full:
+        df = DBManager.get_dbdata(table, cached=False)
+        DBManager.save_snapshot(table, df)
+        report = {"table": table, "rows": len(df), "new_rows": len(df), "full": True}
+    else:
+        before = len(snapshot[0])
+        df = DBManager.refresh_snapshot(table, *snapshot)
+        report = {"table": table, "rows": len(df), "new_rows": len(df) - before, "full": False}
+
+    report["seconds"] = time.perf_counter() - start
+    log.info("Synced %s: %s rows, %s new", table, report["rows"], report["new_rows"], extra={"fields": report})
+    result(report)
+    return EXIT_OK
+
+
+def cmd_stats(args):
+    DBManager = configure_db(args)
+    stats = DBManager.query_category_stats(filters=args.filter, search=args.search,
+                                           table=DBManager.get_crud_table(args.table))
+    if args.format == "csv":
+        stats.to_csv(sys.stdout)
+    else:
+        result(stats.reset_index().to_dict("records"))
+    return EXIT_OK
+
+
+def filter_arg(text):
+    """Parse a `--filter` of "column op [value]", eg "stock_available < 5" or "brand is null"."""
+    parts = text.split(None, 1)
+    if len(parts) < 2:
+        raise argparse.ArgumentTypeError(f"`{text}` isn't a filter of the form \"column op [value]\".")
+
+    column, rest = parts
+    for op in ("is not null", "is null"):
+        if rest.lower() == op:
+            return (column, op)
+
+    op, _, value = rest.partition(" ")
+    if op.lower() == "not":
+        op, _, value = value.partition(" ")
+        op = "not " + op
+    if op.lower() in ("in", "not in"):
+        return (column, op, [parse_value(item.strip()) for item in value.split(",")])
+    return (column, op, parse_value(value.strip()))
+
+
+def parse_value(text):
+    """Numbers are compared as numbers, anything else as text."""
+    try:
+        return float(text) if "." in text else int(text)
+    except ValueError:
+        return text
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="datavault", description="Run DataVault jobs without the GUI.")
+    parser.add_argument("--backend", choices=("mysql", "sqlite"), help="database backend (DATAVAULT_BACKEND)")
+    parser.add_argument("--host", help="database server (DATAVAULT_HOST)")
+    parser.add_argument("--user", help="database user (DATAVAULT_USER), the password is read from DATAVAULT_PASSWORD")
+    parser.add_argument("--db", help="database, or the file of a SQLite database (DATAVAULT_DB)")
+    parser.add_argument("--table", default="products")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="import CSV files in the import-products.csv format")
+    import_parser.add_argument("files", nargs="+")
+    import_parser.add_argument("--workers", type=int, help="processes parsing the files, one per CPU by default")
+    import_parser.add_argument("--keep-duplicates", action="store_true",
+                               help="don't deduplicate the rows on category, name and brand")
+    import_parser.add_argument("--load-data", action="store_true",
+                               help="load each file on its own with LOAD DATA LOCAL INFILE (MySQL)")
+    import_parser.add_argument("--chunk-size", type=int, help="rows per LOAD DATA chunk")
+    import_parser.set_defaults(run=cmd_import)
+
+    export_parser = commands.add_parser("export", help="export the table to a CSV, Parquet or XLSX file")
+    export_parser.add_argument("path", help="the file to write, its extension gives the format, eg stock.csv.gz")
+    export_parser.add_argument("--columns", type=lambda text: [col.strip() for col in text.split(",")],
+                               help="comma separated columns to export, all by default")
+    export_parser.add_argument("--format", choices=("csv", "parquet", "xlsx"))
+    export_parser.add_argument("--compression", help="gzip, bz2 or xz for CSV, snappy, gzip, zstd, ... for Parquet")
+    export_parser.set_defaults(run=cmd_export)
+
+    sync_parser = commands.add_parser("sync", help="bring the local snapshot of the table up to date")
+    sync_parser.add_argument("--full", action="store_true", help="read the whole table again")
+    sync_parser.set_defaults(run=cmd_sync)
+
+    stats_parser = commands.add_parser("stats", help="print the statistics of each category")
+    stats_parser.add_argument("--format", choices=("json", "csv"), default="json")
+    stats_parser.set_defaults(run=cmd_stats)
+
+    for sub in (export_parser, stats_parser):
+        sub.add_argument("--filter", type=filter_arg, action="append",
+                         help="only rows matching \"column op [value]\", eg \"stock_available < 5\"")
+        sub.add_argument("--search", help="only rows whose name, brand or barcode starts with this")
+    return parser
+
+
+def main(argv=None):
+    try:
+        args = build_parser().parse_args(argv)
+    except SystemExit as exit:
+        return exit.code
+
+    configure_logging(args.log_format, args.verbose)
+    try:
+        return args.run(args)
+    except ConnectionError as err:
+        log.error("%s", err)
+        return EXIT_CONNECTION
+    except (OSError, ValueError) as err:
+        log.error("%s", err)
+        return EXIT_INPUT
+    except Exception as err:
+        log.error("The %s job failed: %s", args.command, err, exc_info=args.verbose)
+        return EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
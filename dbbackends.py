@@ -0,0 +1,308 @@
+import os
+import sqlite3
+
+from migrations import foreign_key
+
+
+class Backend(object):
+    """The parts of talking to a database engine that differ between engines.
+
+    `DBManager` builds its SQL with `param` as the placeholder and backticks around
+    names, which every backend accepts, and leaves connecting, DDL, cursors, upserts and
+    auto increment ids to the backend. Subclasses fill in the engine specific parts."""
+    name = ""
+    # Placeholder for a parameter in a statement.
+    param = "%s"
+    # The most parameters a single statement may have, multi-row INSERTs are split to fit.
+    max_params = 65535
+    # Whether the backend can bulk load files, see `DBManager.load_data_infile`.
+    supports_load_data = False
+
+    def connect(self, settings, ignore_db=False):
+        """Open a new raw connection, settings is a dict of the connection config of `DBManager`."""
+        raise NotImplementedError
+
+    def connect_errors(self):
+        """Get the exception types raised when the database can't be reached."""
+        raise NotImplementedError
+
+    def is_connected(self, con):
+        raise NotImplementedError
+
+    def cursor(self, con):
+        """Get a cursor that reads the whole result as soon as a statement is executed."""
+        return con.cursor()
+
+    def stream_cursor(self, con):
+        """Get a cursor that fetches rows as they are asked for, see `DBManager.iter_dbdata`."""
+        return con.cursor()
+
+    def column_sql(self, col):
+        """Get the definition of a `DBColumn` for a CREATE TABLE statement."""
+        return str(col)
+
+    def create_table_sql(self, table):
+        """Get the CREATE TABLE statement for a table dict of `DBManager._tables`."""
+        return f"""CREATE TABLE IF NOT EXISTS `{table["table"]}` (
+                    {",".join(self.column_sql(field) for field in table["fields"])},
+                    PRIMARY KEY (`{table["primary"]}`)
+                )"""
+
+    def schema_errors(self):
+        """Get the exception types raised when a statement refers to a table that doesn't exist."""
+        raise NotImplementedError
+
+    def describe_schema(self, cursor, tables):
+        """Read the live schema of the tables named in tables from the catalog of the database,
+        as a dict of table name -> {"columns": set of names, "indexes": set of names,
+        "foreign": dict of (column, referenced table, referenced column) -> constraint names}.
+        Tables that don't exist are left out. See `migrations.Migrator`."""
+        raise NotImplementedError
+
+    def created_schema(self, table):
+        """Get the schema `create_table_sql()` gives table, in the form of `describe_schema()`."""
+        return {"columns": {col.name for col in table["fields"]}, "indexes": set(), "foreign": {}}
+
+    def alter_table_sql(self, table, changes):
+        """Get the statements making changes to an existing table, in one ALTER TABLE. changes
+        is a list of ("column", `DBColumn`), ("index", `DBIndex`), ("foreign", (column,
+        referenced table, referenced column)) and ("drop_foreign", constraint name)."""
+        clauses = []
+        for kind, item in changes:
+            if kind == "column":
+                clauses.append(f"ADD COLUMN {self.column_sql(item)}")
+            elif kind == "index":
+                clauses.append(f"ADD {'UNIQUE ' if item.unique else ''}INDEX `{item.name}` (" +
+                               ",".join(f"`{col}`" for col in item.columns) + ")")
+            elif kind == "foreign":
+                clauses.append(f"ADD FOREIGN KEY (`{item[0]}`) REFERENCES `{item[1]}` (`{item[2]}`)")
+            elif kind == "drop_foreign":
+                clauses.append(f"DROP FOREIGN KEY `{item}`")
+
+        if not clauses:
+            return []
+        return [f"ALTER TABLE `{table['table']}` " + ", ".join(clauses)]
+
+    def create_index_sql(self, table, index):
+        """Get the CREATE INDEX statement for a `DBIndex` of table."""
+        return (f"CREATE {'UNIQUE ' if index.unique else ''}INDEX `{index.name}` ON `{table}` (" +
+                ",".join(f"`{col}`" for col in index.columns) + ")")
+
+    def prefix_sql(self, column, prefix):
+        """Get a condition matching the values of column that start with prefix, ignoring
+        case, written so an index on column can be used, as (sql, params)."""
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"`{column}` LIKE {self.param}", (escaped + "%",)
+
+    def upsert_sql(self, table, cols, pk):
+        """Get a statement inserting one row of cols, or updating it if its primary key pk exists."""
+        raise NotImplementedError
+
+    def first_insert_id(self, cursor, rows):
+        """Get the auto increment id given to the first row of the multi-row INSERT that cursor just ran."""
+        # InnoDB hands a multi-row insert consecutive ids and reports the first one.
+        return cursor.lastrowid
+
+
+class MySQLBackend(Backend):
+    """MySQL through `mysql.connector`, which is only imported once it is used."""
+    name = "mysql"
+    supports_load_data = True
+
+    def connect(self, settings, ignore_db=False):
+        import mysql.connector
+
+        connect_args = {
+            "host": settings["host"],
+            "user": settings["user"],
+            "passwd": settings["passwd"] or ""
+        }
+        if settings["db"] and not ignore_db:
+            connect_args["database"] = settings["db"]
+        if settings["local_infile"]:
+            connect_args["allow_local_infile"] = True
+
+        return mysql.connector.connect(**connect_args)
+
+    def connect_errors(self):
+        import mysql.connector.errors
+        return (mysql.connector.errors.InterfaceError,)
+
+    def is_connected(self, con):
+        return con.is_connected()
+
+    def cursor(self, con):
+        return con.cursor(buffered=True)
+
+    def stream_cursor(self, con):
+        return con.cursor(buffered=False)
+
+    def schema_errors(self):
+        import mysql.connector.errors
+        return (mysql.connector.errors.ProgrammingError,)
+
+    def describe_schema(self, cursor, tables):
+        names = ",".join([self.param] * len(tables))
+        schema = {}
+
+        cursor.execute(f"""SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS
+                           WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({names})""", tuple(tables))
+        for table, column in cursor.fetchall():
+            schema.setdefault(table, {"columns": set(), "indexes": set(), "foreign": {}})["columns"].add(column)
+
+        cursor.execute(f"""SELECT DISTINCT TABLE_NAME, INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS
+                           WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({names})""", tuple(tables))
+        for table, index in cursor.fetchall():
+            schema[table]["indexes"].add(index)
+
+        cursor.execute(f"""SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+                           FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+                           WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL
+                           AND TABLE_NAME IN ({names}) ORDER BY CONSTRAINT_NAME""", tuple(tables))
+        for table, constraint, column, ref_table, ref_column in cursor.fetchall():
+            schema[table]["foreign"].setdefault((column, ref_table, ref_column), []).append(constraint)
+        return schema
+
+    def upsert_sql(self, table, cols, pk):
+        return (f"INSERT INTO `{table}` (`" + "`,`".join(cols) + "`) VALUES (" +
+                ",".join([self.param] * len(cols)) + ") ON DUPLICATE KEY UPDATE " +
+                ",".join(f"`{col}`=VALUES(`{col}`)" for col in cols if col != pk))
+
+
+class SQLiteBackend(Backend):
+    """An embedded SQLite database, the `db` config is the path of the database file.
+
+    Connections use WAL journaling, so reads don't block behind a write, and keep a
+    cache of prepared statements, so repeated statements such as batched INSERTs are
+    only compiled once per connection."""
+    name = "sqlite"
+    param = "?"
+    # SQLite before 3.32 only allows 999 parameters per statement.
+    max_params = 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999
+
+    # Size of the prepared statement cache of each connection.
+    cached_statements = 256
+
+    def connect(self, settings, ignore_db=False):
+        path = os.path.expanduser(settings["db"] or ":memory:")
+        # Pooled connections are handed between threads, but only used by one at a time.
+        con = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                              cached_statements=SQLiteBackend.cached_statements)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA foreign_keys=ON")
+        return con
+
+    def connect_errors(self):
+        return (sqlite3.OperationalError,)
+
+    def is_connected(self, con):
+        try:
+            con.execute("SELECT 1")
+        except sqlite3.ProgrammingError:
+            return False
+        return True
+
+    def column_sql(self, col):
+        if col.auto_increment:
+            # Only an INTEGER PRIMARY KEY column is given ids automatically.
+            return f"`{col.name}` INTEGER PRIMARY KEY"
+        return str(col)
+
+    def create_table_sql(self, table):
+        fields = [self.column_sql(field) for field in table["fields"]]
+        if not any(field.auto_increment for field in table["fields"]):
+            fields.append(f"PRIMARY KEY (`{table['primary']}`)")
+        # SQLite can't add a foreign key to an existing table.
+        if "foreign" in table:
+            fields.append(
+                f"FOREIGN KEY (`{table['foreign'][0]}`) REFERENCES {table['foreign'][1]}")
+
+        return f"""CREATE TABLE IF NOT EXISTS `{table["table"]}` (
+                    {",".join(fields)}
+                )"""
+
+    def schema_errors(self):
+        return (sqlite3.OperationalError,)
+
+    def describe_schema(self, cursor, tables):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        existing = {row[0] for row in cursor.fetchall()}
+        schema = {}
+
+        for table in tables:
+            if table not in existing:
+                continue
+
+            cursor.execute(f"PRAGMA table_info(`{table}`)")
+            columns = {row[1] for row in cursor.fetchall()}
+            foreign = {}
+            cursor.execute(f"PRAGMA foreign_key_list(`{table}`)")
+            for row in cursor.fetchall():
+                # SQLite constraints have no names, only their position in the table.
+                foreign.setdefault((row[3], row[2], row[4]), []).append(str(row[0]))
+            schema[table] = {"columns": columns, "indexes": self.index_names(cursor, table), "foreign": foreign}
+        return schema
+
+    def created_schema(self, table):
+        schema = Backend.created_schema(self, table)
+        if "foreign" in table:
+            # The foreign key is part of the CREATE TABLE, see `create_table_sql()`.
+            schema["foreign"][foreign_key(table)] = ["0"]
+        return schema
+
+    def alter_table_sql(self, table, changes):
+        # SQLite alters one thing per statement, and can't add or drop foreign keys of an existing table.
+        statements = []
+        for kind, item in changes:
+            if kind == "column":
+                statements.append(f"ALTER TABLE `{table['table']}` ADD COLUMN {self.column_sql(item)}")
+            elif kind == "index":
+                statements.append(self.create_index_sql(table["table"], item))
+        return statements
+
+    def create_index_sql(self, table, index):
+        collate = " COLLATE NOCASE" if index.nocase else ""
+        return (f"CREATE {'UNIQUE ' if index.unique else ''}INDEX `{index.name}` ON `{table}` (" +
+                ",".join(f"`{col}`{collate}" for col in index.columns) + ")")
+
+    def index_names(self, cursor, table):
+        cursor.execute(f"PRAGMA index_list(`{table}`)")
+        return {row[1] for row in cursor.fetchall()}
+
+    def prefix_sql(self, column, prefix):
+        # A range rather than LIKE, which SQLite won't serve from an index with an ESCAPE clause.
+        # NOCASE folds ASCII letters to lower case, so the bounds are folded the same way
+        # (eg "Z" would otherwise end the range at "[", before "z"), see `DBIndex.nocase`.
+        if not prefix:
+            return f"`{column}` IS NOT NULL", ()
+        prefix = "".join(char.lower() if "A" <= char <= "Z" else char for char in prefix)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return (f"(`{column}` COLLATE NOCASE >= {self.param} AND `{column}` COLLATE NOCASE < {self.param})",
+                (prefix, upper))
+
+    def upsert_sql(self, table, cols, pk):
+        return (f"INSERT INTO `{table}` (`" + "`,`".join(cols) + "`) VALUES (" +
+                ",".join([self.param] * len(cols)) + f") ON CONFLICT(`{pk}`) DO UPDATE SET " +
+                ",".join(f"`{col}`=excluded.`{col}`" for col in cols if col != pk))
+
+    def first_insert_id(self, cursor, rows):
+        # SQLite reports the id of the last row inserted, the rows before it have the ids before.
+        if not cursor.lastrowid:
+            return None
+        return cursor.lastrowid - rows + 1
+
+
+# The backends that can be chosen with the `backend` config of `DBManager`.
+backends = {
+    "mysql": MySQLBackend,
+    "sqlite": SQLiteBackend
+}
+
+
+def get_backend(name):
+    """Create the backend called name, see `backends`."""
+    if name not in backends:
+        raise ValueError(
+            f"Unknown database backend `{name}`, expected one of {', '.join(backends)}.")
+    return backends[name]()
@@ -1,21 +1,52 @@
-import mysql.connector
-import mysql.connector.errors
+import batchimport
+import dbbackends
+import exporters
+import hashlib
+import json
+import logging
 import numpy as np
+import os
 import pandas as pd
-import tkinter.messagebox as tkMessageBox
-import tkinter.simpledialog as tkSimpleDialog
+import tempfile
+import threading
+import time
+
+from collections import deque
+from instrumentation import InstrumentedCursor, QueryStats
+from migrations import Migrator, foreign_key
+from querycache import QueryCache
+from snapshot import SnapshotStore
 
 
 class DBColumn(object):
-    def __init__(self, name, dtype="VARCHAR(45)", allow_nulls=True, auto_increment=False, default=None):
+    # Base SQL types that are stored as numbers.
+    _numeric_types = ("INT", "INTEGER", "TINYINT", "SMALLINT", "MEDIUMINT", "BIGINT",
+                      "DECIMAL", "NUMERIC", "FLOAT", "DOUBLE", "REAL")
+
+    # The smallest NumPy integer type that holds every value of the SQL integer types.
+    _int_dtypes = {
+        "TINYINT": "int8",
+        "SMALLINT": "int16",
+        "MEDIUMINT": "int32",
+        "INT": "int32",
+        "INTEGER": "int32",
+        "BIGINT": "int64"
+    }
+
+    _datetime_types = ("DATE", "DATETIME", "TIMESTAMP")
+
+    def __init__(self, name, dtype="VARCHAR(45)", allow_nulls=True, auto_increment=False, default=None,
+                 categorical=False):
         self.name = name
         self.type = dtype
         self.allow_nulls = allow_nulls
         self.auto_increment = auto_increment
         self.default = default
+        # Store the column as a pandas categorical, for low cardinality text such as brands.
+        self.categorical = categorical
 
     def __repr__(self):
-        self.__str__()
+        return self.__str__()
 
     def __str__(self):
         out = ""
@@ -37,21 +68,703 @@ class DBColumn(object):
     def get_name(self):
         return self.name
 
+    def get_base_type(self):
+        """Get the SQL type without its arguments, eg `DECIMAL` for `DECIMAL(13,2)`."""
+        return self.type.split("(")[0].strip().upper()
+
+    def get_scale(self):
+        """Get the number of decimal places of a DECIMAL/NUMERIC column, otherwise None."""
+        if self.get_base_type() not in ("DECIMAL", "NUMERIC") or "," not in self.type:
+            return None
+        return int(self.type.split(",")[1].rstrip(") "))
+
+    def is_numeric(self):
+        return self.get_base_type() in DBColumn._numeric_types
+
+    def get_dtype(self, decimal_mode="float"):
+        """Get the compact pandas dtype used to hold this column in a DataFrame.
+
+        Integers use the smallest fitting NumPy type (nullable `Int32` etc. if the column
+        allows nulls), DECIMAL is float64, or int64 fixed point when decimal_mode is
+        "cents", and text is object unless the column is `categorical`."""
+        base = self.get_base_type()
+
+        if base in DBColumn._int_dtypes:
+            dtype = DBColumn._int_dtypes[base]
+            return dtype.capitalize() if self.allow_nulls else dtype
+        if base in ("DECIMAL", "NUMERIC") and decimal_mode == "cents" and self.get_scale() is not None:
+            return "Int64" if self.allow_nulls else "int64"
+        if self.is_numeric():
+            return "float64"
+        if base in DBColumn._datetime_types:
+            return "datetime64[ns]"
+        if self.categorical:
+            return "category"
+        return "object"
+
+
+class DBIndex(object):
+    """A secondary index of a table, added by `DBManager.setup_db`. A query can use the
+    index when it filters or sorts on a leading run of its columns, eg an index on
+    (id_category, selling_price) serves a filter on id_category sorted by selling_price.
+    A nocase index compares text case insensitively, as the default collation of MySQL
+    does, so the case insensitive prefix searches of SQLite can use it too."""
+
+    def __init__(self, name, columns, unique=False, nocase=False):
+        self.name = name
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.nocase = nocase
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return (f"{'UNIQUE ' if self.unique else ''}INDEX `{self.name}` ({','.join(self.columns)})"
+                f"{' NOCASE' if self.nocase else ''}")
+
+
+class ChangeSet(object):
+    """The rows to insert, update and delete to bring a table in line with some data.
+
+    insert DataFrame Rows to insert,
+    update DataFrame The primary key and new values of rows to update,
+    changed DataFrame Booleans marking which columns of `update` changed (all columns but the key),
+    delete list The primary keys of the rows to delete,
+    versions dict The row version each updated or deleted row was read at, by primary key
+        (optional), the save fails rather than overwrite rows changed since, see `apply_changes`."""
+
+    def __init__(self, insert=None, update=None, changed=None, delete=None, versions=None):
+        self.insert = insert if insert is not None else pd.DataFrame()
+        self.update = update if update is not None else pd.DataFrame()
+        self.changed = changed if changed is not None else pd.DataFrame()
+        self.delete = list(delete) if delete is not None else []
+        self.versions = dict(versions) if versions is not None else {}
+
+    def __len__(self):
+        return len(self.insert) + len(self.update) + len(self.delete)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    @staticmethod
+    def merge(changesets):
+        """Combine changesets of different rows (eg of different pages of a table) into one."""
+        changesets = [changes for changes in changesets if not changes.empty]
+        if not changesets:
+            return ChangeSet()
+
+        def concat(frames):
+            frames = [frame for frame in frames if len(frame) > 0]
+            return pd.concat(frames, ignore_index=True) if frames else None
+
+        changed = concat([changes.changed for changes in changesets])
+        return ChangeSet(insert=concat([changes.insert for changes in changesets]),
+                         update=concat([changes.update for changes in changesets]),
+                         changed=changed.fillna(False).astype(bool) if changed is not None else None,
+                         delete=[key for changes in changesets for key in changes.delete],
+                         versions={key: version for changes in changesets
+                                   for key, version in changes.versions.items()})
+
+
+class ConflictError(RuntimeError):
+    """Raised by `DBManager.apply_changes` when rows being saved were changed or deleted by
+    someone else since they were read, rather than overwriting their changes.
+
+    keys list The primary keys of the conflicting rows."""
+
+    def __init__(self, table, keys):
+        self.table = table
+        self.keys = list(keys)
+        shown = ", ".join(str(key) for key in self.keys[:10]) + (", ..." if len(self.keys) > 10 else "")
+        RuntimeError.__init__(
+            self, f"{len(self.keys)} rows of `{table}` were changed or deleted by someone else since "
+            f"they were loaded, nothing was saved. Rows: {shown}")
+
+
+class PooledConnection(object):
+    """Proxy around a connection leased from a `ConnectionPool`.
+
+    Leaving the `with` block (or calling `close()`) hands the connection back to the
+    pool instead of closing it. Proxies handed out for nested calls on the same
+    thread don't own the lease, so closing them leaves the outer caller's connection alone."""
+
+    def __init__(self, pool, con, owner=True):
+        self._pool = pool
+        self._con = con
+        self._owner = owner
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def wrote(self, table):
+        """Note that a statement on the connection changed table, see `ConnectionPool.on_write`."""
+        self._pool.wrote(self._con, table)
+
+    def commit(self):
+        self._con.commit()
+        self._pool.committed(self._con)
+
+    def rollback(self):
+        self._con.rollback()
+        self._pool.rolled_back(self._con)
+
+    def close(self):
+        if self._con is None:
+            return
+        if self._owner:
+            self._pool.release(self._con)
+        self._con = None
+
+
+class ConnectionPool(object):
+    """A size bounded pool of database connections.
+
+    connect callable Creates a new raw connection,
+    size int The maximum number of connections open at once (leased + idle),
+    timeout float Seconds to wait for a free connection before giving up,
+    idle_timeout float Seconds an idle connection may sit in the pool before it is closed,
+    check_interval float Connections idle for longer than this are health checked before reuse,
+    check callable Returns True if a raw connection is still usable,
+    on_write callable Called with the set of tables a connection wrote, as soon as they are
+    written and again once the transaction is committed or rolled back, eg to invalidate cached reads."""
+
+    def __init__(self, connect, size=5, timeout=10, idle_timeout=300, check_interval=30, check=None,
+                 on_write=None):
+        self._connect = connect
+        self._check = check
+        self.on_write = on_write
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+
+        # Idle connections as (connection, released_at), oldest on the left.
+        self._idle = deque()
+        self._leased = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        # Raw connection -> the tables written in its open transaction.
+        self._written = {}
+
+        self._stats = {
+            "created": 0,
+            "reused": 0,
+            "nested": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "evicted_idle": 0,
+            "evicted_broken": 0
+        }
+
+    def acquire(self, exclusive=False):
+        """Lease a connection wrapped in a `PooledConnection`.
+
+        When the calling thread already holds a lease, that connection is shared,
+        unless `exclusive` is set (e.g. for unbuffered reads that tie up the connection)."""
+        if not exclusive:
+            current = getattr(self._local, "con", None)
+            if current is not None:
+                with self._cond:
+                    self._stats["nested"] += 1
+                return PooledConnection(self, current, owner=False)
+
+        con = self._checkout()
+        if not exclusive:
+            self._local.con = con
+        return PooledConnection(self, con)
+
+    def wrote(self, con, table):
+        """Note that a statement on the leased connection con changed table."""
+        self._written.setdefault(con, set()).add(table)
+        if self.on_write is not None:
+            self.on_write({table})
+
+    def committed(self, con):
+        """Note that the transaction of the leased connection con was committed."""
+        tables = self._written.pop(con, None)
+        if tables and self.on_write is not None:
+            self.on_write(tables)
+
+    def rolled_back(self, con):
+        """Note that the transaction of the leased connection con was rolled back. Reads made
+        on con since it wrote saw the writes that are now undone, so the tables are reported
+        to `on_write` again."""
+        tables = self._written.pop(con, None)
+        if tables and self.on_write is not None:
+            self.on_write(tables)
+
+    def release(self, con):
+        """Return a leased connection to the pool."""
+        if getattr(self._local, "con", None) is con:
+            self._local.con = None
+        # Whatever wasn't committed is rolled back below.
+        self.rolled_back(con)
+
+        keep = not self._closed
+        if keep:
+            # End any open transaction so the next user doesn't see a stale snapshot.
+            try:
+                con.rollback()
+            except Exception:
+                keep = False
+
+        with self._cond:
+            self._leased -= 1
+            if keep and not self._closed and len(self._idle) < self.size:
+                self._idle.append((con, time.monotonic()))
+                con = None
+            elif not keep:
+                self._stats["evicted_broken"] += 1
+            self._cond.notify()
+
+        if con is not None:
+            self._close_quietly(con)
+
+    def close(self):
+        """Close every idle connection, leased connections are closed once released."""
+        with self._cond:
+            self._closed = True
+            idle = [con for con, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+
+        for con in idle:
+            self._close_quietly(con)
+
+    def stats(self):
+        """Get a snapshot of the pool's counters."""
+        with self._cond:
+            out = dict(self._stats)
+            out["size"] = self.size
+            out["in_use"] = self._leased
+            out["idle"] = len(self._idle)
+        return out
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            con = None
+            released = 0
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("The connection pool has been closed.")
+                self._evict_idle()
+
+                if self._idle:
+                    # Reuse the most recently used connection, it is the least likely to have gone stale.
+                    con, released = self._idle.pop()
+                    self._leased += 1
+                elif self._leased + len(self._idle) < self.size:
+                    self._leased += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise TimeoutError(
+                            f"No database connection became available within {self.timeout}s (pool size {self.size}).")
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                    continue
+
+            if con is None:
+                try:
+                    con = self._connect()
+                except BaseException:
+                    with self._cond:
+                        self._leased -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats["created"] += 1
+                return con
+
+            if self._is_healthy(con, released):
+                with self._cond:
+                    self._stats["reused"] += 1
+                return con
+
+            self._close_quietly(con)
+            with self._cond:
+                self._leased -= 1
+                self._stats["evicted_broken"] += 1
+
+    def _is_healthy(self, con, released):
+        if self._check is None or time.monotonic() - released < self.check_interval:
+            return True
+        try:
+            return bool(self._check(con))
+        except Exception:
+            return False
+
+    def _evict_idle(self):
+        """Close connections that have been idle for longer than `idle_timeout`, caller holds the lock."""
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            con, _ = self._idle.popleft()
+            self._stats["evicted_idle"] += 1
+            self._close_quietly(con)
+
+    @staticmethod
+    def _close_quietly(con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+
+class ChangeTracker(object):
+    """Keeps track of the edits made to the data of a table since it was loaded or saved,
+    so that only those rows have to be written back, see `changeset()`.
+
+    Cell edits are recorded by primary key through `record_edit()`. Rows without a key
+    are new rows and rows whose key has disappeared since `reset()` were deleted. For
+    tables with a row version column, the version each row was loaded at is kept, so the
+    save can check that nobody else changed the row in the meantime."""
+
+    def __init__(self, table, df=None):
+        self.table = table
+        self.pk = DBManager.get_table(table)["primary"]
+        self.row_version = DBManager.get_table(table).get("version")
+        self.columns = DBManager.get_table_cols(table)
+        self.reset(df)
+
+    def reset(self, df=None):
+        """Forget all changes and treat df as the data that is in the database."""
+        if df is not None and self.pk in df:
+            keyed = df[df[self.pk].notna()]
+            self._loaded_keys = pd.Index(keyed[self.pk].astype(np.int64))
+        else:
+            keyed = None
+            self._loaded_keys = pd.Index([], dtype=np.int64)
+
+        # primary key -> row version the row was loaded at.
+        self._row_versions = {}
+        if keyed is not None and self.row_version in keyed:
+            versions = keyed[self.row_version]
+            self._row_versions = {key: int(version) for key, version
+                                  in zip(self._loaded_keys, versions) if not pd.isna(version)}
+        self._edits = {}
+        self.version = 0
+
+    def record_edit(self, key, column, value):
+        """Record that column of the row with primary key `key` was set to value."""
+        self.version += 1
+        if pd.isna(key) or column not in self.columns or column in (self.pk, self.row_version):
+            return
+        self._edits.setdefault(int(key), {})[column] = value
+
+    def is_edited(self, key):
+        return int(key) in self._edits
+
+    def set_row_versions(self, versions):
+        """Record the version rows are at in the database now, as a dict of primary key ->
+        version, eg after they were saved or refreshed from the change feed. A version of
+        None saves the row without checking it, ie overwrites whatever is in the database."""
+        self._row_versions.update({int(key): version for key, version in versions.items()})
+
+    def forget(self, keys):
+        """Treat the rows of keys as never loaded, eg rows someone else deleted, so dropping
+        them from the data isn't saved as a delete."""
+        keys = pd.Index(keys, dtype=np.int64)
+        self._loaded_keys = self._loaded_keys[~self._loaded_keys.isin(keys)]
+        for key in keys:
+            self._edits.pop(key, None)
+            self._row_versions.pop(key, None)
+
+    def touch(self):
+        """Record that rows were added or removed."""
+        self.version += 1
+
+    def restore(self, changes):
+        """Put back the changes of a save that failed after `reset()` was called for it,
+        so they are sent again with the next save. Edits made since then take precedence."""
+        inserted = changes.insert[self.pk].dropna() if self.pk in changes.insert else []
+        self._loaded_keys = self._loaded_keys.append(
+            pd.Index(changes.delete, dtype=np.int64))
+        self._loaded_keys = self._loaded_keys[~self._loaded_keys.isin(
+            pd.Index(inserted).astype(np.int64))]
+
+        self._row_versions.update(changes.versions)
+
+        for idx in range(len(changes.update)):
+            key = int(changes.update.iloc[idx][self.pk])
+            edits = self._edits.setdefault(key, {})
+            for col in changes.changed.columns[changes.changed.iloc[idx].to_numpy()]:
+                edits.setdefault(col, changes.update.iloc[idx][col])
+
+        self.version += 1
+
+    @property
+    def dirty(self):
+        return self.version > 0
+
+    def changeset(self, df):
+        """Get the `ChangeSet` that brings the database in line with df."""
+        if self.pk not in df:
+            return ChangeSet(insert=df)
+
+        keys = pd.to_numeric(df[self.pk])
+        is_new = keys.isna().to_numpy()
+        is_new[~is_new] = ~keys[~is_new].astype(np.int64).isin(self._loaded_keys)
+        df_insert = df[is_new]
+
+        current = pd.Index(keys.dropna().astype(np.int64))
+        delete_keys = self._loaded_keys[~self._loaded_keys.isin(current)].tolist()
+
+        edits = {key: values for key, values in self._edits.items()
+                 if key in self._loaded_keys and key not in delete_keys}
+        versions = {key: self._row_versions[key] for key in list(edits) + delete_keys
+                    if self._row_versions.get(key) is not None}
+        if not edits:
+            return ChangeSet(insert=df_insert, delete=delete_keys, versions=versions)
+
+        update = pd.DataFrame.from_dict(edits, orient="index")
+        update = update[[col for col in self.columns if col in update]]
+        changed = pd.DataFrame({col: [col in values for values in edits.values()]
+                                for col in update.columns}, index=update.index)
+        update.insert(0, self.pk, update.index.astype(np.int64))
+
+        return ChangeSet(insert=df_insert,
+                         update=update.reset_index(drop=True),
+                         changed=changed.reset_index(drop=True),
+                         delete=delete_keys,
+                         versions=versions)
+
+
+class CategoryAggregates(object):
+    """Per category product count, total stock and total price of a products table, plus an
+    index of the products that are low on stock, maintained in O(1) per inserted, updated or
+    deleted row. A full `rebuild()` is only needed to reconcile with the database.
+
+    The contribution of every product is remembered, so an update or delete only needs the
+    key of the row and its new values. Rows written to the database, by this client or any
+    other, come in through the change feed, see `apply_feed()` and `DBManager.sync_aggregates`."""
+
+    def __init__(self, table="products", key="id_product", group="id_category",
+                 stock="stock_available", price="selling_price", low_stock_threshold=5):
+        self.table = table
+        self.key = key
+        self.group = group
+        self.stock = stock
+        self.price = price
+        self.low_stock_threshold = low_stock_threshold
+
+        self.version = 0
+        # False until the first rebuild, or once a change couldn't be applied incrementally.
+        self.built = False
+        # The row version of the table the rows are up to date with, see `DBManager.changes_since`.
+        self.feed_version = None
+
+        self._rows = {}  # key -> [group, stock, price]
+        self._totals = {}  # group -> [count, stock sum, price sum]
+        self._low_stock = {}  # key -> stock, for products below the threshold
+        self._lock = threading.Lock()
+
+    def rebuild(self, products_df, feed_version=None):
+        """Recompute everything from a DataFrame of the whole table, read at feed_version."""
+        df = products_df[[self.key, self.group, self.stock, self.price]]
+        df = df[df[self.key].notna()]
+        keys = df[self.key].astype(np.int64).tolist()
+        groups = df[self.group].tolist()
+        stocks = pd.to_numeric(df[self.stock]).fillna(0).tolist()
+        prices = pd.to_numeric(df[self.price]).fillna(0).tolist()
+
+        totals = df.assign(**{self.stock: stocks, self.price: prices}).groupby(self.group).agg(
+            count=(self.key, "size"), stock_sum=(self.stock, "sum"), price_sum=(self.price, "sum"))
+
+        with self._lock:
+            self._rows = {key: [group, stock, price] for key, group, stock, price
+                          in zip(keys, groups, stocks, prices)}
+            self._totals = {group: list(values) for group, values
+                            in zip(totals.index, totals.itertuples(index=False))}
+            self._low_stock = {key: row[1] for key, row in self._rows.items()
+                               if row[1] < self.low_stock_threshold}
+            self.built = True
+            self.feed_version = feed_version
+            self.version += 1
+
+    def upsert(self, key, values):
+        """Set the values (a dict of column -> value) of the product with key, columns
+        that aren't given keep their current value."""
+        if pd.isna(key) or not any(col in values for col in (self.group, self.stock, self.price)):
+            return
+
+        key = int(key)
+        with self._lock:
+            old = self._rows.get(key)
+            new = list(old) if old is not None else [None, 0, 0]
+            for idx, col in enumerate((self.group, self.stock, self.price)):
+                if col in values:
+                    value = values[col]
+                    if idx > 0:
+                        value = 0 if pd.isna(value) else float(value)
+                    new[idx] = value
+
+            if old is not None:
+                self._remove(key, old)
+            # A product without a category can't be counted anywhere.
+            if new[0] is not None and not pd.isna(new[0]):
+                self._add(key, new)
+            self.version += 1
+
+    def delete(self, key):
+        if pd.isna(key):
+            return
+
+        with self._lock:
+            old = self._rows.get(int(key))
+            if old is not None:
+                self._remove(int(key), old)
+                self.version += 1
+
+    def apply_feed(self, changed, deleted, since, version):
+        """Apply the rows written and deleted between the row versions since and version, see
+        `DBManager.changes_since`. Nothing is applied if the rows were brought past since in
+        the meantime, eg by a rebuild. Returns whether the changes were applied."""
+        with self._lock:
+            if not self.built or since != self.feed_version:
+                return False
+            self.feed_version = version
+
+        for key in deleted:
+            self.delete(key)
+        cols = [col for col in (self.key, self.group, self.stock, self.price) if col in changed]
+        for row in changed[cols].to_dict("records"):
+            self.upsert(row[self.key], row)
+        return True
+
+    def stats(self):
+        """Get the count, total stock and average price per category as a DataFrame."""
+        with self._lock:
+            groups = sorted(self._totals)
+            totals = [self._totals[group] for group in groups]
+
+        df = pd.DataFrame(totals, index=pd.Index(groups, name=self.group),
+                          columns=["count", "stock_sum", "price_sum"])
+        df["price_mean"] = df["price_sum"] / df["count"]
+        return df.drop(columns=["price_sum"])
+
+    def low_stock(self):
+        """Get the keys and stock of the products below the low stock threshold, lowest first."""
+        with self._lock:
+            return sorted(self._low_stock.items(), key=lambda item: item[1])
+
+    def _add(self, key, row):
+        self._rows[key] = row
+        totals = self._totals.setdefault(row[0], [0, 0, 0])
+        totals[0] += 1
+        totals[1] += row[1]
+        totals[2] += row[2]
+        if row[1] < self.low_stock_threshold:
+            self._low_stock[key] = row[1]
+
+    def _remove(self, key, row):
+        del self._rows[key]
+        totals = self._totals[row[0]]
+        totals[0] -= 1
+        totals[1] -= row[1]
+        totals[2] -= row[2]
+        if totals[0] == 0:
+            del self._totals[row[0]]
+        self._low_stock.pop(key, None)
+
 
 class DBManager(object):
     _config = {
+        "backend": None,
         "host": "localhost",
         "user": "root",
         "passwd": "",
         "db": "",
-        "table": ""
+        "table": "",
+        "pool_size": None,
+        "pool_timeout": None,
+        "pool_idle_timeout": None,
+        "pool_check_interval": None,
+        "insert_batch_size": None,
+        "insert_method": None,
+        "read_chunk_size": None,
+        "decimal_mode": None,
+        "import_chunk_size": None,
+        "import_workers": None,
+        "local_infile": None,
+        "low_stock_threshold": None,
+        "snapshot_dir": None,
+        "slow_query_ms": None,
+        "slow_query_log": None,
+        "query_profiling": None,
+        "page_size": None,
+        "page_cache_size": None,
+        "page_prefetch": None,
+        "scan_flush_ms": None,
+        "scan_max_pending": None,
+        "scan_journal": None,
+        "cache_budget_mb": None,
+        "cache_ttl_s": None,
+        "feed_poll_ms": None
+    }
+
+    # Values returned by `getconfig` for keys that haven't been set in `_config`.
+    _config_defaults = {
+        "backend": "mysql",  # a name from `dbbackends.backends`
+        "pool_size": 5,
+        "pool_timeout": 10,
+        "pool_idle_timeout": 300,
+        "pool_check_interval": 30,
+        "insert_batch_size": 1000,
+        "insert_method": "multirow",  # "multirow" or "executemany"
+        "read_chunk_size": 10000,
+        "decimal_mode": "float",  # "float" or "cents", see DBColumn.get_dtype
+        "import_chunk_size": 50000,
+        "import_workers": None,  # processes parsing files for `import_csv_files`, None for one per CPU
+        "local_infile": False,  # allow the `LOAD DATA LOCAL INFILE` import fast path
+        "low_stock_threshold": 5,
+        "snapshot_dir": os.path.join("~", ".datavault", "snapshots"),
+        "slow_query_ms": 500,  # statements slower than this are logged, see `query_report`, 0 disables
+        "slow_query_log": None,  # file the slow statements are appended to as JSON lines
+        "query_profiling": False,  # time the pandas stages around the statements, see `stage`
+        "page_size": 500,  # rows per page of the View Data tab, see `get_page`
+        "page_cache_size": 20,  # pages kept in memory, besides pages with unsaved edits
+        "page_prefetch": 1,  # pages read ahead in the direction of travel, 0 disables
+        "scan_flush_ms": 200,  # how often scanned stock changes are written, see `scanner.ScanIngester`
+        "scan_max_pending": 10000,  # scans waiting to be written before scanners are held back
+        "scan_journal": None,  # file unwritten scans are kept in over a restart
+        "cache_budget_mb": 64,  # memory the cached query results may take, 0 disables the cache
+        "cache_ttl_s": 60,  # seconds a cached result is served, to pick up other clients' writes
+        "feed_poll_ms": 5000  # how often the View Data tab merges in other clients' changes, 0 disables
     }
 
+    # Config keys that change where connections go, updating them resets the pools.
+    _connection_keys = ("backend", "host", "user", "passwd", "db")
+
+    # The `dbbackends.Backend` of the configured `backend`, see `get_backend()`.
+    _backend = None
+
+    # Connection pools, keyed by whether they connect to the configured database.
+    _pools = {}
+    _pools_lock = threading.Lock()
+
     # Store information about the tables for the database through a list of dictionaries
     # Fields Include:
     # table string The name of the table,
     # primary string The primray key of the table,
     # foreign tuple The foreign key data for the table,
+    # label string The column that names a row (optional), see `resolve_labels`,
+    # watermark string A column that grows with every new row (optional), see `refresh_snapshot`,
+    # version string The column holding the version a row was last written at (optional), see `changes_since`,
+    # search tuple The text columns searched by `filter_sql` (optional),
+    # dedup tuple The columns that identify a row when importing files (optional), see `import_csv_files`,
+    # indexes tuple The secondary indexes of the table (optional), represented using DBIndex,
     # fields tuple The fields for the table, represented using DBColumn
     _tables = [
         {
@@ -66,20 +779,76 @@ class DBManager(object):
                          allow_nulls=False, auto_increment=True),
                 DBColumn("id_category", dtype="INT", allow_nulls=False),
                 DBColumn("name", allow_nulls=False),
-                DBColumn("brand"),
+                DBColumn("barcode", dtype="VARCHAR(32)"),
+                DBColumn("brand", categorical=True),
                 DBColumn("stock_available", dtype="INT",
                          allow_nulls=False, default=0),
                 DBColumn("selling_price", dtype="DECIMAL(13,2)",
-                         allow_nulls=False, default=0.00)
+                         allow_nulls=False, default=0.00),
+                DBColumn("row_version", dtype="BIGINT",
+                         allow_nulls=False, default=0)
+            ),
+            "version": "row_version",  # stamped by every write, see `next_version`
+            "watermark": "row_version",  # changed rows are picked up by `refresh_snapshot` too
+            "search": ("name", "brand", "barcode"),  # columns searched by prefix, each one indexed
+            "dedup": ("id_category", "name", "brand"),  # columns identifying a product in supplier files
+            "indexes": (
+                DBIndex("idx_products_barcode", ("barcode",), unique=True, nocase=True),
+                DBIndex("idx_products_name", ("name",), nocase=True),
+                DBIndex("idx_products_brand", ("brand",), nocase=True),
+                DBIndex("idx_products_category_price", ("id_category", "selling_price")),
+                DBIndex("idx_products_row_version", ("row_version",))
             )
         },
         {
             "table": "categories",
             "primary": "id_category",
+            "label": "title",  # column that names a row, used to resolve foreign keys from text
             "fields": (
                 DBColumn("id_category", dtype="INT",
                          allow_nulls=False, auto_increment=True),
                 DBColumn("title", allow_nulls=False)
+            ),
+            "indexes": (
+                DBIndex("idx_categories_title", ("title",)),
+            )
+        }
+    ]
+
+    # The table that records the version of `_tables` the database was migrated to, see `setup_db`.
+    _version_table = {
+        "table": "schema_version",
+        "primary": "id",
+        "fields": (
+            DBColumn("id", dtype="INT", allow_nulls=False),
+            DBColumn("version", dtype="VARCHAR(64)", allow_nulls=False),
+            DBColumn("applied_at", dtype="DATETIME")
+        )
+    }
+
+    # The tables of the change feed of the tables with a "version", see `changes_since`.
+    # row_versions holds the last version handed out for each table and tombstones the
+    # primary keys of deleted rows with the version they were deleted at.
+    _feed_tables = [
+        {
+            "table": "row_versions",
+            "primary": "table_name",
+            "fields": (
+                DBColumn("table_name", dtype="VARCHAR(64)", allow_nulls=False),
+                DBColumn("version", dtype="BIGINT", allow_nulls=False, default=0)
+            )
+        },
+        {
+            "table": "tombstones",
+            "primary": "id",
+            "fields": (
+                DBColumn("id", dtype="BIGINT", allow_nulls=False, auto_increment=True),
+                DBColumn("table_name", dtype="VARCHAR(64)", allow_nulls=False),
+                DBColumn("row_id", dtype="BIGINT", allow_nulls=False),
+                DBColumn("row_version", dtype="BIGINT", allow_nulls=False)
+            ),
+            "indexes": (
+                DBIndex("idx_tombstones_table_version", ("table_name", "row_version")),
             )
         }
     ]
@@ -87,6 +856,18 @@ class DBManager(object):
     # Used for storing data, accessible via `store_data` & `retrieve_data`.
     _data_store = {}
 
+    # Called with (kind, title, message) to show messages to the user, see `notify()`.
+    _notifier = None
+
+    # Live per category statistics of the products, see `CategoryAggregates`.
+    aggregates = CategoryAggregates()
+
+    # Timings of every statement run through `cursor()`, see `query_report()`.
+    query_stats = QueryStats()
+
+    # Results of `get_dbdata()` and `query()`, invalidated by writes, see `cached_read()`.
+    cache = QueryCache(_config_defaults["cache_budget_mb"] * 2 ** 20, ttl=_config_defaults["cache_ttl_s"])
+
     @staticmethod
     def init(data=None, tables=None, **conf):
         """Initialise the DbManager data dictionaries, ie '_data', '_conf' & '_tables'."""
@@ -102,60 +883,141 @@ class DBManager(object):
         DBManager.setup_db()
 
     @staticmethod
-    def open_connection(ignore_db=False):
-        """Open a connection to the database using the data store in DBManager._config.
-        Retrieve using the static method, getconfig()."""
+    def open_connection(ignore_db=False, exclusive=False):
+        """Lease a connection to the database from the connection pool, see `get_pool()`.
+        Nested calls on the same thread reuse the caller's connection unless `exclusive` is set."""
+        connect_errors = DBManager.get_backend().connect_errors()
+        try:
+            return DBManager.get_pool(ignore_db).acquire(exclusive=exclusive)
+        except connect_errors as err:
+            raise ConnectionError(
+                f"Couldn't connect to the database, please check if it is running and available. ({err})") from err
 
-        connect_args = {}
-        connect_args["host"] = DBManager.getconfig("host")
-        connect_args["user"] = DBManager.getconfig("user")
+    @staticmethod
+    def get_backend():
+        """Get the `dbbackends.Backend` of the configured `backend`."""
+        name = DBManager.getconfig("backend")
+        if DBManager._backend is None or DBManager._backend.name != name:
+            DBManager._backend = dbbackends.get_backend(name)
+        return DBManager._backend
 
-        passwd = ""
-        if DBManager.isconfigset("passwd"):
-            passwd = DBManager.getconfig("passwd")
-        connect_args["passwd"] = passwd
+    @staticmethod
+    def cursor(con, stream=False):
+        """Get an instrumented cursor on con, every statement run through it is timed in
+        `query_stats`. A stream cursor fetches rows as they are asked for, see `iter_dbdata()`."""
+        backend = DBManager.get_backend()
+        raw = backend.stream_cursor(con) if stream else backend.cursor(con)
+        return InstrumentedCursor(raw, DBManager.query_stats,
+                                  slow_ms=DBManager.getconfig("slow_query_ms") or None,
+                                  slow_log=DBManager.getconfig("slow_query_log"),
+                                  profile=DBManager.getconfig("query_profiling"),
+                                  on_write=getattr(con, "wrote", None))
 
-        if DBManager.isconfigset("db") and not ignore_db:
-            connect_args["database"] = DBManager.getconfig("db")
+    @staticmethod
+    def stage(name):
+        """Context manager attributing the time spent in it to the stage name of the query
+        profile, when the `query_profiling` config is set. Time spent in the database is
+        attributed to the "database" stage."""
+        return DBManager.query_stats.stage(name, DBManager.getconfig("query_profiling"))
 
-        try:
-            con = mysql.connector.connect(**connect_args)
-        except mysql.connector.errors.InterfaceError:
-            tkMessageBox.showerror(title="Connection Failed",
-                                   message="Couldn't connect to the MySQL server, please check if it is running and available.")
-            return
+    @staticmethod
+    def query_report():
+        """Get the statistics of the statements run so far: per statement type and table
+        counters and latency histograms, the time spent in each profiled stage and the
+        most recent slow statements."""
+        return DBManager.query_stats.report()
+
+    @staticmethod
+    def export_query_report(path):
+        """Write `query_report()` to path, as JSON, or as CSV of the operations if path ends in `.csv`."""
+        report = DBManager.query_report()
+        if path.lower().endswith(".csv"):
+            pd.DataFrame(report["operations"]).drop(columns=["histogram"], errors="ignore").to_csv(
+                path, index=False)
+        else:
+            with open(path, "w", encoding="utf-8") as report_file:
+                json.dump(report, report_file, indent=2)
 
-        return con
+    @staticmethod
+    def set_notifier(notifier):
+        """Set the callable used to show messages to the user, eg to move them onto the GUI thread.
+        Pass None to go back to logging them to the `datavault` logger."""
+        DBManager._notifier = notifier
 
     @staticmethod
-    def setup_db():
-        """Setup the DataBase by creating all of the tables stored in the `_tables` dict."""
-        if (not DBManager.isconfigset("db")) or (not DBManager._tables):
-            return
+    def notify(kind, title, message):
+        """Show a message to the user, kind is either "info" or "error". Without a notifier
+        (see `set_notifier()`) the message is logged, so DBManager never needs a display."""
+        if DBManager._notifier is not None:
+            DBManager._notifier(kind, title, message)
+        else:
+            logging.getLogger("datavault").log(logging.ERROR if kind == "error" else logging.INFO,
+                                               "%s: %s", title, message.replace("\n", " "))
 
-        with DBManager.open_connection() as con:
-            cursor = con.cursor(prepared=True)
+    @staticmethod
+    def get_pool(ignore_db=False):
+        """Get the connection pool, creating it from the pool settings in `_config` on first use."""
+        with DBManager._pools_lock:
+            pool = DBManager._pools.get(ignore_db)
+            if pool is None:
+                pool = ConnectionPool(lambda: DBManager._connect(ignore_db),
+                                      size=DBManager.getconfig("pool_size"),
+                                      timeout=DBManager.getconfig("pool_timeout"),
+                                      idle_timeout=DBManager.getconfig(
+                                          "pool_idle_timeout"),
+                                      check_interval=DBManager.getconfig(
+                                          "pool_check_interval"),
+                                      check=DBManager.get_backend().is_connected,
+                                      on_write=DBManager.cache.invalidate)
+                DBManager._pools[ignore_db] = pool
+        return pool
 
-            # Create all of the tables.
-            for table in DBManager._tables:
-                sql_createtable = f"""CREATE TABLE IF NOT EXISTS `{table["table"]}` (
-                    {",".join(str(field) for field in table["fields"])},
-                    PRIMARY KEY ({table["primary"]})
-                )"""
+    @staticmethod
+    def close_pools():
+        """Close all of the connection pools, the next connection request creates a fresh pool."""
+        with DBManager._pools_lock:
+            pools = list(DBManager._pools.values())
+            DBManager._pools.clear()
 
-                cursor.execute(sql_createtable)
+        for pool in pools:
+            pool.close()
 
-            # Add foreign keys to the tables.
-            for table in DBManager._tables:
-                if "foreign" not in table:
-                    continue
+    @staticmethod
+    def pool_stats():
+        """Get the statistics of every open connection pool."""
+        return {("server" if ignore_db else "db"): pool.stats()
+                for ignore_db, pool in DBManager._pools.items()}
+
+    @staticmethod
+    def _connect(ignore_db=False):
+        """Open a new connection to the database using the data store in DBManager._config.
+        Retrieve using the static method, getconfig()."""
+        settings = {key: DBManager.getconfig(key)
+                    for key in ("host", "user", "passwd", "db", "local_infile")}
 
-                sql_alter = f"""ALTER TABLE `{table["table"]}`
-                    ADD FOREIGN KEY ({table["foreign"][0]})
-                    REFERENCES {table["foreign"][1]}
-                """
+        return DBManager.get_backend().connect(settings, ignore_db)
 
-                cursor.execute(sql_alter)
+    @staticmethod
+    def setup_db():
+        """Setup the DataBase by creating or altering the tables so they match `_tables`, see
+        `migrations.Migrator`. Only the missing tables, columns, indexes and foreign keys are
+        added, and nothing is done if the schema already matches. Returns the statements run."""
+        if (not DBManager.isconfigset("db")) or (not DBManager._tables):
+            return []
+
+        migrator = Migrator(DBManager.get_backend(), DBManager._tables + DBManager._feed_tables,
+                            DBManager._version_table)
+        with DBManager.open_connection() as con:
+            cursor = DBManager.cursor(con)
+            statements = migrator.migrate(cursor)
+            if statements:
+                # Every versioned table has a counter row, so `next_version` only has to update it.
+                for table in DBManager._tables:
+                    if table.get("version") and DBManager.table_version(table["table"], cursor) is None:
+                        cursor.execute(f"INSERT INTO `row_versions` (`table_name`, `version`) "
+                                       f"VALUES ({DBManager.get_backend().param}, 0)", (table["table"],))
+            con.commit()
+        return statements
 
     @staticmethod
     def get_table(tablename, cols_as_dict=False):
@@ -189,6 +1051,7 @@ class DBManager(object):
 
             assert(len(columns) >
                    0), f"`{table}` is not a known table, please pass `{table}` directly or add it to the `tables` dictionary."
+            columns = columns[0]
         elif isinstance(table, dict):
             columns = table["fields"]
         else:
@@ -209,6 +1072,7 @@ class DBManager(object):
         if key in DBManager._config:
             if not DBManager.isconfigset(key):
                 DBManager._config[key] = data
+                DBManager._config_changed(key)
         else:
             raise KeyError(f"{key} does not exists in DBManager.tables")
 
@@ -217,13 +1081,32 @@ class DBManager(object):
         """Update data in the `_conf` dictionary"""
         if key in DBManager._config:
             DBManager._config[key] = data
+            DBManager._config_changed(key)
         else:
             raise KeyError(f"{key} does not exist in `tables`")
 
+    @staticmethod
+    def _config_changed(key):
+        """Apply a new value of the config at key to the pools and the query cache."""
+        if key in DBManager._connection_keys:
+            DBManager.close_pools()
+            # The cached results were read from the previous database.
+            DBManager.cache.clear()
+        elif key == "cache_budget_mb":
+            # 0 is a setting here, not "unset".
+            data = DBManager._config[key]
+            DBManager.cache.resize((DBManager._config_defaults[key] if data is None else data) * 2 ** 20)
+        elif key == "cache_ttl_s":
+            data = DBManager._config[key]
+            DBManager.cache.ttl = DBManager._config_defaults[key] if data is None else data
+
     @ staticmethod
     def getconfig(key):
-        """Get the data at key in the `_conf` dict"""
+        """Get the data at key in the `_conf` dict, falling back to `_config_defaults` if it is None,
+        so settings such as 0 or False are kept."""
         if key in DBManager._config:
+            if DBManager._config[key] is None and key in DBManager._config_defaults:
+                return DBManager._config_defaults[key]
             return DBManager._config[key]
         raise KeyError(f"{key} does not exist in `config`")
 
@@ -252,36 +1135,622 @@ class DBManager(object):
     def isdataset(key):
         return key in DBManager._data_store
 
+    @staticmethod
+    def query_category_stats(filters=None, search=None, table="products", cached=True):
+        """Get the number of products, total stock, average price and number of products low
+        on stock (see the `low_stock_threshold` config) of each category, computed by the
+        database in a single GROUP BY, so only one row per category is transferred.
+
+        Only the products matching filters and search are counted, see `filter_sql()`.
+        Returns a DataFrame indexed by category title, in title order, served from the query
+        cache unless cached is False, see `cached_read()`."""
+        param = DBManager.get_backend().param
+        group, ref_table, ref_col = DBManager.get_foreign(table)
+        label = DBManager.get_table(ref_table)["label"]
+        where, params = DBManager.filter_sql(table, filters, search)
+
+        sql = f"""SELECT s.`{group}`, c.`{label}`, s.`count`, s.`stock_sum`, s.`price_mean`, s.`low_stock`
+                  FROM (SELECT `{group}`, COUNT(*) AS `count`, SUM(`stock_available`) AS `stock_sum`,
+                               AVG(`selling_price`) AS `price_mean`,
+                               SUM(CASE WHEN `stock_available` < {param} THEN 1 ELSE 0 END) AS `low_stock`
+                        FROM `{table}` {f"WHERE {where}" if where else ""}
+                        GROUP BY `{group}`) s
+                  LEFT JOIN `{ref_table}` c ON c.`{ref_col}` = s.`{group}`
+                  ORDER BY c.`{label}`"""
+
+        params = (DBManager.getconfig("low_stock_threshold"),) + params
+
+        def read():
+            with DBManager.open_connection() as con:
+                cursor = DBManager.cursor(con)
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+
+            df = pd.DataFrame.from_records(
+                rows, columns=[group, label, "count", "stock_sum", "price_mean", "low_stock"])
+            # MySQL returns the sums and averages of DECIMAL columns as Decimal.
+            df = df.astype({group: np.int64, "count": np.int64, "low_stock": np.int64})
+            df["stock_sum"] = pd.to_numeric(df["stock_sum"]).fillna(0).astype(np.int64)
+            df["price_mean"] = pd.to_numeric(df["price_mean"]).astype(np.float64)
+            # Products of a category that doesn't exist are listed under its id.
+            df[label] = df[label].where(df[label].notna(), df[group].astype(str))
+            return df.set_index(label)
+
+        if not cached:
+            return read()
+        key = ("category_stats", table, where, params)
+        return DBManager.cached_read(key, (table, ref_table), read)
+
+    @staticmethod
+    def rebuild_aggregates():
+        """Reconcile `aggregates` with the database by rebuilding it from the products table,
+        reading only the columns it keeps."""
+        aggregates = DBManager.aggregates
+        cols = [aggregates.key, aggregates.group, aggregates.stock, aggregates.price]
+        # Taken first, so rows written while the table is read come again with the next sync.
+        version = DBManager.table_version(aggregates.table)
+        df = DBManager.concat_chunks(DBManager.iter_dbdata(aggregates.table, columns=cols), columns=cols)
+        aggregates.low_stock_threshold = DBManager.getconfig("low_stock_threshold")
+        aggregates.rebuild(df, feed_version=version)
+
+    @staticmethod
+    def sync_aggregates():
+        """Bring `aggregates` up to date with every row written since it was built or last
+        synced, by this client or any other, in O(1) per row, see `changes_since()`. It is
+        rebuilt if it was never built, or was marked as out of line with the database.
+        Returns `aggregates`."""
+        aggregates = DBManager.aggregates
+        since = aggregates.feed_version
+        if not aggregates.built or since is None:
+            DBManager.rebuild_aggregates()
+            return aggregates
+
+        changed, deleted, version = DBManager.changes_since(aggregates.table, since)
+        aggregates.apply_feed(changed, deleted, since, version)
+        return aggregates
+
     @staticmethod
     def add_to_table(table, *data):
         pass
 
     @staticmethod
-    def get_dbdata(table: str = None) -> pd.DataFrame:
-        """ Method to get the data from the database and return it as a tuple consisting
-        of a list of the names of the columns and a list of the actualy data in tuple format."""
-        if DBManager.isconfigset("table"):
+    def get_dbdata(table: str = None, chunksize: int = None, cached=True) -> pd.DataFrame:
+        """ Method to get the data from the database and return it as a DataFrame.
+        If chunksize is given, a generator of DataFrames with at most chunksize rows is
+        returned instead, see `iter_dbdata()`. The whole table is served from the query
+        cache unless cached is False, see `cached_read()`."""
+        tablename = table
+        if not tablename and DBManager.isconfigset("table"):
             tablename = DBManager.getconfig("table")
-        tablename = table or tablename
 
         if not DBManager.does_table_exist(tablename):
             return
 
+        if chunksize:
+            return DBManager.iter_dbdata(tablename, chunksize=chunksize)
+
+        def read():
+            # The chunks are read through the caller's connection (if any) and fully consumed here.
+            chunks = DBManager.iter_dbdata(tablename, exclusive=False)
+            return DBManager.concat_chunks(chunks, columns=DBManager.get_table_cols(tablename))
+
+        if not cached:
+            return read()
+        return DBManager.cached_read(("dbdata", tablename), (tablename,), read)
+
+    @staticmethod
+    def cached_read(key, tables, read):
+        """Get the result cached at key in `cache`, or call read() and cache what it returns as
+        read from tables. Writes to the tables through `cursor()` invalidate the result as
+        soon as they run and again once committed or rolled back, see `ConnectionPool.on_write`. Returns a
+        copy, so the caller may modify it."""
+        result = DBManager.cache.get(key)
+        if result is not None:
+            return result
+
+        generation = DBManager.cache.generation(tables)
+        result = read()
+        if DBManager.cache.put(key, tables, result, generation):
+            return result.copy()
+        return result
+
+    @staticmethod
+    def cache_report():
+        """Get the hit, miss and eviction counters of the query cache, and the memory it takes."""
+        return DBManager.cache.stats()
+
+    @staticmethod
+    def iter_dbdata(table, chunksize=None, columns=None, exclusive=True, where=None, params=(),
+                    order_by=None, limit=None):
+        """Stream the rows of table from an unbuffered cursor, yielding DataFrames of at
+        most chunksize rows, so only one chunk of rows is held in memory at a time.
+        where is an optional SQL condition, with its placeholders filled from params,
+        order_by an optional SQL ORDER BY list and limit the most rows to read.
+
+        By default the rows are read on a connection of their own, as an unbuffered
+        cursor ties up its connection until every row has been read."""
+        chunksize = chunksize or DBManager.getconfig("read_chunk_size")
+        cols = columns or DBManager.get_table_cols(table)
+
+        with DBManager.open_connection(exclusive=exclusive) as con:
+            cursor = DBManager.cursor(con, stream=True)
+
+            sql = f"SELECT {','.join(cols)} FROM {table}"
+            if where:
+                sql += f" WHERE {where}"
+            if order_by:
+                sql += f" ORDER BY {order_by}"
+            if limit is not None:
+                sql += f" LIMIT {int(limit)}"
+            cursor.execute(sql, params)
+
+            while True:
+                data = cursor.fetchmany(chunksize)
+                if not data:
+                    break
+                with DBManager.stage("frame"):
+                    chunk = pd.DataFrame.from_records(data, columns=cols)
+                with DBManager.stage("dtypes"):
+                    chunk = DBManager.apply_dtypes(chunk, table)
+                yield chunk
+
+    # The comparisons `filter_sql()` accepts, besides "in", "not in", "is null", "is not null" and "prefix".
+    _comparisons = ("=", "!=", "<", "<=", ">", ">=")
+
+    @staticmethod
+    def filter_sql(table, filters=None, search=None):
+        """Turn filters and a search into a parameterized SQL condition on table, as (where, params).
+
+        filters is a list of (column, operator, value), operator one of `_comparisons`,
+        "in" and "not in" (value a list), "is null" and "is not null" (no value) or
+        "prefix" (values starting with value). search is text matched against the start of
+        each of the table's `search` columns. Conditions are written so the table's indexes
+        can serve them, ie the columns are never wrapped in functions. where is None if
+        there are no conditions. Raises ValueError for unknown columns or operators."""
+        backend = DBManager.get_backend()
+        cols = DBManager.get_table_cols(table)
+        conditions, params = [], []
+
+        for column, operator, *value in filters or ():
+            if column not in cols:
+                raise ValueError(f"`{column}` is not a column of `{table}`.")
+            operator = operator.lower()
+            value = DBManager.sql_value(value[0]) if value else None
+
+            if operator in DBManager._comparisons:
+                conditions.append(f"`{column}` {operator} {backend.param}")
+                params.append(value)
+            elif operator in ("in", "not in"):
+                values = [DBManager.sql_value(item) for item in value]
+                if not values:
+                    # Nothing is in an empty list.
+                    conditions.append("1 = 0" if operator == "in" else "1 = 1")
+                    continue
+                conditions.append(f"`{column}` {operator.upper()} ({','.join([backend.param] * len(values))})")
+                params.extend(values)
+            elif operator in ("is null", "is not null"):
+                conditions.append(f"`{column}` {operator.upper()}")
+            elif operator == "prefix":
+                sql, prefix_params = backend.prefix_sql(column, str(value))
+                conditions.append(sql)
+                params.extend(prefix_params)
+            else:
+                raise ValueError(f"Unknown filter operator `{operator}`.")
+
+        if search:
+            matches = [backend.prefix_sql(column, search)
+                       for column in DBManager.get_table(table).get("search", ())]
+            if matches:
+                conditions.append("(" + " OR ".join(sql for sql, _ in matches) + ")")
+                params.extend(param for _, match_params in matches for param in match_params)
+
+        return (" AND ".join(conditions) or None), tuple(params)
+
+    @staticmethod
+    def sql_value(value):
+        """Convert a NumPy scalar to the Python value the database drivers expect."""
+        return value.item() if isinstance(value, np.generic) else value
+
+    @staticmethod
+    def query(table, filters=None, search=None, order_by=None, descending=False, limit=None, columns=None,
+              cached=True):
+        """Read the rows of table that match filters and search (see `filter_sql()`), sorted
+        by the column or list of columns order_by, with the filtering, sorting and limiting
+        done by the database. Returns a DataFrame of columns (all columns by default), served
+        from the query cache when the same rows were read before unless cached is False,
+        see `cached_read()`."""
+        cols = DBManager.get_table_cols(table)
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        for column in list(order_by or ()) + list(columns or ()):
+            if column not in cols:
+                raise ValueError(f"`{column}` is not a column of `{table}`.")
+
+        where, params = DBManager.filter_sql(table, filters, search)
+        order = ",".join(f"`{column}` {'DESC' if descending else 'ASC'}" for column in order_by or ())
+
+        def read():
+            return DBManager.concat_chunks(DBManager.iter_dbdata(
+                table, columns=columns, exclusive=False, where=where, params=params,
+                order_by=order or None, limit=limit), columns=columns or cols)
+
+        if not cached:
+            return read()
+        key = ("query", table, tuple(columns or ()), where, params, order, limit)
+        return DBManager.cached_read(key, (table,), read)
+
+    @staticmethod
+    def get_page(table, order_by=None, descending=False, after=None, before=None, limit=None,
+                 filters=None, search=None):
+        """Read one page of table with keyset pagination, ie by the position of a row in the
+        sort order rather than an OFFSET, so every page costs the same however deep it is.
+
+        The rows are sorted by order_by (the primary key by default), ties broken by the
+        primary key. after is the `page_key()` of the row the page starts after and before
+        the key of the row the page ends before. Giving neither reads the first page and
+        `before=()` reads the last page. Only the rows matching filters and search are read,
+        see `filter_sql()`. Returns a DataFrame of at most limit rows, in sort order."""
+        pk = DBManager.get_table(table)["primary"]
+        limit = limit or DBManager.getconfig("page_size")
+        param = DBManager.get_backend().param
+        keys = [order_by, pk] if order_by and order_by != pk else [pk]
+        if order_by and order_by not in DBManager.get_table_cols(table):
+            raise ValueError(f"`{order_by}` is not a column of `{table}`.")
+
+        # Reading backwards is reading the reversed order forwards, then flipping the rows.
+        backwards = before is not None
+        direction = "DESC" if descending != backwards else "ASC"
+        order = ",".join(f"`{col}` {direction}" for col in keys)
+
+        where, params = DBManager.filter_sql(table, filters, search)
+        anchor = before if backwards else after
+        if anchor:
+            cols = ",".join(f"`{col}`" for col in keys)
+            placeholders = ",".join([param] * len(keys))
+            keyset = f"({cols}) {'<' if direction == 'DESC' else '>'} ({placeholders})"
+            where = f"{where} AND {keyset}" if where else keyset
+            params += tuple(anchor)
+
+        df = DBManager.concat_chunks(DBManager.iter_dbdata(
+            table, exclusive=False, where=where, params=params, order_by=order, limit=limit),
+            columns=DBManager.get_table_cols(table))
+        if backwards:
+            df = df.iloc[::-1]
+        return df.reset_index(drop=True)
+
+    @staticmethod
+    def page_key(table, df, row, order_by=None):
+        """Get the key of a row of df for `get_page()`, ie its values of the sort columns as
+        they are stored in the database."""
+        pk = DBManager.get_table(table)["primary"]
+        keys = [order_by, pk] if order_by and order_by != pk else [pk]
+        return DBManager.df_to_rows(DBManager.to_db_frame(df.iloc[[row]][keys], table))[0]
+
+    @staticmethod
+    def count_rows(table, filters=None, search=None):
+        """Count the rows of table that match filters and search, see `filter_sql()`."""
+        where, params = DBManager.filter_sql(table, filters, search)
+        with DBManager.open_connection() as con:
+            cursor = DBManager.cursor(con)
+            cursor.execute(f"SELECT COUNT(*) FROM `{table}`" + (f" WHERE {where}" if where else ""), params)
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def concat_chunks(chunks, columns=None):
+        """Concatenate an iterable of DataFrame chunks into one DataFrame with a single
+        copy, rather than growing a DataFrame chunk by chunk."""
+        frames = list(chunks)
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        if len(frames) == 1:
+            return frames[0]
+
+        # Categoricals only stay categorical through concat if every chunk has the same categories.
+        for col in frames[0].columns:
+            if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+                categories = pd.api.types.union_categoricals(
+                    [frame[col] for frame in frames]).categories
+                for frame in frames:
+                    frame[col] = frame[col].cat.set_categories(categories)
+
+        with DBManager.stage("concat"):
+            return pd.concat(frames, ignore_index=True, copy=False)
+
+    @staticmethod
+    def empty_df(table):
+        """Get an empty DataFrame with the columns and dtypes of table."""
+        return DBManager.apply_dtypes(pd.DataFrame(columns=DBManager.get_table_cols(table)), table)
+
+    @staticmethod
+    def get_table_dtypes(table):
+        """Get a dict of the pandas dtype of each column in table, see `DBColumn.get_dtype`."""
+        decimal_mode = DBManager.getconfig("decimal_mode")
+        return {col.get_name(): col.get_dtype(decimal_mode)
+                for col in DBManager.get_table_cols_full(table)}
+
+    @staticmethod
+    def apply_dtypes(df, table):
+        """Convert the columns of df that belong to table to their compact dtypes,
+        see `get_table_dtypes()`. Values that don't fit the dtype are left as they are."""
+        table_cols = DBManager.get_table_cols_dict(table)
+        dtypes = DBManager.get_table_dtypes(table)
+
+        for col in df.columns:
+            if col not in dtypes or df[col].dtype == dtypes[col]:
+                continue
+
+            series = df[col]
+            try:
+                if dtypes[col] in ("int64", "Int64") and table_cols[col].get_scale() is not None:
+                    # Fixed point, eg a DECIMAL(13,2) price stored as a whole number of cents.
+                    scale = table_cols[col].get_scale()
+                    series = (series.astype(np.float64) * 10 ** scale).round()
+                elif table_cols[col].is_numeric():
+                    series = pd.to_numeric(series)
+                df[col] = series.astype(dtypes[col])
+            except (TypeError, ValueError):
+                continue
+
+        return df
+
+    @staticmethod
+    def to_db_frame(df, table):
+        """Undo the conversions of `apply_dtypes()` that the database can't take as is,
+        ie fixed point DECIMAL columns are turned back into floats."""
+        if DBManager.getconfig("decimal_mode") != "cents":
+            return df
+
+        table_cols = DBManager.get_table_cols_dict(table)
+        scaled = [col for col in df.columns
+                  if col in table_cols and table_cols[col].get_scale() is not None
+                  and pd.api.types.is_integer_dtype(df[col].dtype)]
+        if not scaled:
+            return df
+
+        df = df.copy()
+        for col in scaled:
+            df[col] = df[col].astype(np.float64) / 10 ** table_cols[col].get_scale()
+        return df
+
+    @staticmethod
+    def get_snapshot_store():
+        """Get the `SnapshotStore` for the configured server and database."""
+        path = os.path.expanduser(DBManager.getconfig("snapshot_dir"))
+        name = f"{DBManager.getconfig('host')}_{DBManager.getconfig('db')}"
+        return SnapshotStore(os.path.join(path, name))
+
+    @staticmethod
+    def schema_hash(table):
+        """Hash of the definition of table, a snapshot taken with a different hash is ignored."""
+        definition = DBManager.get_table(table)
+        parts = [table, definition["primary"], DBManager.getconfig("decimal_mode")]
+        parts += [f"{col} {col.get_dtype(DBManager.getconfig('decimal_mode'))}"
+                  for col in DBManager.get_table_cols_full(table)]
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_watermark(table):
+        """Get the column that grows whenever a row of table is added, see `refresh_snapshot()`.
+        This is the "watermark" of the table if it has one, otherwise its primary key."""
+        definition = DBManager.get_table(table)
+        return definition.get("watermark", definition["primary"])
+
+    @staticmethod
+    def save_snapshot(table, df):
+        """Save df as the local snapshot of table, tagged with its schema hash and the
+        highest watermark in it. This writes df to disk, so pass a copy if it's still being edited."""
+        watermark = df[DBManager.get_watermark(table)].max() if len(df) > 0 else None
+        if watermark is not None and not pd.isna(watermark):
+            watermark = watermark.item() if hasattr(watermark, "item") else str(watermark)
+        else:
+            watermark = None
+
+        DBManager.get_snapshot_store().save(
+            table, df, DBManager.schema_hash(table), high_water_mark=watermark)
+
+    @staticmethod
+    def load_snapshot(table):
+        """Load the local snapshot of table as (DataFrame, meta), None if there isn't a usable one.
+        The DataFrame is memory-mapped rather than read into memory, see `SnapshotStore`."""
+        return DBManager.get_snapshot_store().load(table, DBManager.schema_hash(table))
+
+    @staticmethod
+    def refresh_snapshot(table, df, meta):
+        """Bring a DataFrame loaded by `load_snapshot()` up to date with the database by
+        only reading the rows past its high-water mark. When the watermark is the row
+        version of the table, the rows deleted since are dropped too, see `changes_since()`.
+        If the row count then doesn't match the database, eg rows were deleted from a table
+        without row versions, the whole table is read instead.
+        Returns the up to date DataFrame and saves it as the new snapshot."""
+        watermark = DBManager.get_watermark(table)
+        primary = DBManager.get_table(table)["primary"]
+        cols = DBManager.get_table_cols(table)
+
+        with DBManager.open_connection():
+            count = DBManager.count_rows(table)
+
+            deleted = []
+            if meta["high_water_mark"] is None:
+                changed = DBManager.empty_df(table)
+            elif watermark == DBManager.get_table(table).get("version"):
+                changed, deleted, _ = DBManager.changes_since(table, meta["high_water_mark"])
+            else:
+                changed = DBManager.concat_chunks(DBManager.iter_dbdata(
+                    table, exclusive=False, where=f"`{watermark}` > {DBManager.get_backend().param}",
+                    params=(meta["high_water_mark"],)), columns=cols)
+
+            if len(changed) > 0 or deleted:
+                # Rows that were changed rather than added replace their old version.
+                replaced = df[primary].isin(changed[primary]) | df[primary].isin(deleted)
+                if replaced.any():
+                    df = df[~replaced].copy()
+                if len(changed) > 0:
+                    df = DBManager.concat_chunks([df, changed], columns=cols)
+
+            if len(df) != count:
+                df = DBManager.get_dbdata(table, cached=False)
+
+        if len(changed) > 0 or len(df) != meta["rows"]:
+            DBManager.save_snapshot(table, df.copy())
+        return df
+
+    @staticmethod
+    def sync_snapshot(table):
+        """Bring the local snapshot of table up to date, see `refresh_snapshot()`, or take one
+        from the whole table if there isn't a usable one. Returns the up to date DataFrame."""
+        snapshot = DBManager.load_snapshot(table)
+        if snapshot is not None:
+            return DBManager.refresh_snapshot(table, *snapshot)
+
+        df = DBManager.get_dbdata(table, cached=False)
+        DBManager.save_snapshot(table, df.copy())
+        return df
+
+    @staticmethod
+    def next_version(cursor, table):
+        """Hand out the next row version of table for the transaction of cursor, to stamp
+        on the rows it writes. Bumping the counter locks it until the transaction ends, so
+        writers of the table take turns and a version is only visible once every row
+        written at an earlier version is, which `changes_since()` relies on. Returns None
+        for tables without a row version."""
+        if not DBManager.get_table(table).get("version"):
+            return None
+
+        param = DBManager.get_backend().param
+        cursor.execute(f"UPDATE `row_versions` SET `version` = `version` + 1 WHERE `table_name` = {param}",
+                       (table,))
+        if not cursor.rowcount:
+            # The counter is created by `setup_db`, unless it was removed since.
+            cursor.execute(f"INSERT INTO `row_versions` (`table_name`, `version`) VALUES ({param}, 1)",
+                           (table,))
+        return DBManager.table_version(table, cursor)
+
+    @staticmethod
+    def table_version(table, cursor=None):
+        """Get the last row version handed out for table, None if it has no counter."""
+        if cursor is None:
+            with DBManager.open_connection() as con:
+                return DBManager.table_version(table, DBManager.cursor(con))
+
+        cursor.execute(f"SELECT `version` FROM `row_versions` WHERE `table_name` = {DBManager.get_backend().param}",
+                       (table,))
+        row = cursor.fetchone()
+        return int(row[0]) if row else None
+
+    @staticmethod
+    def changes_since(table, since=0):
+        """Read the change feed of table, ie the rows written and deleted since the row
+        version since, eg the version returned by an earlier call or by `table_version()`.
+
+        Returns (DataFrame of the rows added or changed, list of the primary keys deleted,
+        the version the changes go up to), the version to pass as since next time. Only
+        the changed rows are read, through the index on the row version."""
+        definition = DBManager.get_table(table)
+        version_col = definition.get("version")
+        if not version_col:
+            raise ValueError(f"`{table}` has no row version to read changes by.")
+        pk = definition["primary"]
+        param = DBManager.get_backend().param
+
+        with DBManager.open_connection() as con:
+            cursor = DBManager.cursor(con)
+            # Versions past this one may still be written, they are left for the next call.
+            version = DBManager.table_version(table, cursor) or 0
+            if version <= since:
+                return DBManager.empty_df(table), [], since
+
+            changed = DBManager.concat_chunks(DBManager.iter_dbdata(
+                table, exclusive=False, where=f"`{version_col}` > {param} AND `{version_col}` <= {param}",
+                params=(since, version)), columns=DBManager.get_table_cols(table))
+
+            cursor.execute(f"""SELECT `row_id`, MAX(`row_version`) FROM `tombstones`
+                               WHERE `table_name` = {param} AND `row_version` > {param} AND `row_version` <= {param}
+                               GROUP BY `row_id`""", (table, since, version))
+            tombstones = cursor.fetchall()
+
+        # A key deleted and then used again by a later row isn't gone.
+        written = dict(zip(changed[pk].astype(np.int64), changed[version_col].astype(np.int64)))
+        deleted = [int(key) for key, deleted_at in tombstones if written.get(int(key), -1) < deleted_at]
+        return changed, deleted, version
+
+    @staticmethod
+    def row_conflicts(cursor, table, versions, deleted=()):
+        """Get the keys of versions (primary key -> row version read) whose rows are no longer
+        at that version, ie were changed or deleted since. Rows of the keys in deleted that
+        are already gone aren't conflicts, as they were going to be deleted anyway."""
+        definition = DBManager.get_table(table)
+        pk, version_col = definition["primary"], definition["version"]
+        backend = DBManager.get_backend()
+        keys = sorted(versions)
+
+        current = {}
+        for offset in range(0, len(keys), backend.max_params):
+            batch = keys[offset:offset + backend.max_params]
+            cursor.execute(f"SELECT `{pk}`, `{version_col}` FROM `{table}` "
+                           f"WHERE `{pk}` IN ({','.join([backend.param] * len(batch))})", batch)
+            current.update((int(key), int(version)) for key, version in cursor.fetchall())
+
+        deleted = set(deleted)
+        return [key for key in keys
+                if current.get(key) != versions[key] and not (key not in current and key in deleted)]
+
+    @staticmethod
+    def add_df_to_db(df, table: str = "", suppress="", read_version=None):
+        """Bring table in line with df, see `diff_df()`. read_version is the row version of the
+        table when df was read (see `table_version()`), without it every row missing from df
+        is deleted, including rows someone else added since."""
+        db_table = DBManager.get_crud_table(table)
+
         with DBManager.open_connection() as con:
-            cursor = con.cursor()
+            # Firstly, get original dataframe, using get_db_data()
+            # Compared against what is in the database now, not a cached read.
+            left_df = DBManager.get_dbdata(table=db_table, cached=False)
+            # End the read's transaction, so the save checks the row versions against what
+            # is committed once it holds the version lock rather than against this read.
+            con.rollback()
+
+            # Then, compare the two on the primary key and only take the rows that have differences
+            with DBManager.stage("diff"):
+                changes = DBManager.diff_df(left_df, df, db_table, read_version=read_version)
+
+            if changes.empty:
+                DBManager.notify("info", title="DataBase Update Complete",
+                                 message="Nothing was added to the DB as no changes were detected between the different datasets.")
+                return
+
+            report = DBManager.save_changes(
+                changes, table=db_table, suppress=suppress)
+
+        return report
+
+    @staticmethod
+    def save_changes(changes, table: str = "", suppress=""):
+        """Write a `ChangeSet` to the database in a single transaction, without comparing
+        it against the data that is already in the table."""
+        db_table = DBManager.get_crud_table(table)
 
-            cols = DBManager.get_table_cols(tablename)
+        with DBManager.open_connection() as con:
+            # try:
+            report = DBManager.apply_changes(con, db_table, changes)
+            con.commit()
 
-            cursor.execute(
-                f"SELECT {','.join(cols)} FROM {tablename}")
-            data = cursor.fetchall()
+            if (suppress == "success") or (suppress == "all"):
+                DBManager.notify("info", title="Save Successful",
+                                 message="Save Completed Successfully!\n"
+                                 f"Inserted {report['rows']} rows ({report['rows_per_sec']:.0f} rows/s), "
+                                 f"updated {report['updated']} and deleted {report['deleted']}.")
+            # except Exception as err:
+            #     con.rollback()
 
-        data_df = pd.DataFrame(data, columns=cols)
+            #     if (suppress == "error") or (suppress == "all"):
+            #         DBManager.notify("error", title="Save Failed",
+            #                          message=f"The data was not saved to the DB.\n{err}")
 
-        return data_df
+        return report
 
     @staticmethod
-    def add_df_to_db(df, table: str = "", suppress=""):
+    def get_crud_table(table=""):
+        """Get the table to use for CRUD operations, table or else the configured `table`."""
         if (not table) and (not DBManager.isconfigset("table")):
             raise LookupError(
                 "There is no table specified to use for CRUD operations.")
@@ -292,68 +1761,614 @@ class DBManager(object):
             raise LookupError(
                 "The specified table is not specified in `table` dict or does not exist.")
 
-        with DBManager.open_connection() as con:
-            cursor = con.cursor()
+        return db_table
 
-            # Firstly, get original dataframe, using get_db_data()
-            left_df = DBManager.get_dbdata(table=db_table)
+    @staticmethod
+    def diff_df(left, right, table, read_version=None):
+        """Compare `right` (the new data) against `left` (the data in the database) on the
+        primary key of table and return the differences as a `ChangeSet`.
+
+        Rows of `right` without a key, or with a key that isn't in `left`, are inserts.
+        Keys that are only in `left` are deletes. For keys in both, a hash of the non key
+        columns decides whether the row changed, and only the changed columns are updated.
+
+        For tables with a row version, the updates and deletes carry the version their rows
+        were read at (from `right` for updates, `left` for deletes), so rows changed by
+        someone else since are reported as conflicts rather than overwritten. read_version is
+        the version of the table when `right` was read (see `table_version()`), rows of
+        `left` written after it were added or changed by someone else and aren't deleted."""
+        pk = DBManager.get_table(table)["primary"]
+        version_col = DBManager.get_table(table).get("version")
+        table_cols = DBManager.get_table_cols(table)
+
+        right = right[[col for col in table_cols if col in right]]
+        cols = [col for col in right.columns if col not in (pk, version_col) and col in left]
+        versioned = version_col is not None and version_col in left
+
+        if pk not in right:
+            if len(right) > 0:
+                return ChangeSet(insert=right)
+            # No rows at all, so every row read is deleted.
+            right = pd.DataFrame({pk: pd.Series(dtype=np.int64)})
+
+        has_key = right[pk].notna()
+        right_keyed = right[has_key].copy()
+        right_keyed[pk] = pd.to_numeric(right_keyed[pk]).astype(np.int64)
+        right_keyed = right_keyed.drop_duplicates(subset=pk, keep="last")
+        right_keyed = right_keyed.set_index(pk, drop=False)
+
+        left_keyed = left.set_index(left[pk].astype(np.int64), drop=False)
+
+        in_left = right_keyed.index.isin(left_keyed.index)
+        df_insert = pd.concat([right[~has_key], right_keyed[~in_left]],
+                              ignore_index=True)
+        deleted = ~left_keyed.index.isin(right_keyed.index)
+        versions = {}
+        if versioned:
+            if read_version is not None:
+                deleted &= (left_keyed[version_col] <= read_version).to_numpy()
+            versions = dict(zip(left_keyed.index[deleted], left_keyed[version_col][deleted].astype(np.int64)))
+        delete_keys = left_keyed.index[deleted].tolist()
+
+        common = right_keyed.index[in_left]
+        if len(common) == 0 or not cols:
+            return ChangeSet(insert=df_insert, delete=delete_keys, versions=versions)
+
+        new = DBManager._comparable(right_keyed.loc[common, cols], table)
+        old = DBManager._comparable(left_keyed.loc[common, cols], table)
+
+        # Cheap per-row hashes first, then a per-column comparison of only the rows that differ.
+        row_changed = (pd.util.hash_pandas_object(new, index=False).to_numpy() !=
+                       pd.util.hash_pandas_object(old, index=False).to_numpy())
+        new = new[row_changed]
+        old = old[row_changed]
+
+        changed = ~((new == old) | (new.isna() & old.isna()))
+        changed = changed[changed.any(axis=1)]
+        if versioned and version_col in right:
+            read = right_keyed.loc[changed.index, version_col]
+            versions.update((key, int(version)) for key, version in read.items() if not pd.isna(version))
+
+        return ChangeSet(insert=df_insert,
+                         update=right_keyed.loc[changed.index, [pk] + cols].reset_index(drop=True),
+                         changed=changed.reset_index(drop=True),
+                         delete=delete_keys,
+                         versions=versions)
 
-            # Then, compare the the two and only take the ones that have differences
-            out_df = left_df.merge(df, how="outer", indicator="shared")
+    @staticmethod
+    def apply_changes(con, table, changes):
+        """Write a `ChangeSet` to table using the open connection con, without committing.
+        Deletes and updates are sent as `executemany` batches keyed on the primary key and
+        inserts go through `bulk_insert`. Returns the insert report extended with the
+        number of rows updated and deleted, and the row version they were written at.
+
+        For tables with a row version, every row written is stamped with a new version and
+        deleted rows leave a tombstone, see `changes_since()`. Rows the changes hold a
+        version for are only written if they are still at that version, otherwise
+        `ConflictError` is raised and the caller should roll back."""
+        pk = DBManager.get_table(table)["primary"]
+        version_col = DBManager.get_table(table).get("version")
+        param = DBManager.get_backend().param
+        cursor = DBManager.cursor(con)
+
+        version = DBManager.next_version(cursor, table)
+        versions = changes.versions if version_col else {}
+        if versions:
+            # The counter is locked by now, so no other writer of the table can slip in between.
+            conflicts = DBManager.row_conflicts(cursor, table, versions, deleted=changes.delete)
+            if conflicts:
+                raise ConflictError(table, conflicts)
+
+        if len(changes.delete) > 0:
+            sql_delete = f"DELETE FROM `{table}` WHERE `{pk}`={param}"
+            cursor.executemany(sql_delete, [(key,) for key in changes.delete])
+            if version_col:
+                cursor.executemany(f"INSERT INTO `tombstones` (`table_name`, `row_id`, `row_version`) "
+                                   f"VALUES ({param},{param},{param})",
+                                   [(table, int(key), version) for key in changes.delete])
+
+        if len(changes.update) > 0:
+            update = DBManager.to_db_frame(changes.update, table)
+            cols = list(changes.changed.columns)
+            bits = 1 << np.arange(len(cols), dtype=np.int64)
+            patterns = changes.changed.to_numpy() @ bits
+
+            # One statement per combination of changed columns, only those columns are SET.
+            for pattern in np.unique(patterns):
+                set_cols = [col for bit, col in enumerate(cols)
+                            if (int(pattern) >> bit) & 1 and col != version_col]
+                rows = DBManager.df_to_rows(
+                    update.loc[patterns == pattern, set_cols + [pk]])
+                if version_col:
+                    set_cols.append(version_col)
+                    rows = [row[:-1] + (version,) + row[-1:] for row in rows]
+
+                sql_update = (f"UPDATE `{table}` SET " +
+                              ",".join(f"`{col}`={param}" for col in set_cols) +
+                              f" WHERE `{pk}`={param}")
+                cursor.executemany(sql_update, rows)
+
+        report = DBManager.bulk_insert(cursor, table, changes.insert, version=version)
+        report["updated"] = len(changes.update)
+        report["deleted"] = len(changes.delete)
+        report["version"] = version
+        return report
 
-            df_insert = out_df[out_df["shared"] == "right_only"].copy()
-            df_delete = out_df[out_df["shared"] == "left_only"].copy()
+    @staticmethod
+    def _comparable(df, table):
+        """Normalise the columns of df so values read from the database and values edited
+        in the GUI compare equal, ie numbers as floats and everything else as strings."""
+        table_cols = DBManager.get_table_cols_dict(table)
+        out = {}
+        for col in df.columns:
+            series = df[col]
+            if table_cols[col].is_numeric():
+                series = pd.to_numeric(series, errors="coerce").astype(np.float64)
+                scale = table_cols[col].get_scale()
+                if scale is not None:
+                    series = series.round(scale)
+            else:
+                series = series.astype(str).where(series.notna(), None)
+            out[col] = series
+        return pd.DataFrame(out, index=df.index)
 
-            out_df = out_df.drop(["shared"], axis=1)
-            df_insert = df_insert.drop(["shared"], axis=1)
-            df_delete = df_delete.drop(["shared"], axis=1)
+    @staticmethod
+    def get_foreign(table):
+        """Get the foreign key of table as a tuple of (column, referenced table, referenced column),
+        or None if it doesn't have one."""
+        return foreign_key(DBManager.get_table(table))
 
-            if len(out_df) == 0:
-                tkMessageBox.showinfo(title="DataBase Update Complete",
-                                      message="Nothing was added to the DB as no changes were detected between the different datasets.")
-                return
+    @staticmethod
+    def get_label_lookup(table, cached=True):
+        """Get a dict mapping the `label` of each row of table (eg a category title) to its primary key.
+        Only the two columns are read, through the query cache unless cached is False, see `query()`."""
+        current_table = DBManager.get_table(table)
+        data_df = DBManager.query(table, columns=[current_table["primary"], current_table["label"]],
+                                  cached=cached)
 
-            current_table = DBManager.get_table(db_table, cols_as_dict=True)
-            table_cols = current_table["fields"]
-            table_pk = current_table["primary"]
+        data_df = data_df[data_df[current_table["primary"]].notna()]
+        return dict(zip(data_df[current_table["label"]], data_df[current_table["primary"]]))
 
-            cols_insert = "`,`".join([str(i)
-                                      for i in df_insert.columns.tolist()])
-            sql_delete = f"DELETE FROM `{db_table}` WHERE {table_pk}=%s"
+    @staticmethod
+    def resolve_labels(df, table, label_column="category"):
+        """Fill in the foreign key column of df (eg `id_category`) from a column of labels (eg category
+        titles) with one dictionary lookup per row. Labels that the referenced table doesn't know yet
+        are inserted in bulk first. The label column is dropped, df is modified in place and returned."""
+        if label_column not in df:
+            return df
+
+        fk_col, ref_table, _ = DBManager.get_foreign(table)
+        ref = DBManager.get_table(ref_table)
+
+        if fk_col not in df:
+            df[fk_col] = np.nan
+        needs_key = (df[fk_col].isna() & df[label_column].notna()).to_numpy()
+
+        if needs_key.any():
+            # Read from the database, a cached lookup can miss the labels other clients added
+            # since, which would then be inserted again.
+            lookup = DBManager.get_label_lookup(ref_table, cached=False)
+            labels = df.loc[needs_key, label_column]
+
+            unknown = pd.unique(labels[~labels.isin(lookup.keys())])
+            if len(unknown) > 0:
+                new_df = pd.DataFrame({ref["label"]: unknown})
+                new_df.insert(0, ref["primary"],
+                              DBManager.insert_returning_ids(ref_table, new_df))
+                new_df = DBManager.apply_dtypes(new_df, ref_table)
+
+                lookup.update(zip(new_df[ref["label"]], new_df[ref["primary"]]))
+
+            df[fk_col] = df[fk_col].astype(object)
+            df.loc[needs_key, fk_col] = labels.map(lookup).to_numpy()
+            df[fk_col] = pd.to_numeric(df[fk_col])
+
+        df.drop(columns=[label_column], inplace=True)
+        return df
 
-            # try:
-            if len(df_insert) > 0:
-                for _, row in df_insert.iterrows():
-                    for index, value in row.iteritems():
-                        if pd.isna(value) and table_cols[index].can_self_generate():
-                            row = row.drop(index=[index])
-                            continue
-                        if type(value) == np.int64:
-                            row.loc[index] = int(value)
-                    # if not row.loc[table_pk] or pd.isna(row.loc[table_pk]):
-                    #     row = row.drop(index=[table_pk])
-                    # print(row)
-
-                    cols_insert = "`,`".join([str(i)
-                                              for i in row.index.tolist()])
-
-                    sql_insert = (f"INSERT INTO `{db_table}` (`" + cols_insert +
-                                  "`) VALUES (" + "%s," * (len(row.index)-1) + "%s)")
-                    cursor.execute(sql_insert, tuple(row))
-            if len(df_delete) > 0:
-                cursor.executemany(sql_delete, df_delete)
+    @staticmethod
+    def export_table(path, table="", columns=None, filters=None, search=None, format=None, compression=None,
+                     chunksize=None, progress=None):
+        """Stream the rows of table that match filters and search (see `filter_sql()`) to a
+        CSV, Parquet or XLSX file, chunk by chunk, so only one chunk is held in memory however
+        big the table is. See `exporters` for the writers.
+
+        columns is the list of columns to export (all by default), format one of
+        `exporters.writers` and compression one the writer supports, both taken from the
+        extension of path if not given, eg `stock.csv.gz`. The rows are written to a
+        temporary file that only replaces path once the export is complete. progress is
+        called after every chunk with (rows exported, rows to export). Returns a dict
+        describing the export."""
+        db_table = DBManager.get_crud_table(table)
+        table_cols = DBManager.get_table_cols_dict(db_table)
+        columns = list(columns or table_cols)
+        for column in columns:
+            if column not in table_cols:
+                raise ValueError(f"`{column}` is not a column of `{db_table}`.")
+
+        if format is None:
+            format, detected = exporters.detect_format(path)
+            compression = compression or detected
+        # Exports hold the values as the database does, see `to_db_frame()`.
+        dtypes = {name: table_cols[name].get_dtype() for name in columns}
+        where, params = DBManager.filter_sql(db_table, filters, search)
+        pk = DBManager.get_table(db_table)["primary"]
+
+        start = time.perf_counter()
+        total = DBManager.count_rows(db_table, filters, search) if progress is not None else None
+        report = {"path": path, "format": format, "compression": compression, "rows": 0, "chunks": 0}
+
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        writer = exporters.get_writer(format)(tmp_path, columns, dtypes, compression=compression)
+        try:
+            for chunk in DBManager.iter_dbdata(db_table, chunksize=chunksize, columns=columns, where=where,
+                                               params=params, order_by=f"`{pk}`"):
+                writer.write(DBManager.to_db_frame(chunk, db_table))
+                report["rows"] += len(chunk)
+                report["chunks"] += 1
+                if progress is not None:
+                    progress(report["rows"], total)
+        except BaseException:
+            writer.abort()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        writer.close()
+        os.replace(tmp_path, path)
+
+        report["seconds"] = time.perf_counter() - start
+        report["rows_per_sec"] = 0.0
+        if report["seconds"] > 0:
+            report["rows_per_sec"] = report["rows"] / report["seconds"]
+        return report
+
+    @staticmethod
+    def import_csv(path, table="", chunksize=None, progress=None, load_data=False, label_column="category"):
+        """Stream a CSV file into table chunk by chunk, so the file is never held in memory as a whole.
+
+        Each chunk is read with dtypes taken from the table's schema, rows missing required
+        values (or with values that aren't numbers in numeric columns) are rejected, labels are
+        resolved to foreign keys (see `resolve_labels()`) and the rows are written and committed.
+        Rows are written with `bulk_insert`, or with `LOAD DATA LOCAL INFILE` when load_data is
+        set, which needs the `local_infile` config. progress is called after every chunk with
+        (rows imported, bytes read, file size). Returns a dict describing the import."""
+        db_table = DBManager.get_crud_table(table)
+        chunksize = chunksize or DBManager.getconfig("import_chunk_size")
+        if load_data and not DBManager.getconfig("local_infile"):
+            raise ValueError(
+                "`LOAD DATA LOCAL INFILE` needs the `local_infile` config to be set.")
+        if load_data and not DBManager.get_backend().supports_load_data:
+            raise ValueError(
+                f"The `{DBManager.getconfig('backend')}` backend can't load data from files.")
+
+        table_cols = DBManager.get_table_cols_dict(db_table)
+        foreign = DBManager.get_foreign(db_table)
+        header = pd.read_csv(path, nrows=0).columns.tolist()
+
+        # Required columns must be in the file, a foreign key can be given by its label instead.
+        required = []
+        for name, col in table_cols.items():
+            if col.can_self_generate():
+                continue
+            if name in header:
+                required.append(name)
+            elif foreign and name == foreign[0] and label_column in header:
+                required.append(label_column)
+            else:
+                raise ValueError(
+                    f"`{path}` is missing the required column `{name}`.")
+
+        # Numbers are parsed by `pd.to_numeric` so that one bad value only rejects its row.
+        dtypes = {name: "object" for name in header}
+        numeric = [name for name in header
+                   if name in table_cols and table_cols[name].is_numeric()]
+
+        start = time.perf_counter()
+        total_bytes = os.path.getsize(path)
+        report = {"rows": 0, "rejected": 0, "chunks": 0,
+                  "method": "load_data" if load_data else "insert"}
+
+        with open(path, "rb") as csv_file, DBManager.open_connection() as con:
+            cursor = DBManager.cursor(con)
+
+            for chunk in pd.read_csv(csv_file, dtype=dtypes, chunksize=chunksize):
+                valid = chunk[required].notna().all(axis=1)
+                for name in numeric:
+                    values = pd.to_numeric(chunk[name], errors="coerce")
+                    valid &= values.notna() | chunk[name].isna()
+                    chunk[name] = values
+
+                report["rejected"] += int((~valid).sum())
+                chunk = chunk[valid]
+
+                if len(chunk) > 0:
+                    chunk = DBManager.apply_dtypes(chunk, db_table)
+                    if foreign:
+                        chunk = DBManager.resolve_labels(
+                            chunk, db_table, label_column=label_column)
+
+                    if load_data:
+                        DBManager.load_data_infile(cursor, db_table, chunk)
+                    else:
+                        DBManager.bulk_insert(cursor, db_table, chunk)
+                    con.commit()
+
+                report["rows"] += len(chunk)
+                report["chunks"] += 1
+                if progress is not None:
+                    progress(report["rows"], csv_file.tell(), total_bytes)
+
+        report["seconds"] = time.perf_counter() - start
+        report["rows_per_sec"] = 0.0
+        if report["seconds"] > 0:
+            report["rows_per_sec"] = report["rows"] / report["seconds"]
+        return report
+
+    @staticmethod
+    def import_csv_files(paths, table="", workers=None, dedup=True, progress=None, label_column="category"):
+        """Import many CSV files at once: the files are parsed, normalized and validated in
+        parallel on a pool of processes (see `batchimport`), merged, and written with one
+        `bulk_insert` in one transaction.
+
+        With dedup set, rows are deduplicated across (and within) the files on the table's
+        `dedup` columns, compared case insensitively, and the row from the file given last
+        is kept, eg a supplier's later file overrides their earlier one. A file that can't
+        be read or is missing a required column is reported without stopping the others.
+        progress is called with (files parsed, files). Returns a dict describing the import,
+        with the per file results in "files" and the failed files in "failed"."""
+        db_table = DBManager.get_crud_table(table)
+        table_cols = DBManager.get_table_cols_dict(db_table)
+        foreign = DBManager.get_foreign(db_table)
+        spec = batchimport.file_spec(table_cols, foreign, label_column=label_column)
+        workers = workers or DBManager.getconfig("import_workers")
+
+        start = time.perf_counter()
+        report = {"rows": 0, "rejected": 0, "duplicates": 0, "files": [], "failed": []}
+        parsed = {}
+        for path, df, rejected, err in batchimport.parse_files(list(paths), spec, workers=workers,
+                                                               progress=progress):
+            if err is not None:
+                report["failed"].append({"file": path, "error": str(err)})
+                continue
+            parsed[path] = df
+            report["rejected"] += rejected
+            report["files"].append({"file": path, "rows": len(df), "rejected": rejected})
+
+        # Files finish in any order, they are merged in the order they were given.
+        frames = [parsed[path] for path in paths if path in parsed]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if len(df) > 0:
+            with DBManager.stage("dtypes"):
+                df = DBManager.apply_dtypes(df, db_table)
+            if foreign:
+                df = DBManager.resolve_labels(df, db_table, label_column=label_column)
+
+            keys = [col for col in DBManager.get_table(db_table).get("dedup", ()) if col in df]
+            if dedup and keys:
+                normalized = pd.DataFrame({col: df[col] if pd.api.types.is_numeric_dtype(df[col].dtype)
+                                           else df[col].astype(object).str.casefold() for col in keys})
+                duplicated = normalized.duplicated(keep="last").to_numpy()
+                report["duplicates"] = int(duplicated.sum())
+                df = df[~duplicated]
+
+            with DBManager.open_connection() as con:
+                cursor = DBManager.cursor(con)
+                DBManager.bulk_insert(cursor, db_table, df)
+                con.commit()
+            report["rows"] = len(df)
+
+        report["seconds"] = time.perf_counter() - start
+        report["rows_per_sec"] = 0.0
+        if report["seconds"] > 0:
+            report["rows_per_sec"] = report["rows"] / report["seconds"]
+        return report
+
+    @staticmethod
+    def load_data_infile(cursor, table, df):
+        """Bulk load df into table through a temporary file and `LOAD DATA LOCAL INFILE`."""
+        table_cols = DBManager.get_table_cols_dict(table)
+        df = DBManager.to_db_frame(
+            df[[col for col in df.columns if col in table_cols]], table)
+        version_col = DBManager.get_table(table).get("version")
+        if version_col:
+            df = df.assign(**{version_col: DBManager.next_version(cursor, table)})
+
+        # LOAD DATA doesn't fall back on column defaults for \N, so fill those in here.
+        fill = {col: table_cols[col].default for col in df.columns
+                if table_cols[col].default is not None}
+        if fill:
+            df = df.fillna(value=fill)
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(fd, "w", newline="", encoding="utf-8") as tmp_file:
+                df.to_csv(tmp_file, header=False, index=False, na_rep="\\N")
+
+            cols = ",".join(f"`{col}`" for col in df.columns)
+            cursor.execute(f"""LOAD DATA LOCAL INFILE %s INTO TABLE `{table}`
+                CHARACTER SET utf8mb4
+                FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+                LINES TERMINATED BY %s ({cols})""", (tmp_path, os.linesep))
+        finally:
+            os.remove(tmp_path)
+
+    @staticmethod
+    def insert_returning_ids(table, df):
+        """Insert every row of df into table and return the auto increment ids they were given,
+        in the same order as the rows."""
+        with DBManager.open_connection() as con:
+            report = DBManager.bulk_insert(
+                DBManager.cursor(con), table, df, method="multirow")
             con.commit()
 
-            if (suppress == "success") or (suppress == "all"):
-                tkMessageBox.showinfo(title="Save Successful",
-                                      message="Save Completed Successfully!")
-            # except Exception as err:
-            #     con.rollback()
+        return report["ids"].astype(np.int64).tolist()
 
-            #     if (suppress == "error") or (suppress == "all"):
-            #         tkMessageBox.showerror(title="Save Failed",
-            #                                message=f"The data was not saved to the DB.\n{err}")
+    @staticmethod
+    def upsert(table, df, batch_size=None):
+        """Write every row of df to table, inserting new primary keys and updating the rows of
+        keys that already exist, in one transaction. Returns the number of rows written."""
+        batch_size = batch_size or DBManager.getconfig("insert_batch_size")
+        backend = DBManager.get_backend()
+        table_cols = DBManager.get_table_cols_dict(table)
+        pk = DBManager.get_table(table)["primary"]
+        if pk not in df or df[pk].isna().any():
+            raise ValueError(
+                f"Every row needs a `{pk}` to be upserted into `{table}`.")
+
+        db_df = DBManager.to_db_frame(
+            df[[col for col in df.columns if col in table_cols]], table)
+        version_col = DBManager.get_table(table).get("version")
+        if version_col:
+            # Stamped below, once the transaction has its version.
+            db_df = db_df.drop(columns=version_col, errors="ignore").assign(**{version_col: 0})
+        sql_upsert = backend.upsert_sql(table, list(db_df.columns), pk)
+        rows = DBManager.df_to_rows(db_df)
 
+        with DBManager.open_connection() as con:
+            cursor = DBManager.cursor(con)
+            if version_col:
+                version = DBManager.next_version(cursor, table)
+                rows = [row[:-1] + (version,) for row in rows]
+            for offset in range(0, len(rows), batch_size):
+                cursor.executemany(sql_upsert, rows[offset:offset + batch_size])
+            con.commit()
+        return len(rows)
+
+    @staticmethod
+    def df_to_rows(df):
+        """Convert a DataFrame into a list of tuples of native Python values, ready to be
+        passed to `cursor.execute`. Missing values (NaN, NaT, None) become None."""
+        with DBManager.stage("to_rows"):
+            columns = []
+            for col in df.columns:
+                series = df[col]
+                mask = series.isna().to_numpy()
+
+                if series.dtype == object:
+                    values = [v.item() if isinstance(v, np.generic) else v
+                              for v in series.to_numpy()]
+                else:
+                    # tolist() converts numpy scalars to python scalars in one pass.
+                    values = series.to_numpy(dtype=object if mask.any() else None).tolist()
+
+                for idx in np.flatnonzero(mask):
+                    values[idx] = None
+                columns.append(values)
+
+            return list(zip(*columns))
 
-if __name__ == "__main__":
-    import test
+    @staticmethod
+    def add_stock(cursor, table, deltas, column=None, batch_size=None):
+        """Add to the stock of products atomically, ie `stock_available = stock_available + delta`
+        in the database, so concurrent changes from elsewhere are never overwritten.
+
+        deltas is a dict of key -> change in stock, where the key is a value of column (the
+        primary key by default, or another unique column such as the barcode). The rows are
+        updated in key order, so concurrent batches lock rows in the same order, with one
+        UPDATE per batch of keys. Nothing is committed. Returns the number of rows updated,
+        keys that match no product are skipped. The rows are stamped with a new row version,
+        so the change feed picks up the new stock, see `changes_since`."""
+        column = column or DBManager.get_table(table)["primary"]
+        if column not in DBManager.get_table_cols(table):
+            raise ValueError(f"`{column}` is not a column of `{table}`.")
+        backend = DBManager.get_backend()
+        # Each key takes three parameters, two in the CASE and one in the IN list, besides the version.
+        batch_size = min(batch_size or DBManager.getconfig("insert_batch_size"), (backend.max_params - 1) // 3)
+
+        items = sorted((DBManager.sql_value(key), int(delta)) for key, delta in deltas.items() if delta)
+        version_col = DBManager.get_table(table).get("version")
+        stamp, version = "", ()
+        if version_col and items:
+            stamp, version = f", `{version_col}` = {backend.param}", (DBManager.next_version(cursor, table),)
+
+        updated = 0
+        for offset in range(0, len(items), batch_size):
+            batch = items[offset:offset + batch_size]
+            cases = " ".join([f"WHEN {backend.param} THEN {backend.param}"] * len(batch))
+            keys = ",".join([backend.param] * len(batch))
+            cursor.execute(f"""UPDATE `{table}` SET `stock_available` = `stock_available` + CASE `{column}` {cases} END{stamp}
+                               WHERE `{column}` IN ({keys})""",
+                           tuple(value for item in batch for value in item) + version + tuple(key for key, _ in batch))
+            updated += max(cursor.rowcount or 0, 0)
+        return updated
+
+    @staticmethod
+    def bulk_insert(cursor, table, df, batch_size=None, method=None, version=None):
+        """Insert every row of df into table using batched statements.
+
+        Rows are grouped by which self generating columns (see `DBColumn.can_self_generate`)
+        are null, those columns are left out of the INSERT so the database fills them in.
+        Each group is sent in batches of `batch_size` rows, either as a single multi-row
+        `INSERT ... VALUES (...),(...)` or through `cursor.executemany`.
+        Returns a dict with the number of rows, statements sent, rows per second and the
+        primary key given to each row as a Series `ids` aligned with df (NaN where the key
+        isn't known, ie for auto increment keys inserted with `executemany`). The rows of
+        tables with a row version are stamped with version, or a new one, see `next_version`."""
+        batch_size = batch_size or DBManager.getconfig("insert_batch_size")
+        method = method or DBManager.getconfig("insert_method")
+        if method not in ("multirow", "executemany"):
+            raise ValueError(f"Unknown insert method `{method}`.")
+        backend = DBManager.get_backend()
+
+        start = time.perf_counter()
+        report = {"rows": 0, "statements": 0}
+
+        table_cols = DBManager.get_table_cols_dict(table)
+        pk = DBManager.get_table(table)["primary"]
+        df = DBManager.to_db_frame(
+            df[[col for col in df.columns if col in table_cols]], table)
+        ids = np.full(len(df), np.nan)
+        version_col = DBManager.get_table(table).get("version")
+        if version_col and len(df) > 0:
+            df = df.assign(**{version_col: version or DBManager.next_version(cursor, table)})
+
+        if len(df) > 0:
+            # Encode which self generating columns are null in each row as a bit mask.
+            optional = [col for col in df.columns
+                        if table_cols[col].can_self_generate()]
+            if optional:
+                bits = 1 << np.arange(len(optional), dtype=np.int64)
+                patterns = df[optional].isna().to_numpy() @ bits
+            else:
+                patterns = np.zeros(len(df), dtype=np.int64)
+
+            for pattern in np.unique(patterns):
+                dropped = {col for bit, col in enumerate(optional)
+                           if (int(pattern) >> bit) & 1}
+                cols = [col for col in df.columns if col not in dropped]
+                positions = np.flatnonzero(patterns == pattern)
+                rows = DBManager.df_to_rows(df.iloc[positions][cols])
+
+                cols_insert = "`,`".join(cols)
+                row_params = "(" + ",".join([backend.param] * len(cols)) + ")"
+                sql_insert = f"INSERT INTO `{table}` (`{cols_insert}`) VALUES "
+
+                # A multi-row statement can't have more parameters than the backend allows.
+                group_batch = batch_size
+                if method == "multirow":
+                    group_batch = max(1, min(batch_size, backend.max_params // len(cols)))
+
+                for offset in range(0, len(rows), group_batch):
+                    batch = rows[offset:offset + group_batch]
+                    if method == "executemany":
+                        cursor.executemany(sql_insert + row_params, batch)
+                    else:
+                        cursor.execute(sql_insert + ",".join([row_params] * len(batch)),
+                                       [value for row in batch for value in row])
+                        first_id = backend.first_insert_id(cursor, len(batch))
+                        if pk not in cols and first_id:
+                            ids[positions[offset:offset + len(batch)]] = np.arange(
+                                first_id, first_id + len(batch))
+                    report["statements"] += 1
+
+                if pk in cols:
+                    ids[positions] = df[pk].iloc[positions].to_numpy(dtype=np.float64)
+                report["rows"] += len(rows)
+
+        report["ids"] = pd.Series(ids, index=df.index)
+        report["seconds"] = time.perf_counter() - start
+        report["rows_per_sec"] = 0.0
+        if report["seconds"] > 0:
+            report["rows_per_sec"] = report["rows"] / report["seconds"]
+        return report
@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import queue
+import threading
+
+
+class JobCancelled(Exception):
+    """Raised inside a job by `Job.check_cancelled()` once the job has been cancelled."""
+
+
+class Job(object):
+    """A unit of work submitted to a `DBWorker`, similar to a future.
+
+    Callbacks added to a job are run on the thread that calls `DBWorker.run_callbacks()`,
+    ie the Tk thread, so they may touch widgets."""
+
+    def __init__(self, worker, key=None, label=""):
+        self.key = key
+        self.label = label
+        self.progress_value = None
+        self.progress_maximum = None
+
+        self._worker = worker
+        self._future = None
+        # The (fn, args, kwargs) the job runs, see `DBWorker.submit`.
+        self._call = None
+        self._cancel = threading.Event()
+        self._on_done = []
+        self._on_error = []
+        self._on_progress = []
+        self._on_cancel = []
+
+    def add_callbacks(self, on_done=None, on_error=None, on_progress=None, on_cancel=None):
+        with self._worker._lock:
+            if on_done is not None:
+                self._on_done.append(on_done)
+            if on_error is not None:
+                self._on_error.append(on_error)
+            if on_progress is not None:
+                self._on_progress.append(on_progress)
+            if on_cancel is not None:
+                self._on_cancel.append(on_cancel)
+
+    def cancel(self):
+        """Cancel the job. A job that hasn't started won't run, a running job stops
+        the next time it calls `check_cancelled()` or `progress()`."""
+        self._cancel.set()
+        if self._future is not None:
+            self._future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f"`{self.label or self.key}` was cancelled.")
+
+    def progress(self, value, maximum=None):
+        """Report the progress of the job from inside it, this is also a cancellation point."""
+        self.check_cancelled()
+        self.progress_value = value
+        self.progress_maximum = maximum
+        for callback in list(self._on_progress):
+            self._worker.call_soon(callback, value, maximum)
+
+    def done(self):
+        return self._future is not None and self._future.done()
+
+    def result(self, timeout=None):
+        return self._future.result(timeout)
+
+
+class DBWorker(object):
+    """Runs blocking work, such as `DBManager` calls, on a pool of background threads.
+
+    Jobs submitted with the same key while one is still pending or running are
+    coalesced into that job if they make the same call, a different call isn't run. Completion, error and progress callbacks are queued and
+    run by `run_callbacks()`, which the GUI calls from its mainloop through `after()`."""
+
+    def __init__(self, workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="dbworker")
+        self._callbacks = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._keys = {}
+
+    def submit(self, fn, *args, key=None, label="", on_done=None, on_error=None, on_progress=None,
+               on_cancel=None, pass_job=False, **kwargs):
+        """Run fn(*args, **kwargs) in the background and return its `Job`.
+        on_cancel is called without arguments if the job is cancelled before it finishes.
+        If pass_job is set, the job is passed to fn as the `job` keyword argument.
+
+        While a job with the same key is pending or running, the same call joins that job,
+        its callbacks get the job's result. Any other call is dropped and None is returned,
+        so callers should check `is_busy()` first rather than lose work."""
+        call = (fn, args, dict(kwargs))
+        with self._lock:
+            existing = self._keys.get(key) if key is not None else None
+            if existing is not None:
+                if not self._same_call(existing._call, call):
+                    return None
+                job = existing
+            else:
+                job = Job(self, key=key, label=label)
+                job._call = call
+                self._jobs.append(job)
+                if key is not None:
+                    self._keys[key] = job
+
+        job.add_callbacks(on_done, on_error, on_progress, on_cancel)
+        if existing is not None:
+            return job
+
+        if pass_job:
+            kwargs["job"] = job
+        job._future = self._executor.submit(self._run, job, fn, args, kwargs)
+        job._future.add_done_callback(
+            lambda future: self._finished(job, future))
+        return job
+
+    def call_soon(self, fn, *args):
+        """Queue fn(*args) to be run by `run_callbacks()`, safe to call from any thread."""
+        self._callbacks.put((fn, args))
+
+    def run_callbacks(self):
+        """Run every queued callback, this must be called from the GUI thread."""
+        while True:
+            try:
+                fn, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                return
+            fn(*args)
+
+    def active_jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def is_busy(self, key=None):
+        with self._lock:
+            if key is None:
+                return len(self._jobs) > 0
+            return key in self._keys
+
+    def cancel_all(self):
+        for job in self.active_jobs():
+            job.cancel()
+
+    def shutdown(self, wait=True):
+        self.cancel_all()
+        self._executor.shutdown(wait=wait)
+
+    @staticmethod
+    def _same_call(call, other):
+        try:
+            return bool(call == other)
+        except (TypeError, ValueError):
+            # Arguments such as DataFrames don't compare to a single bool, only the same objects match.
+            return False
+
+    @staticmethod
+    def _run(job, fn, args, kwargs):
+        job.check_cancelled()
+        return fn(*args, **kwargs)
+
+    def _finished(self, job, future):
+        with self._lock:
+            self._jobs.remove(job)
+            if self._keys.get(job.key) is job:
+                del self._keys[job.key]
+            on_done = list(job._on_done)
+            on_error = list(job._on_error)
+            on_cancel = list(job._on_cancel)
+
+        if future.cancelled() or isinstance(future.exception(), JobCancelled):
+            for callback in on_cancel:
+                self.call_soon(callback)
+            return
+
+        error = future.exception()
+        if error is not None:
+            for callback in on_error:
+                self.call_soon(callback, error)
+        else:
+            result = future.result()
+            for callback in on_done:
+                self.call_soon(callback, result)
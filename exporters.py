@@ -0,0 +1,192 @@
+"""Writers for `DBManager.export_table`, which streams the rows of a table to a file.
+
+A writer is created with the path, columns and pandas dtypes of the export, is handed
+the rows one chunk at a time and only ever holds the chunk it is writing, so an export
+takes the same memory however big the table is. pyarrow (Parquet) and openpyxl (XLSX)
+are only imported once a file of their format is written."""
+import bz2
+import gzip
+import lzma
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ExportWriter(object):
+    """Writes chunks of rows to a file of one format.
+
+    path str The file to write,
+    columns list The columns of the rows, in order,
+    dtypes dict The pandas dtype of each column, see `DBColumn.get_dtype`,
+    compression str The compression of the file (optional, see `compressions`)."""
+    # The file extensions of the format, see `detect_format()`.
+    extensions = ()
+    # The compressions the format supports, besides None.
+    compressions = ()
+
+    def __init__(self, path, columns, dtypes, compression=None):
+        if compression is not None and compression not in self.compressions:
+            raise ValueError(f"`{compression}` compression isn't supported for {self.extensions[0]} files, "
+                             f"expected one of {', '.join(self.compressions) or 'none'}.")
+        self.path = path
+        self.columns = list(columns)
+        self.dtypes = dtypes
+        self.compression = compression
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        """Finish the file, it holds the header even if no rows were written."""
+        raise NotImplementedError
+
+    def abort(self):
+        """Stop writing after a failure, the file is left incomplete."""
+        self.close()
+
+
+class CSVWriter(ExportWriter):
+    extensions = (".csv",)
+    compressions = ("gzip", "bz2", "xz")
+
+    _openers = {
+        None: open,
+        "gzip": gzip.open,
+        "bz2": bz2.open,
+        "xz": lzma.open
+    }
+
+    def __init__(self, path, columns, dtypes, compression=None):
+        ExportWriter.__init__(self, path, columns, dtypes, compression)
+        self.file = CSVWriter._openers[compression](path, "wt", newline="", encoding="utf-8")
+        pd.DataFrame(columns=self.columns).to_csv(self.file, index=False)
+
+    def write(self, chunk):
+        chunk.to_csv(self.file, header=False, index=False)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter(ExportWriter):
+    """Writes every chunk as a row group of its own, with a schema taken from the table's
+    column definitions rather than the first chunk, so a column that happens to be all
+    null in one chunk still has the same type in every row group."""
+    extensions = (".parquet", ".pq")
+    compressions = ("snappy", "gzip", "brotli", "zstd", "lz4")
+
+    def __init__(self, path, columns, dtypes, compression=None):
+        ExportWriter.__init__(self, path, columns, dtypes, compression)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as err:
+            raise ImportError("Parquet exports need pyarrow, install it with `pip install pyarrow`.") from err
+
+        self.pa = pa
+        self.schema = pa.schema([(col, ParquetWriter.arrow_type(pa, dtypes.get(col))) for col in self.columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression or "snappy")
+
+    @staticmethod
+    def arrow_type(pa, dtype):
+        dtype = str(dtype)
+        if dtype.lower().startswith(("int", "uint", "float")):
+            return pa.from_numpy_dtype(np.dtype(dtype.lower()))
+        if dtype.startswith("datetime64"):
+            return pa.timestamp("ns")
+        # Text, including categorical text, which is written as plain strings.
+        return pa.string()
+
+    def write(self, chunk):
+        for col in chunk.columns:
+            if isinstance(chunk[col].dtype, pd.CategoricalDtype):
+                chunk[col] = chunk[col].astype(object)
+        self.writer.write_table(self.pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
+
+
+class XLSXWriter(ExportWriter):
+    """Writes with openpyxl's write-only mode, which streams the rows to disk rather than
+    keeping the worksheet in memory. The rows go on as many sheets as they need, as a
+    sheet holds at most `max_rows` rows, header included."""
+    extensions = (".xlsx",)
+    # The file is a zip archive, it is always compressed.
+    compressions = ()
+    max_rows = 1048576
+
+    def __init__(self, path, columns, dtypes, compression=None, sheet="Data"):
+        ExportWriter.__init__(self, path, columns, dtypes, compression)
+        try:
+            from openpyxl import Workbook
+        except ImportError as err:
+            raise ImportError("XLSX exports need openpyxl, install it with `pip install openpyxl`.") from err
+
+        self.workbook = Workbook(write_only=True)
+        self.sheet_title = sheet
+        self.sheets = 0
+        self._new_sheet()
+
+    def _new_sheet(self):
+        self.sheets += 1
+        title = self.sheet_title if self.sheets == 1 else f"{self.sheet_title} ({self.sheets})"
+        self.sheet = self.workbook.create_sheet(title)
+        self.sheet.append(self.columns)
+        self.sheet_rows = 1
+
+    def write(self, chunk):
+        # openpyxl takes Python values, with None for empty cells.
+        values = chunk.astype(object).where(chunk.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            if self.sheet_rows >= XLSXWriter.max_rows:
+                self._new_sheet()
+            self.sheet.append(row)
+            self.sheet_rows += 1
+
+    def close(self):
+        self.workbook.save(self.path)
+
+    def abort(self):
+        # Saving would write out every row streamed so far, for a file that is thrown away.
+        self.workbook.close()
+
+
+# The formats `DBManager.export_table` can write.
+writers = {
+    "csv": CSVWriter,
+    "parquet": ParquetWriter,
+    "xlsx": XLSXWriter
+}
+
+# Compressed CSV files are recognised by the extension after `.csv`.
+_compression_extensions = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz"
+}
+
+
+def detect_format(path):
+    """Get the format and compression of an export from the extension of path, eg
+    ("csv", "gzip") for `stock.csv.gz`. Raises ValueError for unknown extensions."""
+    root, ext = os.path.splitext(path.lower())
+    compression = _compression_extensions.get(ext)
+    if compression is not None:
+        root, ext = os.path.splitext(root)
+        if ext != ".csv":
+            raise ValueError(f"Only CSV exports can be compressed by extension, not `{path}`.")
+
+    for name, writer in writers.items():
+        if ext in writer.extensions:
+            return name, compression
+    raise ValueError(f"Can't tell the format of `{path}` from its extension, "
+                     f"expected one of {', '.join(ext for writer in writers.values() for ext in writer.extensions)}.")
+
+
+def get_writer(name):
+    """Get the writer class of the format called name, see `writers`."""
+    if name not in writers:
+        raise ValueError(f"Unknown export format `{name}`, expected one of {', '.join(writers)}.")
+    return writers[name]
@@ -0,0 +1,277 @@
+import bisect
+import json
+import re
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is everything slower.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Rows looked at to estimate the bytes sent or received, see `estimate_bytes()`.
+BYTES_SAMPLE = 100
+
+_table_pattern = re.compile(
+    r"\b(?:FROM|INTO(?:\s+TABLE)?|UPDATE|TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?)\s+`?(\w+)`?", re.IGNORECASE)
+
+# Statement types that change the data or the schema of their table.
+WRITE_KINDS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "LOAD", "CREATE", "ALTER", "DROP", "TRUNCATE", "RENAME")
+
+
+def describe(sql):
+    """Get the statement type (eg SELECT) and the first table named in sql."""
+    words = sql.lstrip().split(None, 1)
+    kind = words[0].upper() if words else ""
+    match = _table_pattern.search(sql)
+    return kind, match.group(1) if match else ""
+
+
+def value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    return 8
+
+
+def estimate_bytes(rows):
+    """Estimate the size of a list of rows (tuples of values) from a sample of them, as
+    it would take too long to measure every value of a large read or write."""
+    if not rows:
+        return 0
+    sample = rows[:BYTES_SAMPLE]
+    size = sum(value_size(value) for row in sample for value in row)
+    return int(size * len(rows) / len(sample))
+
+
+class OperationStats(object):
+    """The counters of one kind of statement on one table, eg SELECTs from products."""
+
+    def __init__(self):
+        self.calls = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "round_trips": self.round_trips,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "total_ms": self.seconds * 1000,
+            "mean_ms": self.seconds * 1000 / self.calls if self.calls else 0.0,
+            "max_ms": self.max_seconds * 1000,
+            "histogram": dict(zip([f"<{bound}ms" for bound in LATENCY_BUCKETS_MS] +
+                                  [f">={LATENCY_BUCKETS_MS[-1]}ms"], self.histogram))
+        }
+
+
+class QueryStats(object):
+    """Collects the timings of every statement run through an `InstrumentedCursor`, keyed
+    by statement type and table, keeps the statements slower than the slow query threshold
+    and, when profiling, the time spent in each stage of the work around the statements."""
+
+    def __init__(self, slow_log_size=100):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operations = {}
+        self._stages = {}
+        self.slow = deque(maxlen=slow_log_size)
+
+    def record(self, kind, table, seconds, rows=0, nbytes=0, round_trips=1, calls=1):
+        with self._lock:
+            stats = self._operations.get((kind, table))
+            if stats is None:
+                stats = self._operations[(kind, table)] = OperationStats()
+            stats.calls += calls
+            stats.round_trips += round_trips
+            stats.rows += max(rows, 0)
+            stats.bytes += nbytes
+            stats.seconds += seconds
+            if calls:
+                stats.max_seconds = max(stats.max_seconds, seconds)
+                stats.histogram[bisect.bisect_right(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def record_slow(self, entry, log_path=None):
+        """Keep a slow statement, and append it to the file at log_path as a JSON line if given."""
+        with self._lock:
+            self.slow.append(entry)
+            if log_path:
+                with open(log_path, "a", encoding="utf-8") as log_file:
+                    log_file.write(json.dumps(entry) + "\n")
+
+    @contextmanager
+    def stage(self, name, enabled=True):
+        """Attribute the time spent in the block to the stage name. Stages nest, time spent
+        in an inner stage only counts towards the inner one."""
+        if not enabled:
+            yield
+            return
+
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        now = time.perf_counter()
+        if stack:
+            self._add_stage(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._add_stage(name, now - stack.pop()[1])
+            if stack:
+                stack[-1][1] = now
+
+    def _add_stage(self, name, seconds):
+        with self._lock:
+            self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    def operations(self):
+        """Get the counters of every operation as a list of dicts, slowest in total first."""
+        with self._lock:
+            out = [dict(kind=kind, table=table, **stats.to_dict())
+                   for (kind, table), stats in self._operations.items()]
+        return sorted(out, key=lambda op: op["total_ms"], reverse=True)
+
+    def stages(self):
+        """Get the milliseconds spent in each profiled stage."""
+        with self._lock:
+            return {name: seconds * 1000 for name, seconds in self._stages.items()}
+
+    def report(self):
+        with self._lock:
+            slow = list(self.slow)
+        return {"operations": self.operations(), "stages": self.stages(), "slow": slow}
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+            self._stages.clear()
+            self.slow.clear()
+
+
+class InstrumentedCursor(object):
+    """Wraps a DB-API cursor so every statement, and every fetch of its results, is
+    recorded in a `QueryStats`. Fetches are counted towards the statement that produced
+    the rows, as extra round trips, so streamed reads are timed as a whole.
+
+    slow_ms float Statements slower than this are kept as slow queries (None to disable),
+    slow_log str Path of a file the slow queries are appended to (optional),
+    profile bool Also count the time spent in the database towards the "database" stage,
+    on_write callable Called with the table of every statement of `WRITE_KINDS` once it has run
+    ("" if the table isn't known), eg to invalidate cached reads (optional)."""
+
+    def __init__(self, cursor, stats, slow_ms=None, slow_log=None, profile=False, on_write=None):
+        self._cursor = cursor
+        self._stats = stats
+        self._slow_ms = slow_ms
+        self._slow_log = slow_log
+        self._profile = profile
+        self._on_write = on_write
+        # [kind, table, sql, seconds, rows] of the last statement, its fetches add to it.
+        self._current = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        with self._stats.stage("database", self._profile):
+            result = self._cursor.execute(sql, params)
+        seconds = time.perf_counter() - start
+
+        kind, table = describe(sql)
+        rows = (self._cursor.rowcount or 0) if kind != "SELECT" else 0
+        nbytes = len(sql) + estimate_bytes([params] if params else [])
+        self._stats.record(kind, table, seconds, rows=rows, nbytes=nbytes)
+        self._finish_statement(kind, table, sql, seconds, rows)
+        return result
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        start = time.perf_counter()
+        with self._stats.stage("database", self._profile):
+            result = self._cursor.executemany(sql, seq_params)
+        seconds = time.perf_counter() - start
+
+        kind, table = describe(sql)
+        rows = self._cursor.rowcount
+        if rows is None or rows < 0:
+            rows = len(seq_params)
+        self._stats.record(kind, table, seconds, rows=rows,
+                           nbytes=len(sql) + estimate_bytes(seq_params))
+        self._finish_statement(kind, table, sql, seconds, rows)
+        return result
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        fetch = self._cursor.fetchmany
+        return self._fetch(lambda: fetch(size) if size is not None else fetch())
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall, last=True)
+
+    def _fetch(self, fetch, last=False):
+        start = time.perf_counter()
+        with self._stats.stage("database", self._profile):
+            result = fetch()
+        seconds = time.perf_counter() - start
+
+        if self._current is not None:
+            kind, table = self._current[0], self._current[1]
+            rows = result if isinstance(result, list) else ([result] if result is not None else [])
+            self._stats.record(kind, table, seconds, rows=len(rows),
+                               nbytes=estimate_bytes(rows), calls=0)
+            self._current[3] += seconds
+            self._current[4] += len(rows)
+            if last or not rows:
+                # The results are used up, so the statement is done.
+                self._check_slow(*self._current)
+                self._current = None
+        return result
+
+    def _finish_statement(self, kind, table, sql, seconds, rows):
+        if self._on_write is not None and kind in WRITE_KINDS:
+            self._on_write(table)
+
+        if self._current is not None:
+            self._check_slow(*self._current)
+            self._current = None
+
+        if kind == "SELECT":
+            # The time spent fetching the rows still has to be added.
+            self._current = [kind, table, sql, seconds, 0]
+        else:
+            self._check_slow(kind, table, sql, seconds, rows)
+
+    def _check_slow(self, kind, table, sql, seconds, rows):
+        if self._slow_ms is None or seconds * 1000 < self._slow_ms:
+            return
+
+        self._stats.record_slow({
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "kind": kind,
+            "table": table,
+            "ms": round(seconds * 1000, 3),
+            "rows": rows,
+            "sql": " ".join(sql.split())[:500]
+        }, self._slow_log)
+
+    def close(self):
+        if self._current is not None:
+            self._check_slow(*self._current)
+            self._current = None
+        return self._cursor.close()
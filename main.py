@@ -2,17 +2,20 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 from pandas.errors import ParserError
 from pandastable import Table, TableModel
-from dbmanager import DBManager
+from dbmanager import ConflictError, DBManager
+from dbworker import DBWorker
+from paging import Pager
 
 import matplotlib
 import matplotlib.pyplot as plt
 import math
-import MySQLdb
 import numpy as np
 import os.path
 import pandas as pd
+import threading
 import tkinter as tk
 import tkinter.font as tkfont
+import tkinter.ttk as ttk
 import tkinter.messagebox as tkMessageBox
 import tkinter.filedialog as tkFileDialog
 import tkinter.simpledialog as tkSimpleDialog
@@ -24,7 +27,8 @@ matplotlib.use("TkAgg")
 class Application (tk.Tk):
     def __init__(self):
         tk.Tk.__init__(self)
-        DBManager.store_data("products_data", DBManager.get_dbdata())
+        self.worker = DBWorker()
+        DBManager.set_notifier(self.notify)
 
         self.fonts = {
             "title": tkfont.Font(family="Lucida Grande", size=24)
@@ -38,6 +42,37 @@ class Application (tk.Tk):
         self.visible_idx = -1
         self.set_tab(0)
 
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.poll_worker()
+        # Show the window straight away with the first page of the local snapshot of the
+        # table, if there is one, while the first page is read from the DB in the background.
+        self.tabs[0].show_snapshot()
+        self.tabs[0].refresh_table_data(suppress_warning=True)
+
+    def poll_worker(self):
+        """Run the callbacks of finished background jobs on the Tk thread and update the progress indicators."""
+        self.worker.run_callbacks()
+
+        jobs = self.worker.active_jobs()
+        for tab in self.tabs:
+            tab.update_progress(jobs)
+
+        self.after(50, self.poll_worker)
+
+    def notify(self, kind, title, message):
+        """Show a message from DBManager, moving it onto the Tk thread if needed."""
+        if threading.current_thread() is not threading.main_thread():
+            self.worker.call_soon(self.notify, kind, title, message)
+        elif kind == "error":
+            tkMessageBox.showerror(title=title, message=message)
+        else:
+            tkMessageBox.showinfo(title=title, message=message)
+
+    def close(self):
+        self.worker.shutdown(wait=False)
+        DBManager.close_pools()
+        self.destroy()
+
     def create_widgets(self):
         self.rowconfigure(index=2, weight=1)
         self.columnconfigure(index=0, weight=1)
@@ -92,6 +127,74 @@ class Application (tk.Tk):
                     self.tabs[idx].hide()
 
 
+class TrackedTableModel(TableModel):
+    """A pandastable TableModel that reports edits to a `ChangeTracker`, so that saving
+    only has to send the rows that changed."""
+
+    def __init__(self, dataframe=None, tracker=None, **kwargs):
+        TableModel.__init__(self, dataframe, **kwargs)
+        self.tracker = tracker
+
+    def setValueAt(self, value, row, col, df=None):
+        if df is None:
+            try:
+                value = self.coerce_value(value, col)
+            except (TypeError, ValueError) as e:
+                tkMessageBox.showerror(title="Invalid Value",
+                                       message=f"The value could not be set.\n{e}")
+                return False
+
+        changed = TableModel.setValueAt(self, value, row, col, df=df)
+        if changed and df is None and self.tracker is not None:
+            pk = self.tracker.pk
+            key = self.df.iloc[row][pk] if pk in self.df else None
+            column, value = self.df.columns[col], self.df.iat[row, col]
+
+            self.tracker.record_edit(key, column, value)
+        return changed
+
+    def coerce_value(self, value, col):
+        """Convert an entered value to the compact dtype of its column, which pandastable
+        doesn't know how to cast to (see `DBColumn.get_dtype`)."""
+        if value == "" or pd.isna(value):
+            return value
+
+        series = self.df.iloc[:, col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            if value not in series.cat.categories:
+                self.df[self.df.columns[col]] = series.cat.add_categories([value])
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            value = int(float(value))
+        elif pd.api.types.is_float_dtype(series.dtype):
+            value = float(value)
+        return value
+
+    def autoAddRows(self, num):
+        TableModel.autoAddRows(self, num)
+        self._touch()
+
+    def insertRow(self, row):
+        idx = TableModel.insertRow(self, row)
+        self._touch()
+        return idx
+
+    def deleteRows(self, rowlist=None, unique=True):
+        TableModel.deleteRows(self, rowlist, unique)
+        self._touch()
+
+    def deleteCells(self, rows, cols):
+        TableModel.deleteCells(self, rows, cols)
+        if self.tracker is not None and self.tracker.pk in self.df:
+            keys = self.df.iloc[rows][self.tracker.pk]
+            for col in self.df.columns[cols]:
+                for key in keys:
+                    self.tracker.record_edit(key, col, np.nan)
+
+    def _touch(self):
+        if self.tracker is not None:
+            self.tracker.touch()
+
+
 class DataFrame(tk.Frame):
     label = "View Data"
 
@@ -100,14 +203,33 @@ class DataFrame(tk.Frame):
         self.columnconfigure(index=0, weight=1)
         self.rowconfigure(index=1, weight=1)
 
+        self.worker = self.winfo_toplevel().worker
+        # Set when Save is clicked while a save is running, so one more save follows it.
+        self.save_pending = False
+        # The table is shown a page at a time, only the pages looked at are read from the DB.
+        self.pager = Pager(DBManager.get_crud_table())
+        # The direction pages are read ahead in, the way the user last moved.
+        self.travel = "after"
+        # The row version the pages are up to date with, see `poll_changes`.
+        self.feed_version = None
+        # Set until the local snapshot shown on startup has been brought up to date, see `show_snapshot`.
+        self.snapshot_stale = True
+        # The (request, offset) to reload once the running reload is done, see `reload_page`.
+        self.pending_reload = None
+
         self.create_widgets()
+        self.poll_changes()
+
+    @property
+    def tracker(self):
+        return self.pager.current.tracker
 
     def show(self):
         self.tkraise()
         return True
 
     def hide(self):
-        DBManager.store_data("products_data", self.data_table.model.df)
+        pass
 
     def create_widgets(self):
         # Create buttons to manage the DB.
@@ -126,26 +248,254 @@ class DataFrame(tk.Frame):
             self.toolbar, text="Import Data from CSV", command=self.import_csv)
         self.refresh_button = tk.Button(
             self.toolbar, text="Refresh Data from DB", command=self.refresh_table_data)
+        self.queries_button = tk.Button(
+            self.toolbar, text="Query Stats", command=lambda: QueryStatsWindow(self))
+
+        # Progress of background DB jobs, only shown while there are jobs running.
+        self.status_label = tk.Label(self.toolbar, text="")
+        self.progress_bar = ttk.Progressbar(
+            self.toolbar, length=160, mode="indeterminate")
+        self.cancel_button = tk.Button(
+            self.toolbar, text="Cancel", command=self.worker.cancel_all)
 
         self.save_button.grid(row=0, column=12)
         self.export_button.grid(row=0, column=11)
         self.import_button.grid(row=0, column=10)
         self.refresh_button.grid(row=0, column=9)
         self.addrow_button.grid(row=0, column=8)
+        self.queries_button.grid(row=0, column=7)
+        self.status_label.grid(row=0, column=0, sticky="W")
+        self.progress_bar.grid(row=0, column=1)
+        self.cancel_button.grid(row=0, column=2)
+        self.update_progress([])
 
         self.table_container = tk.Frame(self)
         self.table_container.grid(row=1, column=0, sticky="NSEW")
-        # Create table to display data
-        data_df = DBManager.retrieve_data("products_data")
-
-        self.data_table = Table(self.table_container, TableModel(data_df))
+        # Create table to display data, empty until the first page is read.
+        self.pager.current = self.pager.add(
+            self.pager.first(), DBManager.empty_df(DBManager.get_crud_table()))
+        self.data_table = Table(self.table_container,
+                                TrackedTableModel(self.pager.current.df, tracker=self.tracker))
         # self.data_table.autoResizeColumns()
         self.data_table.show()
 
+        # Create the controls to move between pages and sort the table.
+        self.pager_bar = tk.Frame(self)
+        self.pager_bar.grid(row=2, column=0, padx=12, pady=3, sticky="NSEW")
+        self.pager_bar.columnconfigure(index=4, weight=1)
+
+        self.first_button = tk.Button(
+            self.pager_bar, text="<< First", command=lambda: self.load_page(self.pager.first()))
+        self.previous_button = tk.Button(
+            self.pager_bar, text="< Previous", command=lambda: self.load_page(self.pager.previous()))
+        self.next_button = tk.Button(
+            self.pager_bar, text="Next >", command=lambda: self.load_page(self.pager.next()))
+        self.last_button = tk.Button(
+            self.pager_bar, text="Last >>", command=lambda: self.load_page(self.pager.last()))
+        self.rows_label = tk.Label(self.pager_bar, text="")
+
+        # Only columns without missing values can be sorted on, see `DBManager.get_page`.
+        sort_columns = [col.name for col in DBManager.get_table(DBManager.get_crud_table())["fields"]
+                        if not col.allow_nulls]
+        self.sort_column = tk.StringVar(value=self.pager.sort[0])
+        self.sort_descending = tk.BooleanVar(value=False)
+        self.sort_label = tk.Label(self.pager_bar, text="Sort by")
+        self.sort_box = ttk.Combobox(self.pager_bar, textvariable=self.sort_column,
+                                     values=sort_columns, state="readonly", width=16)
+        self.sort_box.bind("<<ComboboxSelected>>", lambda event: self.sort_table())
+        self.descending_check = tk.Checkbutton(self.pager_bar, text="Descending",
+                                               variable=self.sort_descending, command=self.sort_table)
+
+        self.first_button.grid(row=0, column=0)
+        self.previous_button.grid(row=0, column=1)
+        self.next_button.grid(row=0, column=2)
+        self.last_button.grid(row=0, column=3)
+        self.rows_label.grid(row=0, column=4)
+        self.sort_label.grid(row=0, column=5)
+        self.sort_box.grid(row=0, column=6)
+        self.descending_check.grid(row=0, column=7)
+
+        # Searching is done by the database, on the indexed columns of the table.
+        self.search_text = tk.StringVar()
+        self.search_label = tk.Label(self.pager_bar, text="Search")
+        self.search_entry = tk.Entry(self.pager_bar, textvariable=self.search_text, width=24)
+        self.search_entry.bind("<Return>", lambda event: self.search_table())
+        self.search_label.grid(row=0, column=8)
+        self.search_entry.grid(row=0, column=9)
+        self.update_pager()
+
     def add_row_to_table(self):
         num_rows = self.data_table.rows
         self.data_table.setSelectedRow(num_rows)
         self.data_table.addRow()
+        self.tracker.touch()
+
+    def update_progress(self, jobs):
+        # Jobs without a label, such as reading the next page ahead, run quietly.
+        jobs = [job for job in jobs if job.label]
+        widgets = (self.status_label, self.progress_bar, self.cancel_button)
+        if not jobs:
+            for widget in widgets:
+                widget.grid_remove()
+            return
+
+        for widget in widgets:
+            widget.grid()
+        self.status_label["text"] = ", ".join(
+            job.label for job in jobs) + "..."
+
+        # Show real progress if a job reports it, otherwise keep the bar moving.
+        measured = [job for job in jobs if job.progress_maximum]
+        if measured:
+            self.progress_bar.configure(mode="determinate", maximum=measured[0].progress_maximum,
+                                        value=measured[0].progress_value)
+        else:
+            self.progress_bar.configure(mode="indeterminate")
+            self.progress_bar.step(4)
+
+    def update_pager(self):
+        page = self.pager.current
+        if self.pager.count is None or len(page.df) == 0:
+            self.rows_label["text"] = "No rows"
+        else:
+            self.rows_label["text"] = f"Rows {page.offset + 1}-{page.offset + len(page.df)} of {self.pager.count}"
+
+        previous, following = self.pager.previous(), self.pager.next()
+        self.first_button["state"] = self.previous_button["state"] = "normal" if previous else "disabled"
+        self.next_button["state"] = self.last_button["state"] = "normal" if following else "disabled"
+
+    def job_failed(self, err):
+        tkMessageBox.showerror(title="DataBase Error",
+                               message=f"The database operation failed.\n{err}")
+
+    def sync_page(self):
+        # pandastable replaces the frame of its model on some edits, so keep the page's frame in step.
+        # While the snapshot is shown the model isn't a page's, see `show_snapshot`.
+        if self.pager.current is not None and self.data_table.editable:
+            self.pager.current.df = self.data_table.model.df
+
+    def load_page(self, request):
+        """Show the page of request, reading it from the DB in the background unless it's still kept."""
+        if request is None or self.worker.is_busy("page"):
+            return
+
+        self.sync_page()
+        base = self.pager.current
+        if request[1] in ("after", "before") and request[2] is not None:
+            self.travel = request[1]
+
+        page = self.pager.get(request)
+        if page is not None:
+            self.show_page(page)
+            return
+
+        self.worker.submit(DBManager.get_page, **self.pager.read_args(request), key="page", label="Loading data",
+                           on_done=lambda df: self.page_loaded(request, df, base),
+                           on_error=self.job_failed)
+
+    def page_loaded(self, request, df, base):
+        if request[0] != self.pager.sort:
+            # The sort order changed while the page was read.
+            return
+        if len(df) == 0 and request[2]:
+            # The rows after (or before) the page were deleted since the table was counted.
+            return
+
+        page = self.pager.get(request) or self.pager.add(request, df, base)
+        self.show_page(page)
+
+    def show_snapshot(self):
+        """Show the first page of the local snapshot of the table, read-only, until the page
+        read from the DB replaces it, see `DBManager.load_snapshot`."""
+        snapshot = DBManager.load_snapshot(self.pager.table)
+        if snapshot is None:
+            return
+
+        df = snapshot[0]
+        first = df.nsmallest(self.pager.page_size, self.pager.pk).reset_index(drop=True)
+        # Edits to rows that are about to be replaced would be lost, so none are allowed.
+        self.data_table.editable = False
+        self.data_table.updateModel(TableModel(first))
+        self.data_table.redraw()
+        self.rows_label["text"] = f"Rows 1-{len(first)} of {len(df)}, as last loaded"
+
+    def sync_snapshot(self):
+        """Bring the local snapshot up to date in the background, reading only the rows changed
+        since it was taken, so the next start shows them, see `DBManager.sync_snapshot`."""
+        self.snapshot_stale = False
+        # The snapshot is only a cache, so failing to write it isn't reported.
+        self.worker.submit(DBManager.sync_snapshot, self.pager.table, key="snapshot", label="Caching data")
+
+    def show_page(self, page):
+        self.pager.current = page
+        self.data_table.editable = True
+        self.data_table.updateModel(
+            TrackedTableModel(page.df, tracker=page.tracker))
+        self.data_table.redraw()
+        self.update_pager()
+        self.prefetch(page, DBManager.getconfig("page_prefetch"))
+
+    def prefetch(self, page, pages):
+        """Read up to pages pages ahead of page in the direction of travel, so paging on doesn't wait on the DB."""
+        if pages <= 0 or self.worker.is_busy("prefetch"):
+            return
+
+        request = self.pager.next(page) if self.travel == "after" else self.pager.previous(page)
+        if request is None:
+            return
+        ahead = self.pager.get(request)
+        if ahead is not None:
+            self.prefetch(ahead, pages - 1)
+            return
+
+        # Not labelled, so reading ahead doesn't show as a running job.
+        view = (self.pager.filters, self.pager.search)
+        self.worker.submit(DBManager.get_page, **self.pager.read_args(request), key="prefetch",
+                           on_done=lambda df: self.prefetched(request, view, df, page, pages))
+
+    def prefetched(self, request, view, df, base, pages):
+        if (request[0] != self.pager.sort or view != (self.pager.filters, self.pager.search)
+                or len(df) == 0 or self.pager.get(request) is not None):
+            return
+        self.prefetch(self.pager.add(request, df, base), pages - 1)
+
+    def sort_table(self):
+        sort = (self.sort_column.get(), self.sort_descending.get())
+        if sort == self.pager.sort:
+            return
+
+        self.sync_page()
+        busy = self.worker.is_busy("page") or self.worker.is_busy("refresh")
+        if not busy and self.pager.dirty:
+            # The pages with edits are kept by the current sort order, so they have to be saved first.
+            tkMessageBox.showinfo(title="Unsaved Changes",
+                                  message="Please save your changes before sorting the table.")
+        if busy or self.pager.dirty:
+            self.sort_column.set(self.pager.sort[0])
+            self.sort_descending.set(self.pager.sort[1])
+            return
+
+        self.pager.set_sort(sort)
+        self.travel = "after"
+        self.load_page(self.pager.first())
+
+    def search_table(self):
+        search = self.search_text.get().strip() or None
+        if search == self.pager.search:
+            return
+
+        self.sync_page()
+        busy = self.worker.is_busy("page") or self.worker.is_busy("refresh")
+        if not busy and self.pager.dirty:
+            tkMessageBox.showinfo(title="Unsaved Changes",
+                                  message="Please save your changes before searching the table.")
+        if busy or self.pager.dirty:
+            self.search_text.set(self.pager.search or "")
+            return
+
+        self.pager.set_filter(search=search)
+        self.travel = "after"
+        self.reload_page(self.pager.first())
 
     def refresh_table_data(self, suppress_warning=False):
         if not suppress_warning:
@@ -156,64 +506,256 @@ class DataFrame(tk.Frame):
             if res == tkMessageBox.NO:
                 return
 
-        data_df = DBManager.get_dbdata()
+        self.reload_page(self.pager.first())
+
+    def reload_page(self, request, offset=0):
+        """Forget every page and read the table's row count and the page of request again.
+        While a reload is running this one waits for it, and only the latest waiting one is read."""
+        if self.worker.is_busy("refresh"):
+            self.pending_reload = (request, offset)
+            return
+
+        view = (self.pager.filters, self.pager.search)
+        self.worker.submit(self.read_page, self.pager.read_args(request), key="refresh", label="Loading data",
+                           on_done=lambda result: self.reloaded(request, view, offset, *result),
+                           on_error=self.reload_failed,
+                           on_cancel=self.reload_cancelled)
+
+    def reload_waiting(self):
+        """Start the reload that waited for the one that just finished, returns True if there was one."""
+        if self.pending_reload is None:
+            return False
+        request, offset = self.pending_reload
+        self.pending_reload = None
+        self.reload_page(request, offset)
+        return True
 
-        DBManager.store_data("products_data", data_df)
-        self.data_table.updateModel(TableModel(data_df))
-        self.data_table.redraw()
+    def reload_failed(self, err):
+        if not self.reload_waiting():
+            self.job_failed(err)
+
+    def reload_cancelled(self):
+        self.pending_reload = None
+
+    @staticmethod
+    def read_page(args):
+        """Runs on a worker thread."""
+        version = None
+        if DBManager.get_table(args["table"]).get("version"):
+            # Taken first, so changes made while the page is read come with the next poll.
+            version = DBManager.table_version(args["table"])
+        return (DBManager.count_rows(args["table"], args["filters"], args["search"]), DBManager.get_page(**args),
+                version)
+
+    def reloaded(self, request, view, offset, count, df, version):
+        if self.reload_waiting():
+            # A later reload replaces this one.
+            return
+        if request[0] != self.pager.sort or view != (self.pager.filters, self.pager.search):
+            # The table was sorted or searched differently while the page was read.
+            return
+
+        self.feed_version = version
+        self.pager.clear()
+        self.pager.count = count
+        if len(df) == 0 and request[2]:
+            # The page's rows are gone, start from the top instead.
+            self.reload_page(self.pager.first())
+            return
+        self.show_page(self.pager.add(request, df, offset=offset if request[2] else None))
+        if self.snapshot_stale:
+            self.sync_snapshot()
+
+    def poll_changes(self):
+        """Merge the rows other clients changed into the pages kept, every `feed_poll_ms`,
+        reading only those rows rather than the page again, see `DBManager.changes_since`."""
+        interval = DBManager.getconfig("feed_poll_ms")
+        if not interval:
+            return
+        self.after(interval, self.poll_changes)
+        if self.feed_version is None or any(self.worker.is_busy(key) for key in ("feed", "refresh", "save")):
+            return
+
+        # Not labelled, so polling doesn't show as a running job. A failed poll is left to the next one.
+        since = self.feed_version
+        self.worker.submit(DBManager.changes_since, self.pager.table, since, key="feed",
+                           on_done=lambda result: self.changes_polled(since, *result))
+
+    def changes_polled(self, since, changed, deleted, version):
+        if since != self.feed_version:
+            # The page was read again in the meantime, with these changes.
+            return
+        self.feed_version = version
+        if len(changed) == 0 and not deleted:
+            return
+
+        self.sync_page()
+        unseen = self.pager.merge(changed, deleted)
+        page = self.pager.current
+        if unseen and not self.pager.dirty and not self.worker.is_busy("page"):
+            # New rows may belong on the page shown, and the row count has changed.
+            self.reload_page(page.request, page.offset)
+        else:
+            self.show_page(page)
 
     def export_data(self):
-        self.data_table.doExport()
+        """Export the rows of the table that match the search straight from the DB, in the
+        background, see `DBManager.export_table`."""
+        if self.worker.is_busy("export"):
+            tkMessageBox.showinfo(title="Export Data", message="An export is already running.")
+            return
+
+        self.sync_page()
+        if self.pager.dirty and not tkMessageBox.askyesno(
+                title="Export Data",
+                message="The table has unsaved changes, which are not exported.\nExport the saved data anyway?"):
+            return
+
+        path = tkFileDialog.asksaveasfilename(parent=self, defaultextension=".csv",
+                                              filetypes=[("CSV", "*.csv"), ("Compressed CSV", "*.csv.gz"),
+                                                         ("Parquet", "*.parquet"), ("Excel", "*.xlsx")])
+        if not path:
+            return
+
+        table, filters, search = self.pager.table, self.pager.filters, self.pager.search
+
+        def run(job):
+            return DBManager.export_table(path, table, filters=filters, search=search,
+                                          progress=lambda rows, total: job.progress(rows, total))
+
+        self.worker.submit(run, key="export", label="Exporting", pass_job=True,
+                           on_done=self.exported, on_error=self.export_failed)
+
+    def exported(self, report):
+        tkMessageBox.showinfo(title="Export Successful",
+                              message=f"Exported {report['rows']} rows to {report['path']} "
+                              f"({report['rows_per_sec']:.0f} rows/s).")
+
+    def export_failed(self, err):
+        tkMessageBox.showerror(title="Export Failed",
+                               message=f"The data could not be exported.\n{err}")
 
     def save_to_db(self):
-        products_df = self.data_table.model.df
-        update_categories(products_df)
-        if DBManager.isdataset("categories_data"):
-            DBManager.add_df_to_db(DBManager.retrieve_data(
-                "categories_data"), table="categories", suppress="success")
-
-        categories_df = DBManager.get_dbdata("categories")
-        DBManager.store_data("categories_data", categories_df)
-
-        if not "id_category" in products_df:
-            products_df["id_category"] = ""
-        for idx, row in products_df.iterrows():
-            if pd.isna(row.loc["id_category"]) and (row["category"]):
-                mask = categories_df["title"].values == row["category"]
-
-                if not categories_df[mask].empty:
-                    value = categories_df[mask].iloc[0]["id_category"]
-                    products_df.at[idx, "id_category"] = value
-        if "category" in products_df:
-            products_df.drop(columns=["category"], inplace=True)
-
-        DBManager.add_df_to_db(products_df)
-        self.refresh_table_data(suppress_warning=True)
+        if self.worker.is_busy("save"):
+            # Coalesce overlapping saves into a single save once the current one is done.
+            self.save_pending = True
+            return
+        self.save_pending = False
+
+        if self.worker.is_busy("refresh"):
+            tkMessageBox.showinfo(title="Loading Data",
+                                  message="The data is still being loaded from the DB, please save once it has loaded.")
+            return
+
+        # Every page with edits is saved, not only the one shown.
+        self.sync_page()
+        changes, page_changes = self.pager.changeset()
+
+        if changes.empty:
+            tkMessageBox.showinfo(title="DataBase Update Complete",
+                                  message="Nothing was saved to the DB as no changes were made since the data was loaded.")
+            return
+
+        # Edits made while the save runs are tracked for the next save.
+        for page, _ in page_changes:
+            page.tracker.reset(page.df)
+        self.worker.submit(self.write_changes, changes, key="save", label="Saving",
+                           on_done=lambda report: self.saved(page_changes, report),
+                           on_error=lambda err: self.save_failed(page_changes, err),
+                           on_cancel=lambda: self.save_cancelled(page_changes))
+
+    @staticmethod
+    def write_changes(changes):
+        """Runs on a worker thread."""
+        table = DBManager.get_crud_table()
+        # Only new rows can carry a category title that still has to be resolved to an id.
+        if len(changes.insert) > 0:
+            changes.insert = DBManager.resolve_labels(changes.insert.copy(), table)
+
+        report = DBManager.save_changes(changes)
+        if (report["updated"] or report["deleted"]) and report["version"] is None:
+            # Without row versions the snapshot only picks up new rows, so drop it rather than keep stale rows.
+            DBManager.get_snapshot_store().drop(table)
+        return report
+
+    def saved(self, page_changes, report):
+        # The next save of the same rows is checked against the version they were saved at.
+        self.pager.saved(page_changes, report["version"])
+        tkMessageBox.showinfo(title="Save Successful",
+                              message="Save Completed Successfully!\n"
+                              f"Inserted {report['rows']} rows, updated {report['updated']} and deleted {report['deleted']}.")
+
+        if report["rows"] > 0 or report["deleted"] > 0:
+            # New rows only get their ids from the database and the positions of the
+            # rows have moved, so read the page shown again.
+            self.save_pending = False
+            page = self.pager.current
+            self.reload_page(page.request, page.offset)
+        elif self.save_pending:
+            self.save_to_db()
+
+    def save_cancelled(self, page_changes):
+        # The save never ran, so its edits are unsaved again.
+        for page, changes in page_changes:
+            page.tracker.restore(changes)
+        self.save_pending = False
+
+    def save_failed(self, page_changes, err):
+        for page, changes in page_changes:
+            page.tracker.restore(changes)
+        self.save_pending = False
+        if isinstance(err, ConflictError):
+            overwrite = tkMessageBox.askyesno(
+                title="Save Conflict",
+                message=f"{err}\n\nSave your edits over their changes?\n"
+                "Choose No to keep your edits unsaved, eg to check their changes first.")
+            if overwrite:
+                for page, _ in page_changes:
+                    page.tracker.set_row_versions(dict.fromkeys(err.keys))
+                self.save_to_db()
+            return
+        tkMessageBox.showerror(title="Save Failed",
+                               message=f"The data was not saved to the DB.\n{err}")
 
     def import_csv(self, file=""):
         # Get file to import
         if file:
             input_file = file
         else:
-            input_file = tkFileDialog.askopenfilename()
-            if not input_file.strip():
+            input_files = tkFileDialog.askopenfilenames(filetypes=[("CSV", "*.csv"), ("All files", "*")])
+            if not input_files:
                 tkMessageBox.showerror(title="Import Failed",
                                        message="Import failed as no file was selected.")
                 return
+            if len(input_files) > 1:
+                # Several files, eg the morning's supplier files, go straight into the DB together.
+                self.import_files_to_db(input_files)
+                return
+            input_file = input_files[0]
+
+        direct = tkMessageBox.askyesno(title="Import Data",
+                                       message="Import the file straight into the DB?\n"
+                                       "Choose No to load it into the table, so it can be checked before saving.")
+        if direct:
+            self.import_csv_to_db(input_file)
+            return
 
         try:
             import_df = pd.read_csv(input_file)
         except ParserError:
             tkMessageBox.showerror(
                 message="The supplied file is not a valid CSV file, could not import.")
+            return
 
         if len(import_df) > 0:
-            # Data was loaded.
-            table_df = DBManager.retrieve_data("products_data")
-            table_df = table_df.append(import_df, ignore_index=False)
-
-            DBManager.store_data("products_data", table_df)
-            self.data_table.updateModel(TableModel(table_df))
+            # Data was loaded, it is added to the end of the page shown.
+            page = self.pager.current
+            page.df = pd.concat(
+                [self.data_table.model.df, import_df], ignore_index=False)
+
+            self.tracker.touch()
+            self.data_table.updateModel(
+                TrackedTableModel(page.df, tracker=self.tracker))
             self.data_table.columnwidths["id_product"] = 5
             self.data_table.redraw()
 
@@ -223,6 +765,56 @@ class DataFrame(tk.Frame):
             tkMessageBox.showinfo(title="Import Failed",
                                   message="Input file did not have any CSV data so no data was added.")
 
+    def import_csv_to_db(self, input_file):
+        """Stream a CSV file straight into the DB in the background, see `DBManager.import_csv`."""
+        if self.worker.is_busy("import"):
+            tkMessageBox.showinfo(title="Import Data", message="An import is already running.")
+            return
+
+        def run(job):
+            return DBManager.import_csv(input_file,
+                                        progress=lambda rows, done, total: job.progress(done, total))
+
+        self.worker.submit(run, key="import", label="Importing", pass_job=True,
+                           on_done=self.imported, on_error=self.import_failed)
+
+    def import_files_to_db(self, input_files):
+        """Import several CSV files into the DB in the background, parsed in parallel and
+        deduplicated, see `DBManager.import_csv_files`."""
+        if self.worker.is_busy("import"):
+            tkMessageBox.showinfo(title="Import Data", message="An import is already running.")
+            return
+
+        def run(job):
+            return DBManager.import_csv_files(input_files, progress=lambda done, total: job.progress(done, total))
+
+        self.worker.submit(run, key="import", label="Importing files", pass_job=True,
+                           on_done=self.files_imported, on_error=self.import_failed)
+
+    def files_imported(self, report):
+        self.imported(report)
+        if report["failed"]:
+            tkMessageBox.showerror(
+                title="Import Failed",
+                message=f"{len(report['failed'])} of the files could not be imported:\n" +
+                "\n".join(f"{os.path.basename(failed['file'])}: {failed['error']}" for failed in report["failed"]))
+
+    def import_failed(self, err):
+        tkMessageBox.showerror(title="Import Failed",
+                               message=f"The supplied file could not be imported.\n{err}")
+
+    def imported(self, report):
+        # Only ask before throwing away edits if there are any.
+        self.sync_page()
+        self.refresh_table_data(suppress_warning=not self.pager.dirty)
+
+        message = f"Imported {report['rows']} rows ({report['rows_per_sec']:.0f} rows/s)."
+        if report["rejected"]:
+            message += f"\n{report['rejected']} rows were missing values or had invalid numbers and were skipped."
+        if report.get("duplicates"):
+            message += f"\n{report['duplicates']} rows were duplicates of the same product and were skipped."
+        tkMessageBox.showinfo(title="Import Successful", message=message)
+
 
 class StatsFrame(tk.Frame):
     label = "View Stats"
@@ -233,89 +825,141 @@ class StatsFrame(tk.Frame):
         self.rowconfigure(index=0, weight=1)
         self.columnconfigure(index=0, weight=1)
 
-        f = self.get_plot_data()
-        if f:
-            self.plt_show(f)
+        self.worker = self.winfo_toplevel().worker
+        self.stats = None
 
-    def show(self):
-        f = self.get_plot_data()
-        if f:
-            self.plt_show(f)
-            self.tkraise()
-            return True
+        self.create_widgets()
 
-        tkMessageBox.showinfo(title="No Data",
-                              message="There are no statistics because there is no data loaded. Load data to view statistics tab.")
-        return False
+    def create_widgets(self):
+        # One figure and canvas for the lifetime of the tab, the axes are redrawn in place.
+        self.figure = Figure(figsize=(15, 5), dpi=100)
+        self.figure.subplots_adjust(bottom=.25)
+        self.axes = [self.figure.add_subplot(1, 3, idx) for idx in range(1, 4)]
 
-    def hide(self):
-        pass
+        self.canvas = FigureCanvasTkAgg(self.figure, self)
+        self.plot_widget = self.canvas.get_tk_widget()
+        self.plot_widget.grid(row=0, column=0, sticky="NSEW")
 
-    def plt_show(self, f):
-        """Method to add the matplotlib graph onto a tkinter window."""
-        canvas = self.plt_redraw(f)
+    def show(self):
+        # The last statistics are shown while the current ones are read from the DB.
+        self.tkraise()
+        self.worker.submit(self.get_plot_data, key="stats", label="Loading stats",
+                           on_done=self.stats_loaded, on_error=self.stats_failed)
+        return True
 
-        self.plot_widget = canvas.get_tk_widget()
-        self.plot_widget.grid(row=0, column=0, sticky="NSEW")
+    def hide(self):
+        pass
 
-    def plt_redraw(self, f):
-        canvas = FigureCanvasTkAgg(f, self)
-        canvas.draw()
+    def update_progress(self, jobs):
+        pass
 
-        for ax in f.get_axes():
+    def stats_loaded(self, stats):
+        if stats is None:
+            tkMessageBox.showinfo(title="No Data",
+                                  message="There are no statistics because there is no data in the DB.")
+            return
+
+        # Nothing was written since the last switch to this tab, keep the plots as they are.
+        if self.stats is not None and stats.equals(self.stats):
+            return
+
+        self.stats = stats
+        self.plt_show(stats)
+
+    def stats_failed(self, err):
+        tkMessageBox.showerror(title="DataBase Error",
+                               message=f"The statistics could not be read from the DB.\n{err}")
+
+    def plt_show(self, stats):
+        """Method to draw the statistics onto the axes of the matplotlib graph on the tkinter window."""
+        plots = (
+            ("count", "Number of Items per Category"),
+            ("stock_sum", "Total Number of Products per Category"),
+            ("price_mean", "Average Price of Products in Category")
+        )
+
+        for ax, (column, title) in zip(self.axes, plots):
+            ax.clear()
+            stats[column].plot(ax=ax, kind="bar", grid=True, title=title)
+            ax.set_xlabel("")
             for tick in ax.get_xticklabels():
                 tick.set_rotation(35)
-        return canvas
 
-    def get_plot_data(self):
-        # Get a data from datastore and import into pandas.DataFrame
-        # products_df = DBManager.get_dbdata()
-        # DBManager.store_data("products_data", products_df)
-        products_df = DBManager.retrieve_data("products_data")
+        self.canvas.draw_idle()
 
-        if len(products_df) == 0:
+    def get_plot_data(self):
+        """Runs on a worker thread."""
+        # The statistics are aggregated by the database, see `DBManager.query_category_stats`.
+        stats = DBManager.query_category_stats()
+        if len(stats) == 0:
             return None
+        return stats
 
-        # Create the matplotlib figure and axes that will be used to display the graphs for the statistics.
-        fig = Figure(figsize=(15, 5), dpi=100)
-
-        ax1 = fig.add_subplot(1, 3, 1)
-        ax2 = fig.add_subplot(1, 3, 2)
-        ax3 = fig.add_subplot(1, 3, 3)
-
-        fig.subplots_adjust(bottom=.25)
-
-        # Create different statistics and plot them the figure previously defined.
-        products_df.groupby(["id_category"]).size().plot(ax=ax1, y="stock_available", kind="bar", grid=True,
-                                                         title="Number of Items per Category")
-        products_df.groupby(["id_category"]).sum().plot(ax=ax2, y="stock_available", kind="bar", grid=True,
-                                                        title="Total Number of Products per Category")
-        products_df.groupby(["id_category"]).mean().plot(ax=ax3, y="stock_available", kind="bar", grid=True,
-                                                         title="Average Price of Products in Category")
 
-        return fig
+class QueryStatsWindow(tk.Toplevel):
+    """Shows `DBManager.query_report()`: the statements run per type and table, the time spent
+    in each profiled stage and the recent slow statements."""
+    columns = ("kind", "table", "calls", "round_trips", "rows", "bytes", "total_ms", "mean_ms", "max_ms")
 
+    def __init__(self, *args, **kwargs):
+        tk.Toplevel.__init__(self, *args, **kwargs)
+        self.title("Query Stats")
+        self.rowconfigure(index=1, weight=1)
+        self.columnconfigure(index=0, weight=1)
 
-def update_categories(df):
-    if "category" not in df:
-        return
-
-    if DBManager.isdataset("categories_data"):
-        catdf = DBManager.retrieve_data("categories_data")
-    else:
-        catdf = DBManager.get_dbdata("categories")
+        self.create_widgets()
+        self.refresh()
 
-    unknown_cats = df[~df["category"].isin(
-        catdf["title"])]["category"].to_frame().drop_duplicates()
+    def create_widgets(self):
+        buttons = tk.Frame(self)
+        buttons.grid(row=0, column=0, padx=12, pady=3, sticky="E")
+        tk.Button(buttons, text="Refresh", command=self.refresh).grid(row=0, column=0)
+        tk.Button(buttons, text="Reset", command=self.reset).grid(row=0, column=1)
+        tk.Button(buttons, text="Export Report", command=self.export).grid(row=0, column=2)
+
+        self.operations = ttk.Treeview(self, columns=self.columns, show="headings", height=10)
+        for column in self.columns:
+            self.operations.heading(column, text=column)
+            self.operations.column(column, width=90, anchor="e")
+        self.operations.grid(row=1, column=0, padx=12, sticky="NSEW")
+
+        self.details = tk.Text(self, height=12, width=110)
+        self.details.grid(row=2, column=0, padx=12, pady=6, sticky="NSEW")
+
+    def refresh(self):
+        report = DBManager.query_report()
+
+        self.operations.delete(*self.operations.get_children())
+        for op in report["operations"]:
+            self.operations.insert("", "end", values=[
+                f"{op[column]:.2f}" if isinstance(op[column], float) else op[column]
+                for column in self.columns])
+
+        cache = DBManager.cache_report()
+        lines = [f"Query cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_ratio']:.0%}), "
+                 f"{cache['entries']} results in {cache['bytes'] / 2 ** 20:.1f} of {cache['budget'] / 2 ** 20:.0f} MB, "
+                 f"{cache['evictions']} evicted, {cache['invalidations']} invalidated by writes."]
+        if report["stages"]:
+            lines.append("Time per stage: " + ", ".join(
+                f"{name} {ms:.1f} ms" for name, ms in sorted(report["stages"].items(), key=lambda item: -item[1])))
+        else:
+            lines.append("Set the `query_profiling` config to see the time spent per stage.")
+        lines.append(f"Slow statements (over {DBManager.getconfig('slow_query_ms')} ms):")
+        lines += [f"  {entry['time']} {entry['ms']:.1f} ms, {entry['rows']} rows: {entry['sql']}"
+                  for entry in reversed(report["slow"])]
 
-    unknown_cats.rename(columns={"category": "title"}, inplace=True)
+        self.details.delete("1.0", "end")
+        self.details.insert("1.0", "\n".join(lines))
 
-    if not unknown_cats.empty:
-        unknown_cats["id_category"] = np.nan
+    def reset(self):
+        DBManager.query_stats.reset()
+        self.refresh()
 
-        catdf = catdf.append(unknown_cats)
-        catdf["id_category"]
-        DBManager.store_data("categories_data", catdf)
+    def export(self):
+        path = tkFileDialog.asksaveasfilename(parent=self, defaultextension=".json",
+                                              filetypes=[("JSON", "*.json"), ("CSV", "*.csv")])
+        if path:
+            DBManager.export_query_report(path)
 
 
 def merge_dfs(df1, df2):
@@ -332,4 +976,3 @@ if __name__ == "__main__":
                    db="practice", table="products")
     app = Application()
     app.mainloop()
-    # import test
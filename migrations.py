@@ -0,0 +1,104 @@
+import hashlib
+import time
+
+
+def foreign_key(table):
+    """Get the foreign key of a table dict of `DBManager._tables` as a tuple of
+    (column, referenced table, referenced column), or None if it doesn't have one."""
+    foreign = table.get("foreign")
+    if not foreign:
+        return None
+
+    ref_table, ref_col = foreign[1].rstrip(")").split("(")
+    return foreign[0], ref_table.strip(" `"), ref_col.strip(" `")
+
+
+class Migrator(object):
+    """Brings the schema of a database in line with the table definitions of `DBManager`.
+
+    The live schema is read from the catalog of the database (see `Backend.describe_schema`)
+    and compared with the definitions, and only what is missing is added: tables, columns,
+    indexes and foreign keys. Duplicate foreign keys, left behind by older versions that
+    added the foreign keys on every start, are dropped. The changes to each table are made
+    in one statement where the backend allows it, see `Backend.alter_table_sql`.
+
+    The version of the definitions that was last applied is kept in the version table, so
+    when the definitions haven't changed a start only costs reading that one row.
+
+    tables list The table dicts of `DBManager._tables`,
+    version_table dict The definition of the table the applied version is kept in."""
+
+    def __init__(self, backend, tables, version_table):
+        self.backend = backend
+        self.tables = list(tables)
+        self.version_table = version_table
+
+    def version(self):
+        """Get a hash of the table definitions, which changes whenever a definition does."""
+        parts = []
+        for table in self.tables + [self.version_table]:
+            parts.append(f"{table['table']} {table['primary']} {table.get('foreign')}")
+            parts += [str(col) for col in table["fields"]]
+            parts += [str(index) for index in table.get("indexes", ())]
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def applied_version(self, cursor):
+        """Get the version that was last applied to the database, None if it was never migrated."""
+        try:
+            cursor.execute(f"SELECT `version` FROM `{self.version_table['table']}` "
+                           f"WHERE `{self.version_table['primary']}` = 1")
+        except self.backend.schema_errors():
+            # The version table doesn't exist yet.
+            return None
+
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def plan(self, cursor):
+        """Get the statements that add what is missing from the database, in the order to run them."""
+        tables = self.tables + [self.version_table]
+        live = self.backend.describe_schema(cursor, [table["table"] for table in tables])
+
+        creates, alters = [], []
+        for table in tables:
+            existing = live.get(table["table"])
+            changes = []
+
+            if existing is None:
+                creates.append(self.backend.create_table_sql(table))
+                existing = self.backend.created_schema(table)
+            else:
+                changes += [("column", col) for col in table["fields"]
+                            if col.name not in existing["columns"]]
+
+            changes += [("index", index) for index in table.get("indexes", ())
+                        if index.name not in existing["indexes"]]
+
+            foreign = foreign_key(table)
+            if foreign is not None:
+                names = existing["foreign"].get(foreign, [])
+                if not names:
+                    changes.append(("foreign", foreign))
+                # Keep the first of any duplicate constraints.
+                changes += [("drop_foreign", name) for name in names[1:]]
+
+            alters += self.backend.alter_table_sql(table, changes)
+
+        # Every table is created before any foreign key refers to it.
+        return creates + alters
+
+    def migrate(self, cursor):
+        """Apply the statements of `plan()` unless the current version was already applied,
+        and record the version. Returns the statements that were run."""
+        version = self.version()
+        if self.applied_version(cursor) == version:
+            return []
+
+        statements = self.plan(cursor)
+        for sql in statements:
+            cursor.execute(sql)
+
+        cols = [col.name for col in self.version_table["fields"]]
+        cursor.execute(self.backend.upsert_sql(self.version_table["table"], cols, self.version_table["primary"]),
+                       (1, version, time.strftime("%Y-%m-%d %H:%M:%S")))
+        return statements
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from dbmanager import ChangeSet, ChangeTracker, DBManager
+
+
+class Page(object):
+    """One page of a table, with its own `ChangeTracker` so edits survive paging away.
+
+    request tuple The (sort, direction, anchor) the page was read with, see `Pager.first()`,
+    offset int The position of the first row of the page in the sort order."""
+
+    def __init__(self, table, df, request, offset):
+        self.table = table
+        self.df = df
+        self.request = request
+        self.offset = offset
+        self.tracker = ChangeTracker(table, df)
+
+    @property
+    def dirty(self):
+        return self.tracker.dirty
+
+
+class Pager(object):
+    """Keeps the pages of a table that have been read, in sort order, and works out which
+    page to read next. Reading is left to the caller (eg on a background thread) through
+    `DBManager.get_page`, so the pager itself never touches the database.
+
+    Pages are looked up by the request that reads them: the page after the last row of
+    a page, or before the first row of a page. At most `cache_size` pages are kept, least
+    recently used first out, but pages with unsaved edits are never dropped."""
+
+    def __init__(self, table, page_size=None, cache_size=None):
+        self.table = table
+        self.page_size = page_size or DBManager.getconfig("page_size")
+        self.cache_size = cache_size or DBManager.getconfig("page_cache_size")
+        self.pk = DBManager.get_table(table)["primary"]
+
+        # (column, descending) the pages are sorted by.
+        self.sort = (self.pk, False)
+        # The filters and search the rows are limited to, see `DBManager.filter_sql`.
+        self.filters = None
+        self.search = None
+        # The number of rows in the table (that match the filters), when known.
+        self.count = None
+        self.current = None
+
+        self._pages = OrderedDict()  # request -> Page, least recently used first
+        self._links = {}  # other requests that read a kept page -> the request it is kept under
+
+    def first(self):
+        return (self.sort, "after", None)
+
+    def last(self):
+        return (self.sort, "before", ())
+
+    def next(self, page=None):
+        """Get the request for the page after page (the current page by default), or None if it is the last."""
+        page = page or self.current
+        if page is None or len(page.df) == 0:
+            return None
+        if self.count is not None and page.offset + len(page.df) >= self.count:
+            return None
+        return (self.sort, "after", self.row_key(page, len(page.df) - 1))
+
+    def previous(self, page=None):
+        page = page or self.current
+        if page is None or page.offset <= 0 or len(page.df) == 0:
+            return None
+        return (self.sort, "before", self.row_key(page, 0))
+
+    def row_key(self, page, row):
+        return DBManager.page_key(self.table, page.df, row, order_by=self.sort[0])
+
+    def read_args(self, request):
+        """Get the keyword arguments of `DBManager.get_page` that read the page of request."""
+        (order_by, descending), direction, anchor = request
+        args = {"table": self.table, "order_by": order_by, "descending": descending,
+                "limit": self.page_size, "filters": self.filters, "search": self.search}
+        args[direction] = anchor
+        return args
+
+    def get(self, request):
+        """Get the page of request if it has been read, marking it as recently used."""
+        request = self._links.get(request, request)
+        page = self._pages.get(request)
+        if page is not None:
+            self._pages.move_to_end(request)
+        return page
+
+    def add(self, request, df, base=None, offset=None):
+        """Keep the page of rows df read for request. base is the page the request was made
+        from (its neighbour), which gives the position of the new page unless offset is given."""
+        _, direction, anchor = request
+        if offset is None:
+            if direction == "after":
+                offset = base.offset + len(base.df) if base is not None else 0
+            elif anchor == () and self.count is not None:
+                offset = max(self.count - len(df), 0)
+            else:
+                offset = max(base.offset - len(df), 0) if base is not None else 0
+
+        page = Page(self.table, df, request, offset)
+        self._pages[request] = page
+        # Stepping back from the new page leads to base again, so link that request to it.
+        if base is not None and len(df) > 0:
+            if direction == "after":
+                self._links[(self.sort, "before", self.row_key(page, 0))] = base.request
+            else:
+                self._links[(self.sort, "after", self.row_key(page, len(df) - 1))] = base.request
+        self._evict()
+        return page
+
+    def set_sort(self, sort):
+        """Sort the pages by sort, (column, descending), forgetting the pages read in another order."""
+        if sort == self.sort:
+            return
+        self.sort = sort
+        self._forget_others()
+
+    def set_filter(self, filters=None, search=None):
+        """Limit the pages to the rows matching filters and search, forgetting the pages read before."""
+        self.filters = filters
+        self.search = search
+        self.count = None
+        self._forget_others()
+
+    def _forget_others(self):
+        # The current page is still shown until the first page of the new view is read.
+        self._pages = OrderedDict((request, page) for request, page in self._pages.items()
+                                  if page is self.current)
+        self._links.clear()
+
+    def pages(self):
+        return list(self._pages.values())
+
+    def dirty_pages(self):
+        return [page for page in self._pages.values() if page.dirty]
+
+    @property
+    def dirty(self):
+        return any(page.dirty for page in self._pages.values())
+
+    def changeset(self):
+        """Get the changes of every page as one `ChangeSet`, and the changes of each page."""
+        changes = [(page, page.tracker.changeset(page.df)) for page in self.dirty_pages()]
+        return ChangeSet.merge([page_changes for _, page_changes in changes]), changes
+
+    def merge(self, changed, deleted):
+        """Bring the kept pages in line with the rows someone else changed or deleted, see
+        `DBManager.changes_since`. Rows with unsaved edits are left as they are, so saving
+        them is checked against the version they were loaded at and fails as a conflict.
+        Returns the keys of the changed rows that no page holds, eg new rows."""
+        version_col = DBManager.get_table(self.table).get("version")
+        fresh = changed.set_index(changed[self.pk].astype(np.int64), drop=False)
+        deleted = pd.Index(deleted, dtype=np.int64)
+        seen = set()
+
+        for page in self._pages.values():
+            if self.pk not in page.df or len(page.df) == 0:
+                continue
+            df = page.df.reset_index(drop=True)
+            keys = pd.to_numeric(df[self.pk])
+            edited = np.array([not pd.isna(key) and page.tracker.is_edited(key) for key in keys], dtype=bool)
+            clean = keys.notna() & ~edited
+            seen.update(keys[keys.isin(fresh.index)].astype(np.int64))
+
+            gone = clean & keys.isin(deleted)
+            hit = clean & keys.isin(fresh.index) & ~gone
+            if not gone.any() and not hit.any():
+                continue
+
+            if hit.any():
+                positions = np.flatnonzero(hit)
+                rows = df.loc[positions].copy()
+                read = fresh.loc[keys[hit].astype(np.int64)]
+                # Whole columns are replaced, so new categories don't have to be added first.
+                for col in read.columns:
+                    if col in rows:
+                        rows[col] = read[col].to_numpy()
+                df = pd.concat([df.drop(index=positions), rows]).sort_index()
+                if version_col in df:
+                    page.tracker.set_row_versions(dict(zip(rows[self.pk], rows[version_col])))
+            if gone.any():
+                page.tracker.forget(keys[gone].astype(np.int64))
+                df = df[~gone.to_numpy()]
+                if self.count is not None:
+                    self.count = max(self.count - int(gone.sum()), 0)
+            page.df = DBManager.apply_dtypes(df.reset_index(drop=True), self.table)
+
+        return [key for key in fresh.index if key not in seen]
+
+    def saved(self, page_changes, version):
+        """Record that the rows of page_changes (see `changeset()`) were saved at version, so
+        the next save of those rows is checked against it."""
+        version_col = DBManager.get_table(self.table).get("version")
+        if version is None or version_col is None:
+            return
+        for page, changes in page_changes:
+            if self.pk not in changes.update or self.pk not in page.df:
+                continue
+            keys = changes.update[self.pk].astype(np.int64)
+            page.tracker.set_row_versions(dict.fromkeys(keys, version))
+            if version_col in page.df:
+                written = pd.to_numeric(page.df[self.pk]).isin(keys).to_numpy()
+                page.df.loc[written, version_col] = version
+
+    def clear(self):
+        """Forget every page, eg after the table was changed in the database."""
+        self._pages.clear()
+        self._links.clear()
+        self.current = None
+
+    def _evict(self):
+        clean = [request for request, page in self._pages.items()
+                 if not page.dirty and page is not self.current]
+        for request in clean[:max(len(self._pages) - self.cache_size, 0)]:
+            del self._pages[request]
+        live = set(self._pages)
+        self._links = {link: request for link, request in self._links.items() if request in live}
@@ -0,0 +1,149 @@
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+import pandas as pd
+
+
+def result_size(value):
+    """Get the bytes a cached result takes, counting the contents of object columns."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    return sys.getsizeof(value)
+
+
+class QueryCache(object):
+    """An LRU cache of query results, bounded by the memory the results take.
+
+    Results are keyed by what was read, eg (table, columns, where, params), and note the
+    tables they were read from. Writing a table invalidates the results read from it, see
+    `invalidate()`. To not cache a result that a write overlapped, a read takes
+    `generation()` before it starts and `put()` drops the result if a table it was read
+    from has been written since. Results older than ttl seconds are read again, so writes
+    made by other clients are picked up eventually.
+
+    Results are handed out as copies, so callers may modify what they get.
+
+    budget int The most bytes the cached results may take, 0 disables the cache,
+    ttl float Seconds a result is served for (None for no limit)."""
+
+    def __init__(self, budget, ttl=None):
+        self.budget = budget
+        self.ttl = ttl
+
+        # key -> (value, tables, size, cached at), least recently used first.
+        self._entries = OrderedDict()
+        # table -> number of times it was written, see `generation()`.
+        self._generations = {}
+        # Bumped when every result is dropped, as that covers tables that were never written.
+        self._epoch = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "expired": 0,
+            "too_large": 0  # results bigger than the whole budget, which are never cached
+        }
+
+    def get(self, key):
+        """Get a copy of the result cached at key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[3] > self.ttl:
+                self._remove(key)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            value = entry[0]
+        return value.copy() if hasattr(value, "copy") else value
+
+    def generation(self, tables):
+        """Get the write counters of tables, to pass to `put()`."""
+        with self._lock:
+            return (self._epoch,) + tuple(self._generations.get(table, 0) for table in tables)
+
+    def put(self, key, tables, value, generation):
+        """Cache value at key as a result read from tables, unless one of the tables has been
+        written since generation was taken. Least recently used results are evicted to keep
+        within the budget. Returns whether the value was cached."""
+        tables = tuple(tables)
+        size = result_size(value)
+        with self._lock:
+            if self.budget <= 0:
+                return False
+            if generation != (self._epoch,) + tuple(self._generations.get(table, 0) for table in tables):
+                return False
+            if size > self.budget:
+                self._stats["too_large"] += 1
+                return False
+
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self._size + size > self.budget:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+            self._entries[key] = (value, tables, size, time.monotonic())
+            self._size += size
+        return True
+
+    def invalidate(self, tables):
+        """Drop the results read from any of tables, an empty table name drops every result,
+        eg for statements whose table isn't known."""
+        tables = set(tables)
+        with self._lock:
+            if "" in tables:
+                self._epoch += 1
+                tables.update(table for entry in self._entries.values() for table in entry[1])
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+            stale = [key for key, entry in self._entries.items() if tables.intersection(entry[1])]
+            for key in stale:
+                self._remove(key)
+            self._stats["invalidations"] += len(stale)
+
+    def clear(self):
+        """Drop every result, eg when connecting to another database."""
+        self.invalidate([""])
+
+    def resize(self, budget):
+        """Change the budget, evicting results that no longer fit."""
+        with self._lock:
+            self.budget = budget
+            while self._entries and self._size > max(budget, 0):
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        """Get the counters of the cache, with the results and bytes cached and the hit ratio."""
+        with self._lock:
+            out = dict(self._stats)
+            out["entries"] = len(self._entries)
+            out["bytes"] = self._size
+            out["budget"] = self.budget
+        lookups = out["hits"] + out["misses"]
+        out["hit_ratio"] = out["hits"] / lookups if lookups else 0.0
+        return out
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry[2]
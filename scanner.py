@@ -0,0 +1,255 @@
+"""Take stock changes from checkout and warehouse scanners and write them to the database in batches.
+
+Every scan is a (product, delta) event, eg (product id 12, -1) for one item sold or
+(barcode "5012345678900", +24) for a case received. Scanners can send hundreds of events
+a second, so rather than a statement per scan the changes are summed per product in
+memory and written every `scan_flush_ms` as one transaction of atomic
+`stock_available = stock_available + delta` updates, see `DBManager.add_stock`.
+
+Use from any number of threads, or from asyncio through `ScanIngester.consume`:
+
+ingester = ScanIngester().start()
+ingester.scan(12, -1)
+ingester.scan(barcode="5012345678900", delta=24)
+ingester.close()"""
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+
+from dbmanager import DBManager
+
+
+class ScanIngester(object):
+    """Sums the stock deltas of scans per product and writes them in the background.
+
+    Backpressure: at most `max_pending` scans wait to be written, once that many are
+    waiting `scan()` blocks (or gives up after its timeout) until a write makes room, so
+    a database that can't keep up slows the scanners down rather than filling memory.
+
+    Durability: `close()`, which also runs when the interpreter exits, writes what is
+    still waiting. If that fails the waiting deltas are kept in the journal file (if
+    `journal` is set) and are queued again by the next ingester started with the same journal.
+    A write that fails is retried with the next flush, its deltas are never dropped. While
+    writes keep failing the wait between them doubles, up to `max_backoff_ms`, however many
+    scans are waiting, so a database that is down isn't retried in a busy loop.
+
+    table str The products table,
+    flush_ms float How often the waiting deltas are written, in milliseconds,
+    max_pending int The most scans that wait to be written,
+    journal str Path of the file the unwritten deltas are kept in when stopping (optional)."""
+
+    # The longest wait between writes while they keep failing, in milliseconds.
+    max_backoff_ms = 30000
+
+    def __init__(self, table="products", flush_ms=None, max_pending=None, journal=None):
+        self.table = table
+        self.flush_ms = flush_ms or DBManager.getconfig("scan_flush_ms")
+        self.max_pending = max_pending or DBManager.getconfig("scan_max_pending")
+        self.journal = journal or DBManager.getconfig("scan_journal")
+        self.pk = DBManager.get_table(table)["primary"]
+
+        self._cond = threading.Condition()
+        # (column, key) -> summed delta of the scans not yet written.
+        self._deltas = {}
+        # The number of scans summed into `_deltas`, held against max_pending.
+        self._pending = 0
+        self._closed = False
+        self._thread = None
+
+        self._stats = {
+            "scans": 0,  # scans accepted
+            "written": 0,  # scans written to the database
+            "rejected": 0,  # scans given up on by `scan()` after waiting for room
+            "flushes": 0,
+            "rows_updated": 0,
+            "unmatched": 0,  # keys that matched no product when written
+            "errors": 0,
+            "last_error": None,
+            "flush_ms_total": 0.0,
+            "flush_ms_max": 0.0,
+            "blocked_ms": 0.0  # time scanners spent waiting for room
+        }
+        self._started = None
+
+    def start(self):
+        """Queue the deltas left in the journal and start writing in the background. Returns self."""
+        if self._thread is not None:
+            return self
+
+        self._recover()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="ScanIngester", daemon=True)
+        self._thread.start()
+        # Don't lose the waiting scans if the process exits without calling close().
+        atexit.register(self.close)
+        return self
+
+    def scan(self, id_product=None, delta=-1, barcode=None, timeout=None):
+        """Add delta to the stock of the product with id_product, or with barcode.
+
+        Waits for room if `max_pending` scans are already waiting, for at most timeout
+        seconds (None waits for as long as it takes, 0 doesn't wait). Returns False if
+        the scan wasn't taken, raises RuntimeError once the ingester is closed."""
+        if (id_product is None) == (barcode is None):
+            raise ValueError("A scan needs either an id_product or a barcode.")
+        key = (self.pk, int(id_product)) if barcode is None else ("barcode", str(barcode))
+
+        with self._cond:
+            if self._pending >= self.max_pending:
+                start = time.perf_counter()
+                room = self._cond.wait_for(
+                    lambda: self._closed or self._pending < self.max_pending, timeout)
+                self._stats["blocked_ms"] += (time.perf_counter() - start) * 1000
+                if not room:
+                    self._stats["rejected"] += 1
+                    return False
+            if self._closed:
+                raise RuntimeError("The scan ingester is closed.")
+
+            self._deltas[key] = self._deltas.get(key, 0) + int(delta)
+            self._pending += 1
+            self._stats["scans"] += 1
+            if self._pending >= self.max_pending:
+                # Write now rather than waiting out the flush interval.
+                self._cond.notify_all()
+        return True
+
+    async def consume(self, queue):
+        """Take scans from an asyncio queue until None is taken. The items are tuples of
+        `scan()` arguments, eg (id_product, delta), or dicts of them. Waiting for room
+        happens off the event loop."""
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                args, kwargs = (((), item) if isinstance(item, dict) else (item, {}))
+                if not self.scan(*args, timeout=0, **kwargs):
+                    await asyncio.to_thread(self.scan, *args, **kwargs)
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        """Write the waiting deltas now, in one transaction. Returns the number of rows updated.
+        On failure the deltas are put back to be written with the next flush."""
+        with self._cond:
+            deltas, pending = self._deltas, self._pending
+            self._deltas, self._pending = {}, 0
+        if not deltas:
+            return 0
+
+        by_column = {}
+        for (column, key), delta in deltas.items():
+            by_column.setdefault(column, {})[key] = delta
+
+        start = time.perf_counter()
+        try:
+            with DBManager.open_connection() as con:
+                cursor = DBManager.cursor(con)
+                updated = 0
+                for column, column_deltas in by_column.items():
+                    updated += DBManager.add_stock(cursor, self.table, column_deltas, column=column)
+                con.commit()
+        except Exception as err:
+            with self._cond:
+                self._restore(deltas, pending)
+                self._stats["errors"] += 1
+                self._stats["last_error"] = str(err)
+            raise
+
+        seconds = (time.perf_counter() - start) * 1000
+        with self._cond:
+            # Room was made, wake any scanner waiting for it.
+            self._cond.notify_all()
+            stats = self._stats
+            stats["written"] += pending
+            stats["flushes"] += 1
+            stats["rows_updated"] += updated
+            stats["unmatched"] += sum(1 for delta in deltas.values() if delta) - updated
+            stats["flush_ms_total"] += seconds
+            stats["flush_ms_max"] = max(stats["flush_ms_max"], seconds)
+        return updated
+
+    def close(self, timeout=None):
+        """Stop taking scans and write the waiting ones. Anything that can't be written is
+        kept in the journal, if there is one, otherwise a RuntimeError says how much was lost."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+        try:
+            self.flush()
+        except Exception:
+            if self._save_journal():
+                return
+            raise RuntimeError(f"{self._pending} scans could not be written and there is no journal to keep them in.")
+
+    def metrics(self):
+        """Get the counters of the ingester, with the scans waiting and the scans written per second."""
+        with self._cond:
+            out = dict(self._stats)
+            out["pending"] = self._pending
+            out["pending_products"] = len(self._deltas)
+        elapsed = time.perf_counter() - self._started if self._started is not None else 0
+        out["scans_per_sec"] = out["written"] / elapsed if elapsed > 0 else 0.0
+        out["flush_ms_mean"] = out["flush_ms_total"] / out["flushes"] if out["flushes"] else 0.0
+        return out
+
+    def _run(self):
+        interval = self.flush_ms / 1000
+        failures = 0
+        while True:
+            with self._cond:
+                if failures:
+                    # A failed write leaves the buffer full, so only closing cuts the wait short.
+                    backoff = min(interval * 2 ** (failures - 1), self.max_backoff_ms / 1000)
+                    self._cond.wait_for(lambda: self._closed, backoff)
+                else:
+                    self._cond.wait_for(lambda: self._closed or self._pending >= self.max_pending, interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                failures = 0
+            except Exception:
+                # Counted in the metrics, the deltas are written with the next flush.
+                failures += 1
+
+    def _restore(self, deltas, pending):
+        for key, delta in deltas.items():
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+        self._pending += pending
+
+    def _save_journal(self):
+        if not self.journal:
+            return False
+
+        with self._cond:
+            entries = [{"column": column, "key": key, "delta": delta}
+                       for (column, key), delta in self._deltas.items() if delta]
+            pending = self._pending
+        tmp_path = self.journal + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as journal_file:
+            json.dump({"pending": pending, "deltas": entries}, journal_file)
+        os.replace(tmp_path, self.journal)
+        return True
+
+    def _recover(self):
+        if not self.journal or not os.path.exists(self.journal):
+            return
+
+        with open(self.journal, encoding="utf-8") as journal_file:
+            saved = json.load(journal_file)
+        with self._cond:
+            self._restore({(entry["column"], entry["key"]): entry["delta"] for entry in saved["deltas"]},
+                          saved["pending"])
+        # The deltas are held in memory again, they are journaled again if they can't be written.
+        os.remove(self.journal)
@@ -0,0 +1,142 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import threading
+import time
+
+
+class SnapshotStore(object):
+    """Keeps a local, columnar copy of tables on disk so they can be shown without waiting on the database.
+
+    Every table is a directory with one `.npy` file per column (plus a mask for nullable
+    integers) and a `meta.json` holding the schema hash and high-water mark the snapshot
+    was taken at. Numeric columns are memory-mapped copy-on-write when loaded, each as its
+    own block of the DataFrame, so loading doesn't copy them and editing the loaded DataFrame
+    never touches the files. pandas copies them into memory once an operation consolidates
+    the frame's blocks, eg `copy()`. Text is stored as integer codes plus the list of
+    distinct values, which are decoded into memory."""
+
+    # Saves swap directories around, so they are done one at a time.
+    _save_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, table, df, schema_hash, high_water_mark=None):
+        """Write df as the snapshot of table, replacing the previous snapshot in one rename."""
+        with SnapshotStore._save_lock:
+            self._save(table, df, schema_hash, high_water_mark)
+
+    def _save(self, table, df, schema_hash, high_water_mark):
+        target = os.path.join(self.path, table)
+        tmp = target + f".tmp{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        columns = []
+        for idx, col in enumerate(df.columns):
+            columns.append(self._save_column(
+                tmp, f"c{idx}", col, df[col]))
+
+        meta = {
+            "table": table,
+            "schema_hash": schema_hash,
+            "high_water_mark": high_water_mark,
+            "rows": len(df),
+            "saved_at": time.time(),
+            "columns": columns
+        }
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+
+        old = target + f".old{os.getpid()}"
+        if os.path.exists(target):
+            os.replace(target, old)
+        os.replace(tmp, target)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def load(self, table, schema_hash):
+        """Load the snapshot of table as (DataFrame, meta), or None if there is no snapshot
+        or it was taken with a different schema."""
+        meta = self.meta(table)
+        if meta is None or meta["schema_hash"] != schema_hash:
+            return None
+
+        folder = os.path.join(self.path, table)
+        data = {}
+        try:
+            for col in meta["columns"]:
+                data[col["name"]] = self._load_column(folder, col)
+        except (OSError, ValueError):
+            return None
+
+        # Concatenating single column Series keeps every column in its own block. A frame built
+        # from a dict may stack the columns of one dtype into a single block, which copies them.
+        df = pd.concat([pd.Series(values, name=name, copy=False) for name, values in data.items()],
+                       axis=1, copy=False)
+        return df, meta
+
+    def meta(self, table):
+        try:
+            with open(os.path.join(self.path, table, "meta.json"), encoding="utf-8") as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def drop(self, table):
+        shutil.rmtree(os.path.join(self.path, table), ignore_errors=True)
+
+    @staticmethod
+    def _save_column(folder, filename, name, series):
+        col = {"name": name, "file": filename}
+        dtype = series.dtype
+
+        if isinstance(dtype, pd.CategoricalDtype):
+            col["kind"] = "categorical"
+            col["values"] = series.cat.categories.tolist()
+            np.save(os.path.join(folder, filename + ".npy"),
+                    series.cat.codes.to_numpy())
+        elif dtype == object:
+            # Text, stored as codes into the list of distinct values (-1 for missing).
+            col["kind"] = "object"
+            codes, uniques = pd.factorize(series)
+            col["values"] = [value if isinstance(value, (int, float)) else str(value)
+                             for value in uniques.tolist()]
+            np.save(os.path.join(folder, filename + ".npy"),
+                    codes.astype(np.int32))
+        elif isinstance(dtype, pd.api.extensions.ExtensionDtype):
+            # Nullable integers, stored as values plus a mask of missing values.
+            col["kind"] = "masked"
+            col["dtype"] = str(dtype)
+            np.save(os.path.join(folder, filename + ".npy"),
+                    series.to_numpy(dtype=dtype.numpy_dtype, na_value=0))
+            np.save(os.path.join(folder, filename + ".mask.npy"),
+                    series.isna().to_numpy())
+        else:
+            col["kind"] = "numpy"
+            col["dtype"] = str(dtype)
+            np.save(os.path.join(folder, filename + ".npy"), series.to_numpy())
+
+        return col
+
+    @staticmethod
+    def _load_column(folder, col):
+        path = os.path.join(folder, col["file"] + ".npy")
+
+        if col["kind"] in ("categorical", "object"):
+            codes = np.load(path)
+            if col["kind"] == "categorical":
+                return pd.Categorical.from_codes(codes, categories=col["values"])
+            # The extra slot at the end is what missing values (code -1) index into.
+            values = np.empty(len(col["values"]) + 1, dtype=object)
+            values[:-1] = col["values"]
+            values[-1] = np.nan
+            return values[codes]
+
+        values = np.load(path, mmap_mode="c")
+        if col["kind"] == "masked":
+            mask = np.load(os.path.join(folder, col["file"] + ".mask.npy"))
+            return pd.arrays.IntegerArray(values, mask)
+        return values